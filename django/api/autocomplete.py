@@ -0,0 +1,167 @@
+"""
+In-process type-ahead of ingredient names.
+
+Every word start of every name is kept as a token ("soy sauce" -> "soy sauce",
+"sauce") in one sorted list, so the names starting with a prefix or having a
+word starting with it are a contiguous range found by bisection. The range is
+ranked by the number of recipes using each ingredient. Prefixes shorter than
+`MIN_PREFIX_LENGTH` match nothing rather than a large part of the list.
+
+Like `search_index.recipe_index`, each worker keeps its own copy, built on
+first use (see `wsgi.py`) and rebuilt every `RECIPE_INDEX_REBUILD_SECONDS` to
+refresh the usage counts. Ingredients saved in this process are added through
+signals; the ones inserted by other processes (e.g. `save_or_update_min` in the
+scrapy crawler) are picked up by a sync every `SYNC_SECONDS` rather than a
+query per keystroke. Added tokens are buffered and merged into the sorted list
+at once on the next lookup rather than inserted one by one.
+"""
+
+import bisect
+import re
+import threading
+import time
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Count
+
+from .models import Ingredient, RecipeIngredient
+
+SYNC_SECONDS = 10
+MIN_PREFIX_LENGTH = 2
+
+WORD = re.compile(r"\w+")
+
+
+def tokens(name):
+    """the name from each of its word starts, lowercased"""
+    name = name.lower()
+    return [name[match.start() :] for match in WORD.finditer(name)] or [name]
+
+
+class IngredientAutocomplete:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """drop everything; it is rebuilt on the next access"""
+        with self._lock:
+            self.keys = []  # sorted tokens
+            self.ids = []  # ingredient id of each token
+            self.pending = []  # (token, ingredient id) not merged into keys yet
+            self.names = {}  # ingredient id -> name
+            self.usage = {}  # ingredient id -> number of recipes using it
+            self.last_ingredient_id = 0
+            self.built_at = None
+            self.synced_at = None
+
+    def build(self):
+        """(re)build everything from the DB"""
+        with self._lock:
+            self.reset()
+            self.usage = dict(
+                RecipeIngredient.objects.values_list("ingredient_id")
+                .annotate(count=Count("id"))
+                .order_by()
+            )
+            keys, ids = [], []
+            for ingredient_id, name in (
+                Ingredient.objects.order_by("id").values_list("id", "name").iterator()
+            ):
+                self.names[ingredient_id] = name
+                name_tokens = tokens(name)
+                keys += name_tokens
+                ids += [ingredient_id] * len(name_tokens)
+                self.last_ingredient_id = ingredient_id
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            self.keys = [keys[i] for i in order]
+            self.ids = [ids[i] for i in order]
+            self.built_at = self.synced_at = time.monotonic()
+
+    def sync(self):
+        """load ingredients inserted since the last sync"""
+        with self._lock:
+            ingredients = (
+                Ingredient.objects.filter(id__gt=self.last_ingredient_id)
+                .order_by("id")
+                .values_list("id", "name")
+            )
+            for ingredient_id, name in ingredients:
+                self.add(ingredient_id, name)
+                self.last_ingredient_id = ingredient_id
+            self.synced_at = time.monotonic()
+
+    def ensure_fresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if (
+                self.built_at is None
+                or now - self.built_at > settings.RECIPE_INDEX_REBUILD_SECONDS
+            ):
+                self.build()
+            elif now - self.synced_at > SYNC_SECONDS:
+                self.sync()
+
+    def add(self, ingredient_id, name):
+        with self._lock:
+            if self.names.get(ingredient_id) == name:
+                return  # already added, e.g. by both `sync` and a signal
+            if ingredient_id in self.names:
+                self.remove(ingredient_id)
+            self.names[ingredient_id] = name
+            self.pending += [(token, ingredient_id) for token in tokens(name)]
+
+    def merge_pending(self):
+        """merge the added tokens into the sorted ones, in linear time"""
+        with self._lock:
+            if not self.pending:
+                return
+            self.pending.sort()  # two sorted runs, which timsort merges in one pass
+            merged = sorted([*zip(self.keys, self.ids), *self.pending])
+            self.keys = [key for key, _ in merged]
+            self.ids = [ingredient_id for _, ingredient_id in merged]
+            self.pending = []
+
+    def remove(self, ingredient_id):
+        with self._lock:
+            name = self.names.pop(ingredient_id, None)
+            if name is None:
+                return
+            self.merge_pending()
+            for token in tokens(name):
+                i = bisect.bisect_left(self.keys, token)
+                while self.ids[i] != ingredient_id:  # same token of other names
+                    i += 1
+                del self.keys[i]
+                del self.ids[i]
+
+    def complete(self, prefix, limit=10):
+        """
+        Returns [(id, name, number of recipes)] of the ingredients having a
+        word starting with `prefix` (case-insensitive), the most used first,
+        none if the prefix is shorter than `MIN_PREFIX_LENGTH`.
+        """
+        prefix = prefix.strip().lower()
+        if len(prefix) < MIN_PREFIX_LENGTH:
+            return []
+        with self._lock:
+            self.ensure_fresh()
+            self.merge_pending()
+            start = bisect.bisect_left(self.keys, prefix)
+            stop = bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo=start)
+            ids = np.unique(np.array(self.ids[start:stop], dtype=np.int64))
+            usage = np.array([self.usage.get(i, 0) for i in ids.tolist()])
+            if len(ids) > limit:  # keep ties of the limit-th ingredient
+                kth = np.partition(-usage, limit - 1)[limit - 1]
+                ids, usage = ids[-usage <= kth], usage[-usage <= kth]
+            results = [
+                (i, self.names[i], count)
+                for i, count in zip(ids.tolist(), usage.tolist())
+            ]
+        results.sort(key=lambda r: (-r[2], len(r[1]), r[1]))
+        return results[:limit]
+
+
+ingredient_autocomplete = IngredientAutocomplete()
@@ -0,0 +1,107 @@
+"""
+Inventory (ingredients in storage) and excluded ingredients of each user.
+
+The inventory cache is invalidated whenever one of the user's `UserIngredient`
+rows changes (see `signals.py`). The default cache is per process, where other
+workers cannot invalidate it, so entries also expire after
+`settings.INVENTORY_CACHE_SECONDS`. It only feeds the ranking (fridge mode
+and the expiry order), where that staleness is acceptable; `in_storage` of
+recipes is read from the database (see `payloads.py`). Exclusions are not
+cached either: serving an outdated set of allergens from another instance's
+cache is not acceptable.
+"""
+
+import math
+from datetime import timedelta
+
+import numpy as np
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .models import StorageLocation, UserExcludedIngredient, UserIngredient
+
+# weight of an ingredient halves every this many days before it expires
+EXPIRY_HALF_LIFE_DAYS = 3.0
+
+SHELF_LIFE_FIELDS = {
+    StorageLocation.PANTRY: "ingredient__pantry_days",
+    StorageLocation.REFRIGERATOR: "ingredient__refrigerator_days",
+    StorageLocation.FREEZER: "ingredient__freezer_days",
+}
+
+
+def inventory_key(user_id):
+    return f"api:inventory:{user_id}"
+
+
+def _expires_at(row):
+    """timestamp when the user's copy expires, estimated by shelf life if unset"""
+    if row["expiration_date"] is not None:
+        return row["expiration_date"].timestamp()
+    shelf_life = row[SHELF_LIFE_FIELDS.get(row["storage"], "ingredient__pantry_days")]
+    if shelf_life is None:
+        return math.inf
+    return (row["created_date"] + timedelta(days=shelf_life)).timestamp()
+
+
+def user_inventory_expiry(user_id):
+    """
+    Returns {ingredient id: expiration timestamp} of the ingredients the user
+    has and not consumed yet (the earliest one for duplicated ingredients).
+    """
+    key = inventory_key(user_id)
+    inventory = cache.get(key)
+    if inventory is None:
+        inventory = {}
+        rows = UserIngredient.objects.filter(user=user_id, consumed=False).values(
+            "ingredient_id",
+            "expiration_date",
+            "created_date",
+            "storage",
+            *SHELF_LIFE_FIELDS.values(),
+        )
+        for row in rows:
+            expires_at = _expires_at(row)
+            ingredient_id = row["ingredient_id"]
+            inventory[ingredient_id] = min(
+                expires_at, inventory.get(ingredient_id, math.inf)
+            )
+        cache.set(key, inventory, timeout=settings.INVENTORY_CACHE_SECONDS)
+    return inventory
+
+
+def user_inventory(user_id):
+    """ids of the ingredients the user has and not consumed yet"""
+    return list(user_inventory_expiry(user_id))
+
+
+def expiry_weights(user_id, at=None):
+    """
+    Returns {ingredient id: weight} of the user's ingredients at the timestamp
+    `at` (default: now), where the weight is 1 for expired ones and decays
+    exponentially the later they expire.
+    """
+    inventory = user_inventory_expiry(user_id)
+    now = timezone.now().timestamp() if at is None else at
+    expires_at = np.fromiter(inventory.values(), dtype=float, count=len(inventory))
+    days_left = np.clip((expires_at - now) / (24 * 60 * 60), 0, None)
+    weights = np.exp2(-days_left / EXPIRY_HALF_LIFE_DAYS)
+    return dict(zip(inventory, weights.tolist()))
+
+
+def invalidate_inventory(user_id):
+    cache.delete(inventory_key(user_id))
+
+
+def user_exclusions(user_id):
+    """
+    ids of the ingredients the user excluded from recipes (e.g. allergens),
+    always read from the DB: one indexed query, never stale on any instance
+    """
+    return list(
+        UserExcludedIngredient.objects.filter(user=user_id).values_list(
+            "ingredient_id", flat=True
+        )
+    )
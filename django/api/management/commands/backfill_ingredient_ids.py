@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api.models import Recipe
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized Recipe.ingredient_ids from RecipeIngredient"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of recipe ids updated per statement",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = Recipe.objects.aggregate(m=Max("id"))["m"] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            updated += Recipe.objects.filter(
+                id__gte=start, id__lt=start + batch_size
+            ).update_ingredient_ids()
+            if options["verbosity"] > 1:
+                self.stdout.write(f"updated recipes up to id {start + batch_size - 1}")
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} recipes"))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api.models import Recipe
+from api.search_cache import bump_search_version
+
+
+class Command(BaseCommand):
+    help = "Recompute Recipe.search_vector from the titles and tag names"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of recipe ids updated per statement",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = Recipe.objects.aggregate(m=Max("id"))["m"] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            updated += Recipe.objects.filter(
+                id__gte=start, id__lt=start + batch_size
+            ).update_search_vector()
+            if options["verbosity"] > 1:
+                self.stdout.write(f"updated recipes up to id {start + batch_size - 1}")
+        bump_search_version()
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} recipes"))
@@ -0,0 +1,120 @@
+import time
+
+from rest_framework.renderers import JSONRenderer
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch
+
+from api.models import Recipe, User, UserRecipeFavorite, UserRecipeHistory
+from api.payloads import compact_tables, favorite_list, history_list, recipe_list
+from api.serializers import (
+    RecipeSerializer,
+    UserRecipeFavoriteSerializer,
+    UserRecipeHistorySerializer,
+)
+
+
+def drf_recipes(ids, user_id):
+    res = Recipe.objects.in_order(ids).annotate_all(user_id)
+    return RecipeSerializer(res, many=True).data
+
+
+def drf_history(user_id):
+    urhs = (
+        UserRecipeHistory.objects.filter(user=user_id)
+        .prefetch_related(
+            Prefetch("recipe", queryset=Recipe.objects.annotate_all(user_id))
+        )
+        .order_by("-access_date", "-id")
+    )
+    return UserRecipeHistorySerializer(urhs, many=True).data
+
+
+def drf_favorites(user_id):
+    urfs = (
+        UserRecipeFavorite.objects.filter(user=user_id)
+        .prefetch_related(
+            Prefetch("recipe", queryset=Recipe.objects.annotate_all(user_id))
+        )
+        .order_by("-added_date", "-id")
+    )
+    return UserRecipeFavoriteSerializer(urfs, many=True).data
+
+
+def compact(render):
+    """the same rendering function in the compact format"""
+
+    def render_compact(*args):
+        tables = compact_tables()
+        return {"results": render(*args, tables=tables), **tables}
+
+    return render_compact
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time to render recipes through the DRF serializers and "
+        "through api/payloads.py, check that the JSON is identical, and time "
+        "the compact format"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--recipes",
+            type=int,
+            default=500,
+            help="number of recipes rendered (the ones with the smallest ids)",
+        )
+        parser.add_argument(
+            "--user",
+            help="username whose history and favorites are rendered too",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="number of runs of each, the fastest is reported",
+        )
+
+    def handle(self, *args, **options):
+        user_id = None
+        if options["user"] is not None:
+            try:
+                user_id = User.objects.get(username=options["user"]).id
+            except User.DoesNotExist:
+                raise CommandError(f"unknown user: {options['user']}")
+        ids = list(
+            Recipe.objects.order_by("id").values_list("id", flat=True)[
+                : options["recipes"]
+            ]
+        )
+        cases = [
+            (f"{len(ids)} recipes", drf_recipes, recipe_list, (ids, user_id)),
+        ]
+        if user_id is not None:
+            cases += [
+                ("history", drf_history, history_list, (user_id,)),
+                ("favorites", drf_favorites, favorite_list, (user_id,)),
+            ]
+
+        renderer = JSONRenderer()
+        for name, slow, fast, arguments in cases:
+            timings = []
+            for render in [slow, fast, compact(fast)]:
+                best = float("inf")
+                for _ in range(options["repeat"]):
+                    start = time.perf_counter()
+                    content = renderer.render(render(*arguments))
+                    best = min(best, time.perf_counter() - start)
+                timings.append((best, content))
+            (slow_time, slow_content), (fast_time, fast_content) = timings[:2]
+            compact_time, compact_content = timings[2]
+            if slow_content != fast_content:
+                raise CommandError(f"{name}: the JSON differs")
+            self.stdout.write(
+                f"{name}: serializers {slow_time * 1000:.1f} ms, "
+                f"payloads {fast_time * 1000:.1f} ms "
+                f"({slow_time / fast_time:.1f}x, {len(fast_content)} bytes), "
+                f"compact {compact_time * 1000:.1f} ms "
+                f"({slow_time / compact_time:.1f}x, {len(compact_content)} bytes)"
+            )
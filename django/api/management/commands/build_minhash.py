@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api.minhash import update_signatures
+from api.models import Recipe
+
+
+class Command(BaseCommand):
+    help = "Compute the MinHash signatures of all recipes for similar-recipe search"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of recipe ids computed per batch",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        last_id = Recipe.objects.aggregate(m=Max("id"))["m"] or 0
+        updated = 0
+        for start in range(0, last_id + 1, batch_size):
+            updated += update_signatures(
+                Recipe.objects.filter(id__gte=start, id__lt=start + batch_size)
+            )
+            if options["verbosity"] > 1:
+                self.stdout.write(f"computed recipes up to id {start + batch_size - 1}")
+        self.stdout.write(self.style.SUCCESS(f"Computed {updated} signatures"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from api.recommendations import NUM_NEIGHBORS, build_neighbors
+
+
+class Command(BaseCommand):
+    help = "Precompute the most similar recipes of each recipe by users' interactions"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--neighbors",
+            type=int,
+            default=NUM_NEIGHBORS,
+            help="number of similar recipes kept per recipe",
+        )
+
+    def handle(self, *args, **options):
+        count = build_neighbors(n=options["neighbors"])
+        self.stdout.write(self.style.SUCCESS(f"Computed neighbors of {count} recipes"))
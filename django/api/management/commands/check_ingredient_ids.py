@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from api.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        "Check that the denormalized Recipe.ingredient_ids match RecipeIngredient"
+        " (fix them by `manage.py backfill_ingredient_ids`)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--show",
+            type=int,
+            default=20,
+            help="number of inconsistent recipe ids to show",
+        )
+
+    def handle(self, *args, **options):
+        inconsistent = (
+            Recipe.objects.annotate_ingredient_ids("actual")
+            .exclude(ingredient_ids=F("actual"))
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        count = inconsistent.count()
+        if count:
+            ids = ", ".join(map(str, inconsistent[: options["show"]]))
+            raise CommandError(
+                f"{count} recipes have inconsistent ingredient_ids, e.g. {ids}"
+            )
+        self.stdout.write(self.style.SUCCESS("ingredient_ids are consistent"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.rollups import rebuild_usage
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the running usage and happiness aggregates of ingredients"
+        " (IngredientUsage) from RecipeIngredient and UserIngredient"
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild_usage()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt usage of {count} ingredients"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.trending import rebuild
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the checkpoint of the trending recipes from UserRecipeHistory"
+        " (the running workers pick it up within a minute)"
+    )
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt trends of {count} recipes"))
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from api.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the denormalized Recipe.num_cooked and Recipe.num_favorites"
+        " of the recipes where they differ from UserRecipeHistory and"
+        " UserRecipeFavorite"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=10000,
+            help="number of recipe ids updated per statement",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="only report the number of inconsistent recipes",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        inconsistent = list(
+            Recipe.objects.annotate_counts("actual_")
+            .exclude(
+                num_cooked=F("actual_num_cooked"),
+                num_favorites=F("actual_num_favorites"),
+            )
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        if options["dry_run"]:
+            self.stdout.write(f"{len(inconsistent)} recipes have inconsistent counts")
+            return
+        updated = 0
+        for start in range(0, len(inconsistent), batch_size):
+            end = start + batch_size
+            # recomputed rather than set to the values above, which may be stale
+            updated += Recipe.objects.filter(
+                id__in=inconsistent[start:end]
+            ).update_counts()
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} recipes"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from api.rollups import TOP_SIZE, refresh_rankings
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the most cooked, liked and viewed recipes served by"
+        " recipes/statistics (run it periodically, e.g. hourly)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=TOP_SIZE,
+            help="number of recipes kept per list",
+        )
+
+    def handle(self, *args, **options):
+        computed_at = refresh_rankings(n=options["top"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Refreshed recipe statistics at {computed_at}")
+        )
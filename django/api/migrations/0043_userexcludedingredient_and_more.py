@@ -0,0 +1,50 @@
+# Generated by Django 4.1.2 on 2026-10-18 11:54
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("api", "0042_recipe_ingredient_ids_recipe_recipe_ingredient_ids"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserExcludedIngredient",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("added_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "ingredient",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="api.ingredient"
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="userexcludedingredient",
+            constraint=models.UniqueConstraint(
+                fields=("user", "ingredient"), name="unique_user_excluded_ingredient"
+            ),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:07
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0045_recipe_search_vector"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecipeMinHash",
+            fields=[
+                (
+                    "recipe",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="minhash",
+                        serialize=False,
+                        to="api.recipe",
+                    ),
+                ),
+                ("signature", models.BinaryField()),
+                (
+                    "bands",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.BigIntegerField(),
+                        help_text="LSH bucket of each band of `signature`",
+                        size=None,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="recipeminhash",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["bands"], name="recipe_minhash_bands"
+            ),
+        ),
+    ]
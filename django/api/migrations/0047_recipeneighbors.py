@@ -0,0 +1,46 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:09
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0046_recipeminhash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecipeNeighbors",
+            fields=[
+                (
+                    "recipe",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="neighbors",
+                        serialize=False,
+                        to="api.recipe",
+                    ),
+                ),
+                (
+                    "neighbor_ids",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.BigIntegerField(),
+                        help_text="Most similar first",
+                        size=None,
+                    ),
+                ),
+                (
+                    "scores",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(),
+                        help_text="Similarity of each neighbor",
+                        size=None,
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0047_recipeneighbors"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecipePayload",
+            fields=[
+                (
+                    "recipe",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="payload",
+                        serialize=False,
+                        to="api.recipe",
+                    ),
+                ),
+                (
+                    "static",
+                    models.TextField(
+                        help_text="JSON of the recipe without the per-user and statistics fields"
+                    ),
+                ),
+            ],
+        ),
+    ]
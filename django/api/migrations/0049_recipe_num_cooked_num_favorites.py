@@ -0,0 +1,31 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0048_recipepayload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="recipe",
+            name="num_cooked",
+            field=models.IntegerField(
+                default=0,
+                editable=False,
+                help_text="Number of cooked UserRecipeHistory, denormalized for listing",
+            ),
+        ),
+        migrations.AddField(
+            model_name="recipe",
+            name="num_favorites",
+            field=models.IntegerField(
+                default=0,
+                editable=False,
+                help_text="Number of UserRecipeFavorite, denormalized for listing",
+            ),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0049_recipe_num_cooked_num_favorites"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecipeRanking",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("cooked", "most cooked"),
+                            ("liked", "most liked"),
+                            ("viewed", "most viewed"),
+                        ],
+                        max_length=8,
+                    ),
+                ),
+                ("rank", models.PositiveSmallIntegerField(help_text="0 for the first")),
+                ("count", models.PositiveIntegerField()),
+                ("computed_at", models.DateTimeField()),
+                (
+                    "recipe",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="api.recipe",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="reciperanking",
+            constraint=models.UniqueConstraint(
+                fields=("kind", "rank"), name="unique_recipe_ranking_kind_rank"
+            ),
+        ),
+    ]
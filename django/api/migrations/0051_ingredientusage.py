@@ -0,0 +1,75 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0050_reciperanking"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngredientUsage",
+            fields=[
+                (
+                    "ingredient",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="usage",
+                        serialize=False,
+                        to="api.ingredient",
+                    ),
+                ),
+                (
+                    "num_recipes",
+                    models.IntegerField(
+                        default=0, help_text="Number of RecipeIngredient"
+                    ),
+                ),
+                (
+                    "num_user_ingredients",
+                    models.IntegerField(
+                        default=0, help_text="Number of UserIngredient"
+                    ),
+                ),
+                (
+                    "happiness_sum",
+                    models.FloatField(
+                        default=0,
+                        help_text="Sum of the non-null UserIngredient.happiness",
+                    ),
+                ),
+                (
+                    "happiness_count",
+                    models.IntegerField(
+                        default=0,
+                        help_text="Number of the non-null UserIngredient.happiness",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="ingredientusage",
+            index=models.Index(
+                django.db.models.expressions.CombinedExpression(
+                    models.F("num_recipes"), "+", models.F("num_user_ingredients")
+                ),
+                name="ingredient_usage_uses",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="ingredientusage",
+            index=models.Index(
+                django.db.models.expressions.CombinedExpression(
+                    models.F("happiness_sum"), "/", models.F("happiness_count")
+                ),
+                condition=models.Q(("happiness_count__gt", 0)),
+                name="ingredient_usage_happiness",
+            ),
+        ),
+    ]
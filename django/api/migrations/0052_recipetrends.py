@@ -0,0 +1,43 @@
+# Generated by Django 4.1.2 on 2026-10-18 12:33
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0051_ingredientusage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecipeTrends",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "recipe_ids",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.BigIntegerField(), size=None
+                    ),
+                ),
+                (
+                    "scores",
+                    django.contrib.postgres.fields.ArrayField(
+                        base_field=models.FloatField(),
+                        help_text="Decayed view count of each recipe at `as_of`",
+                        size=None,
+                    ),
+                ),
+                ("as_of", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,115 @@
+"""
+MinHash signatures of the ingredient sets of recipes, to find similar recipes
+(by Jaccard similarity) without comparing all pairs.
+
+The signature of a recipe is the minimum of each of `NUM_PERM` hash functions
+over its ingredient ids; two signatures agree on a position with probability
+equal to the Jaccard similarity of the sets. Signatures are split into `BANDS`
+bands of `ROWS` positions, each hashed into one bucket, and only the recipes
+sharing a bucket are compared (likely the ones with a similarity above about
+(1 / BANDS) ** (1 / ROWS) = 0.5).
+
+`RecipeMinHash` rows are built offline by `manage.py build_minhash` and kept up
+to date by signals whenever the ingredients of a recipe change, e.g. when the
+crawler adds recipes.
+"""
+
+import numpy as np
+
+from django.db.models import Case, Value, When
+
+from .models import Recipe, RecipeMinHash
+
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+PRIME = (1 << 31) - 1  # hashes are (a * x + b) % PRIME, fitting in 64 bits
+
+# max number of recipes sharing a bucket with the given one that are compared,
+# those sharing the most buckets (then the lowest ids)
+MAX_CANDIDATES = 5000
+
+_rng = np.random.default_rng(20221204)  # fixed, stored signatures depend on it
+_A = _rng.integers(1, PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, PRIME, NUM_PERM, dtype=np.uint64)
+
+
+def signature(ingredient_ids):
+    """MinHash signature (uint32 array) of a non-empty set of ingredient ids"""
+    x = np.asarray(ingredient_ids, dtype=np.uint64) % np.uint64(PRIME)
+    hashes = (np.outer(_A, x) + _B[:, None]) % np.uint64(PRIME)
+    return hashes.min(axis=1).astype(np.uint32)
+
+
+def buckets(sig):
+    """LSH bucket of each band of the signature, as signed 64-bit integers"""
+    h = np.arange(BANDS, dtype=np.uint64)  # buckets of different bands differ
+    for column in sig.reshape(BANDS, ROWS).T.astype(np.uint64):
+        h = (h * np.uint64(1000003)) ^ column  # wraps around
+    return h.view(np.int64).tolist()
+
+
+def update_signatures(recipes):
+    """(re)compute the signatures of the recipes (queryset) from `ingredient_ids`"""
+    rows, empty = [], []
+    for recipe_id, ingredient_ids in recipes.values_list("id", "ingredient_ids"):
+        if not ingredient_ids:
+            empty.append(recipe_id)
+            continue
+        sig = signature(ingredient_ids)
+        rows.append(
+            RecipeMinHash(
+                recipe_id=recipe_id, signature=sig.tobytes(), bands=buckets(sig)
+            )
+        )
+    RecipeMinHash.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["recipe_id"],  # the column, as Django 4.1 uses it verbatim
+        update_fields=["signature", "bands"],
+    )
+    RecipeMinHash.objects.filter(recipe_id__in=empty).delete()
+    return len(rows)
+
+
+def similar_recipes(recipe_id, limit=10):
+    """
+    Returns [(recipe id, estimated Jaccard similarity)] of the recipes with
+    the most similar ingredients to the given one, the most similar first.
+    Raises Recipe.DoesNotExist for unknown recipes.
+    """
+    row = (
+        RecipeMinHash.objects.filter(recipe_id=recipe_id)
+        .values_list("signature", "bands")
+        .first()
+    )
+    if row is not None:
+        sig, bands = np.frombuffer(row[0], dtype=np.uint32), row[1]
+    else:  # not computed yet
+        ingredient_ids = Recipe.objects.values_list("ingredient_ids", flat=True).get(
+            id=recipe_id
+        )
+        if not ingredient_ids:
+            return []
+        sig = signature(ingredient_ids)
+        bands = buckets(sig)
+
+    # the more bands match, the more similar the signatures are likely
+    matches = sum(
+        (Case(When(bands__contains=[band], then=1), default=0) for band in bands),
+        Value(0),
+    )
+    candidates = list(
+        RecipeMinHash.objects.filter(bands__overlap=bands)
+        .exclude(recipe_id=recipe_id)
+        .annotate(matches=matches)
+        .order_by("-matches", "recipe_id")
+        .values_list("recipe_id", "signature")[:MAX_CANDIDATES]
+    )
+    if not candidates:
+        return []
+    ids = np.array([c[0] for c in candidates], dtype=np.int64)
+    sigs = np.frombuffer(b"".join(c[1] for c in candidates), dtype=np.uint32)
+    similarity = (sigs.reshape(len(ids), NUM_PERM) == sig).mean(axis=1)
+    order = np.lexsort((ids, -similarity))[:limit]
+    return list(zip(ids[order].tolist(), similarity[order].tolist()))
@@ -1,8 +1,13 @@
 from api.querysets import IngredientQuerySet, RecipeQuerySet
 
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import F, Q
+from django.db.models.functions import Cast, Upper
 from django.db.utils import IntegrityError
 
 # Create your models here.
@@ -26,6 +31,13 @@ class StorageLocation(models.IntegerChoices):
     FREEZER = 2, "freezer"
 
 
+# precomputed top lists of recipes
+class RankingKind(models.TextChoices):
+    COOKED = "cooked", "most cooked"
+    LIKED = "liked", "most liked"
+    VIEWED = "viewed", "most viewed"
+
+
 User = get_user_model()
 
 
@@ -76,10 +88,29 @@ class Ingredient(models.Model):
                 found.save()
             return updated
 
+    class Meta:
+        indexes = [
+            # trigrams of the expression compared by `name__icontains`, also used
+            # by `IngredientQuerySet.similar`
+            GinIndex(
+                OpClass(Upper(Cast("name", models.TextField())), name="gin_trgm_ops"),
+                name="ingredient_name_trgm",
+            )
+        ]
+
 
 class Recipe(models.Model):
     objects = RecipeQuerySet.as_manager()
 
+    # kept up to date from other tables by `signals.py`, never saved from an
+    # instance, which may hold stale values
+    DENORMALIZED_FIELDS = {
+        "ingredient_ids",
+        "search_vector",
+        "num_cooked",
+        "num_favorites",
+    }
+
     title = models.CharField(max_length=64)
     recipe_url = models.URLField(blank=True, max_length=1024)
     image_url = models.URLField(blank=True, max_length=2048)
@@ -95,6 +126,28 @@ class Recipe(models.Model):
         blank=True,
         help_text="Number of types of ingredients, for sanity check purpose",
     )
+    ingredient_ids = ArrayField(
+        models.BigIntegerField(),
+        default=list,
+        blank=True,
+        editable=False,
+        help_text="Sorted ids of `ingredients`, denormalized for searching",
+    )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        help_text="Full-text vector of the title and tag names, for searching",
+    )
+    num_cooked = models.IntegerField(
+        default=0,
+        editable=False,
+        help_text="Number of cooked UserRecipeHistory, denormalized for listing",
+    )
+    num_favorites = models.IntegerField(
+        default=0,
+        editable=False,
+        help_text="Number of UserRecipeFavorite, denormalized for listing",
+    )
 
     ingredients = models.ManyToManyField(
         Ingredient, through="RecipeIngredient", related_name="recipes"
@@ -109,6 +162,15 @@ class Recipe(models.Model):
     def __str__(self):
         return self.title
 
+    def save(self, *args, update_fields=None, **kwargs):
+        if update_fields is None and not self._state.adding:
+            update_fields = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DENORMALIZED_FIELDS
+            ]
+        super().save(*args, update_fields=update_fields, **kwargs)
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -116,6 +178,10 @@ class Recipe(models.Model):
                 name="unique_recipe_title_url",
             )
         ]
+        indexes = [
+            GinIndex(fields=["ingredient_ids"], name="recipe_ingredient_ids"),
+            GinIndex(fields=["search_vector"], name="recipe_search_vector"),
+        ]
 
 
 class Tag(models.Model):
@@ -327,6 +393,129 @@ class RecipeNutrition(models.Model):
                 return  # just return if already saved
 
 
+class RecipeMinHash(models.Model):
+    """MinHash signature of the ingredients of a recipe (see api/minhash.py)"""
+
+    recipe = models.OneToOneField(
+        Recipe, on_delete=models.CASCADE, primary_key=True, related_name="minhash"
+    )
+    signature = models.BinaryField()
+    bands = ArrayField(
+        models.BigIntegerField(), help_text="LSH bucket of each band of `signature`"
+    )
+
+    def __str__(self):
+        return f"recipe: {str(self.recipe)}"
+
+    class Meta:
+        indexes = [GinIndex(fields=["bands"], name="recipe_minhash_bands")]
+
+
+class RecipeNeighbors(models.Model):
+    """Most similar recipes by users' interactions (see api/recommendations.py)"""
+
+    recipe = models.OneToOneField(
+        Recipe, on_delete=models.CASCADE, primary_key=True, related_name="neighbors"
+    )
+    neighbor_ids = ArrayField(models.BigIntegerField(), help_text="Most similar first")
+    scores = ArrayField(models.FloatField(), help_text="Similarity of each neighbor")
+
+    def __str__(self):
+        return f"recipe: {str(self.recipe)}"
+
+
+class RecipePayload(models.Model):
+    """Pre-rendered static part of a recipe's JSON (see api/payloads.py)"""
+
+    recipe = models.OneToOneField(
+        Recipe, on_delete=models.CASCADE, primary_key=True, related_name="payload"
+    )
+    static = models.TextField(
+        help_text="JSON of the recipe without the per-user and statistics fields"
+    )
+
+    def __str__(self):
+        return f"recipe: {str(self.recipe)}"
+
+
+class IngredientUsage(models.Model):
+    """Running aggregates of the uses of an ingredient (see api/rollups.py)"""
+
+    ingredient = models.OneToOneField(
+        Ingredient, on_delete=models.CASCADE, primary_key=True, related_name="usage"
+    )
+    num_recipes = models.IntegerField(default=0, help_text="Number of RecipeIngredient")
+    num_user_ingredients = models.IntegerField(
+        default=0, help_text="Number of UserIngredient"
+    )
+    happiness_sum = models.FloatField(
+        default=0, help_text="Sum of the non-null UserIngredient.happiness"
+    )
+    happiness_count = models.IntegerField(
+        default=0, help_text="Number of the non-null UserIngredient.happiness"
+    )
+
+    def __str__(self):
+        return f"ingredient: {str(self.ingredient)}"
+
+    class Meta:
+        indexes = [
+            # the orderings of `rollups.ingredient_rankings`
+            models.Index(
+                F("num_recipes") + F("num_user_ingredients"),
+                name="ingredient_usage_uses",
+            ),
+            models.Index(
+                F("happiness_sum") / F("happiness_count"),
+                name="ingredient_usage_happiness",
+                condition=Q(happiness_count__gt=0),
+            ),
+        ]
+
+
+class RecipeTrends(models.Model):
+    """Checkpoint of the decayed view counts of recipes (see api/trending.py)"""
+
+    recipe_ids = ArrayField(models.BigIntegerField())
+    scores = ArrayField(
+        models.FloatField(), help_text="Decayed view count of each recipe at `as_of`"
+    )
+    as_of = models.DateTimeField()
+
+    def __str__(self):
+        return f"trends as of {self.as_of}"
+
+
+class SearchVersion(models.Model):
+    """Counter of the changes to the searchable data (see api/search_cache.py)"""
+
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"search version {self.version}"
+
+
+class RecipeRanking(models.Model):
+    """Place of a recipe in a precomputed top list (see api/rollups.py)"""
+
+    kind = models.CharField(max_length=8, choices=RankingKind.choices)
+    rank = models.PositiveSmallIntegerField(help_text="0 for the first")
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="+")
+    count = models.PositiveIntegerField()
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.kind} #{self.rank + 1}: {str(self.recipe)}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "rank"],
+                name="unique_recipe_ranking_kind_rank",
+            )
+        ]
+
+
 class UserRecipeHistory(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
@@ -352,3 +541,22 @@ class UserRecipeFavorite(models.Model):
                 name="unique_user_recipe",
             )
         ]
+
+
+class UserExcludedIngredient(models.Model):
+    """Ingredient the user never wants in recipes, e.g. an allergen"""
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE)
+    added_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"user: {str(self.user)}, ingredient: {str(self.ingredient)}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "ingredient"],
+                name="unique_user_excluded_ingredient",
+            )
+        ]
@@ -0,0 +1,443 @@
+"""
+Read-only fast path of `RecipeSerializer` and the serializers nesting it.
+
+Going through DRF costs a model instance per row and a field object call per
+value of every nested recipe-ingredient, ingredient, tag and nutrition. These
+functions build the same dicts from `values_list` tuples instead. Keys, their
+order and the formatting of values follow the serializers, so the rendered
+JSON is byte-identical (see `tests.py` and `./manage.py benchmark_payloads`).
+
+The static part of a recipe (its fields, nutrition, tags and ingredients)
+hardly ever changes after scraping, so it is rendered once by `render_static`
+and stored as JSON in `RecipePayload` (a text column, since jsonb would not
+keep the order of keys). When the recipe or one of its parts changes, the stored
+payload is dropped and rendered again after the change is committed (see
+`signals.py`), overwriting what a concurrent request may have stored from the
+data before the change. Responses then take one query for the statistics and
+per-user fields, which are overlaid on the stored part, and one for the
+ingredients the user has in storage. The latter is not cached, since other
+workers would show a stale `in_storage` after the user changes them.
+
+In the compact format (`tables`), recipes reference their ingredients and tags
+by id, and each of them is rendered once per response in a side table instead
+of once per recipe using it.
+"""
+
+import json
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (
+    Recipe,
+    RecipeIngredient,
+    RecipePayload,
+    RecipeTag,
+    UserIngredient,
+    UserRecipeFavorite,
+    UserRecipeHistory,
+)
+
+CENT = Decimal("0.01")  # decimal_places=2 of the DecimalFields
+
+RECIPE_FIELDS = [
+    "id",
+    "title",
+    "recipe_url",
+    "image_url",
+    "cook_minute",
+    "num_servings",
+    "language",
+    "num_ingredients",
+    "nutrition__recipe",
+    "nutrition__calories_kcal_per_serving",
+    "nutrition__fat_gram_per_serving",
+    "nutrition__carbs_gram_per_serving",
+    "nutrition__protein_gram_per_serving",
+]
+INGREDIENT_FIELDS = [
+    "recipe_id",
+    "id",
+    "quantity_value",
+    "weight",
+    "quantity_scale_id",
+    "ingredient_id",
+    "ingredient__name",
+    "ingredient__info_url",
+    "ingredient__image_url",
+    "ingredient__category",
+    "ingredient__pantry_days",
+    "ingredient__refrigerator_days",
+    "ingredient__freezer_days",
+]
+# keys of `RecipeSerializer`, in its order
+RECIPE_KEYS = [
+    "id",
+    "nutrition",
+    "tags",
+    "ingredients",
+    "user_cooked",
+    "user_favorite",
+    "all_cooked",
+    "all_favorite",
+    "title",
+    "recipe_url",
+    "image_url",
+    "cook_minute",
+    "num_servings",
+    "language",
+    "num_ingredients",
+]
+# relations rendered in full if expanded, as lists of ids otherwise
+EXPANDABLE = ["tags", "ingredients"]
+STATS_KEYS = ["all_cooked", "all_favorite"]
+USER_KEYS = ["user_cooked", "user_favorite"]
+
+TAG_FIELDS = [
+    "recipe_id",
+    "tag_id",
+    "tag__name",
+    "tag__category",
+    "tag__description",
+    "tag__info_url",
+    "tag__image_url",
+    "tag__language",
+]
+
+
+def format_decimal(value):
+    """as `serializers.DecimalField(decimal_places=2)`"""
+    return None if value is None else f"{value.quantize(CENT):f}"
+
+
+def format_datetime(value):
+    """as `serializers.DateTimeField` (ISO 8601 in the current time zone)"""
+    if not value:
+        return None
+    value = timezone.localtime(value).isoformat()
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+
+def nutrition(row):
+    """nutrition of a row of `RECIPE_FIELDS`, None if the recipe has none"""
+    if row.nutrition__recipe is None:
+        return None
+    return {
+        "recipe": row.nutrition__recipe,
+        "calories_kcal_per_serving": row.nutrition__calories_kcal_per_serving,
+        "fat_gram_per_serving": row.nutrition__fat_gram_per_serving,
+        "carbs_gram_per_serving": row.nutrition__carbs_gram_per_serving,
+        "protein_gram_per_serving": row.nutrition__protein_gram_per_serving,
+    }
+
+
+def render_static(ids):
+    """
+    Returns {recipe id: dict} of the static part of the recipes with the given
+    ids, i.e. their payload without the statistics and per-user fields.
+    """
+    ids = list(ids)
+    payloads = {}
+    recipes = Recipe.objects.filter(id__in=ids).order_by()
+    for row in recipes.values_list(*RECIPE_FIELDS, named=True):
+        payloads[row.id] = {
+            "id": row.id,
+            "nutrition": nutrition(row),
+            "tags": [],
+            "ingredients": [],
+            "title": row.title,
+            "recipe_url": row.recipe_url,
+            "image_url": row.image_url,
+            "cook_minute": row.cook_minute,
+            "num_servings": row.num_servings,
+            "language": row.language,
+            "num_ingredients": row.num_ingredients,
+        }
+
+    recipe_ingredients = RecipeIngredient.objects.filter(recipe_id__in=ids)
+    ingredients = {}  # ingredient id -> dict, shared by the recipes using it
+    for row in recipe_ingredients.order_by("id").values_list(
+        *INGREDIENT_FIELDS, named=True
+    ):
+        ingredient = ingredients.get(row.ingredient_id)
+        if ingredient is None:
+            ingredient = ingredients[row.ingredient_id] = {
+                "id": row.ingredient_id,
+                "name": row.ingredient__name,
+                "info_url": row.ingredient__info_url,
+                "image_url": row.ingredient__image_url,
+                "category": row.ingredient__category,
+                "pantry_days": row.ingredient__pantry_days,
+                "refrigerator_days": row.ingredient__refrigerator_days,
+                "freezer_days": row.ingredient__freezer_days,
+            }
+        payloads[row.recipe_id]["ingredients"].append(
+            {
+                "id": row.id,
+                "ingredient": ingredient,
+                "quantity_value": format_decimal(row.quantity_value),
+                "weight": format_decimal(row.weight),
+                "recipe": row.recipe_id,
+                "quantity_scale": row.quantity_scale_id,
+            }
+        )
+
+    tags = {}  # tag id -> dict, shared by the recipes having it
+    recipe_tags = RecipeTag.objects.filter(recipe_id__in=ids).order_by("tag_id")
+    for row in recipe_tags.values_list(*TAG_FIELDS):
+        recipe_id, tag_id, *values = row
+        tag = tags.get(tag_id)
+        if tag is None:
+            name, category, description, info_url, image_url, language = values
+            tag = tags[tag_id] = {
+                "id": tag_id,
+                "name": name,
+                "category": category,
+                "description": description,
+                "info_url": info_url,
+                "image_url": image_url,
+                "language": language,
+            }
+        payloads[recipe_id]["tags"].append(tag)
+    return payloads
+
+
+def static_payloads(ids):
+    """
+    Returns {recipe id: dict} of the static part of the recipes, read from
+    their pre-rendered `RecipePayload`, or rendered and stored if missing.
+    """
+    ids = list(ids)
+    stored = dict(
+        RecipePayload.objects.filter(recipe_id__in=ids).values_list(
+            "recipe_id", "static"
+        )
+    )
+    payloads = {id: json.loads(static) for id, static in stored.items()}
+    missing = [id for id in ids if id not in stored]
+    if missing:
+        rendered = render_static(missing)
+        RecipePayload.objects.bulk_create(
+            [
+                RecipePayload(recipe_id=id, static=json.dumps(payload))
+                for id, payload in rendered.items()
+            ],
+            ignore_conflicts=True,  # stored by a concurrent request
+        )
+        payloads.update(rendered)
+    return payloads
+
+
+def invalidate_payloads(recipes):
+    """drop the pre-rendered payloads of the recipes (ids or a queryset)"""
+    RecipePayload.objects.filter(recipe__in=recipes).delete()
+
+
+def refresh_payloads(recipes):
+    """
+    Render the payloads of the recipes (ids or a queryset) again and store
+    them. The recipe rows are locked meanwhile so that concurrent refreshes
+    store their renderings in the order they read the data.
+    """
+    with transaction.atomic():
+        ids = list(
+            Recipe.objects.select_for_update()
+            .filter(id__in=recipes)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        RecipePayload.objects.bulk_create(
+            [
+                RecipePayload(recipe_id=id, static=json.dumps(payload))
+                for id, payload in render_static(ids).items()
+            ],
+            update_conflicts=True,
+            unique_fields=["recipe_id"],
+            update_fields=["static"],
+        )
+
+
+def compact_tables():
+    """side tables filled by the functions below in the compact format"""
+    return {"ingredients": {}, "tags": {}}
+
+
+def recipe_rows(ids, user_id, fields, expand):
+    """
+    rows of the recipes with the given ids, with only the columns needed for
+    `fields` that are not read from the stored payloads
+    """
+    recipes = Recipe.objects.filter(id__in=list(ids)).order_by()
+    columns = ["id"]
+    if fields.intersection(STATS_KEYS):
+        recipes = recipes.annotate_stats()
+        columns += STATS_KEYS
+    if user_id and fields.intersection(USER_KEYS):
+        recipes = recipes.annotate_user(user_id)
+        columns += USER_KEYS
+    if not expand:  # otherwise read from the stored payloads
+        columns += [
+            name for name in RECIPE_FIELDS[1:] if name.partition("__")[0] in fields
+        ]
+    if "ingredients" in fields - expand:
+        columns.append("ingredient_ids")
+    return list(recipes.values_list(*columns, named=True))
+
+
+def recipe_tag_ids(ids):
+    """{recipe id: ids of its tags in increasing order}"""
+    tag_ids = {}
+    recipe_tags = RecipeTag.objects.filter(recipe_id__in=ids).order_by("tag_id")
+    for recipe_id, tag_id in recipe_tags.values_list("recipe_id", "tag_id"):
+        tag_ids.setdefault(recipe_id, []).append(tag_id)
+    return tag_ids
+
+
+def with_storage(ingredient, inventory):
+    return {
+        "id": ingredient["id"],
+        "in_storage": ingredient["id"] in inventory,
+        **ingredient,
+    }
+
+
+def overlay_tags(values, tables):
+    """reference the expanded tags of `values` by id if `tables` is given"""
+    if tables is not None:
+        for tag in values["tags"]:
+            tables["tags"].setdefault(tag["id"], tag)
+        values["tags"] = [tag["id"] for tag in values["tags"]]
+
+
+def overlay_ingredients(values, tables, inventory):
+    """
+    add `in_storage` to the expanded ingredients of `values`, and reference
+    them by id if `tables` is given
+    """
+    if tables is None:
+        values["ingredients"] = [
+            {
+                **ingredient,
+                "ingredient": with_storage(ingredient["ingredient"], inventory),
+            }
+            for ingredient in values["ingredients"]
+        ]
+        return
+    for ingredient in values["ingredients"]:
+        ingredient_id = ingredient["ingredient"]["id"]
+        if ingredient_id not in tables["ingredients"]:
+            tables["ingredients"][ingredient_id] = with_storage(
+                ingredient["ingredient"], inventory
+            )
+    values["ingredients"] = [
+        {**ingredient, "ingredient": ingredient["ingredient"]["id"]}
+        for ingredient in values["ingredients"]
+    ]
+
+
+def recipe_payloads(ids, user_id=None, tables=None, fields=None, expand=None):
+    """
+    Returns {recipe id: dict} of the recipes with the given ids, the same as
+    `RecipeSerializer(Recipe.objects.annotate_all(user_id), many=True).data`.
+    Unknown ids are left out.
+    If `tables` (see `compact_tables`) is given, the recipes reference their
+    ingredients and tags by id instead, and each of them is added once to
+    `tables["ingredients"]` and `tables["tags"]` by id.
+    `fields` (default: all of `RECIPE_KEYS`) restricts the keys of the
+    recipes, and only the relations in `expand` (default: all of
+    `EXPANDABLE`) are rendered in full, the others as lists of ids. Only what
+    is needed for them is queried.
+    """
+    fields = set(RECIPE_KEYS if fields is None else fields)
+    expand = set(EXPANDABLE if expand is None else expand) & fields
+    rows = recipe_rows(ids, user_id, fields, expand)
+    row_ids = [row.id for row in rows]
+    static = static_payloads(row_ids) if expand else None
+    tag_ids = recipe_tag_ids(row_ids) if "tags" in fields - expand else {}
+    inventory = set()
+    if user_id and "ingredients" in expand:
+        inventory = set(
+            UserIngredient.objects.filter(user=user_id, consumed=False).values_list(
+                "ingredient_id", flat=True
+            )
+        )
+
+    keys = [key for key in RECIPE_KEYS if key in fields]
+    payloads = {}
+    for row in rows:
+        if static is not None:
+            values = static[row.id]
+        else:
+            values = row._asdict()
+            if "nutrition" in fields:
+                values["nutrition"] = nutrition(row)
+        if "tags" in expand:
+            overlay_tags(values, tables)
+        else:
+            values["tags"] = tag_ids.get(row.id, [])
+        if "ingredients" in expand:
+            overlay_ingredients(values, tables, inventory)
+        else:
+            values["ingredients"] = getattr(row, "ingredient_ids", None)
+        for key in STATS_KEYS:
+            values[key] = getattr(row, key, None)
+        for key in USER_KEYS:
+            values[key] = getattr(row, key, False)
+        payloads[row.id] = {key: values[key] for key in keys}
+    return payloads
+
+
+def recipe_list(ids, user_id=None, tables=None, fields=None, expand=None):
+    """
+    Same as `RecipeSerializer(Recipe.objects.in_order(ids).annotate_all(user_id),
+    many=True).data` (see `recipe_payloads` for the other arguments)
+    """
+    ids = list(ids)
+    payloads = recipe_payloads(ids, user_id, tables, fields, expand)
+    return [payloads[id] for id in ids if id in payloads]
+
+
+def history_list(user_id, tables=None, fields=None, expand=None):
+    """
+    Same as `UserRecipeHistorySerializer` of the user's history, newest first
+    (see `recipe_payloads` for the other arguments)
+    """
+    rows = list(
+        UserRecipeHistory.objects.filter(user=user_id)
+        .order_by("-access_date", "-id")
+        .values_list("id", "recipe_id", "access_date", "cooked", "user_id")
+    )
+    recipes = recipe_payloads({row[1] for row in rows}, user_id, tables, fields, expand)
+    return [
+        {
+            "id": id,
+            "recipe": recipes[recipe_id],
+            "access_date": format_datetime(access_date),
+            "cooked": cooked,
+            "user": user,
+        }
+        for id, recipe_id, access_date, cooked, user in rows
+    ]
+
+
+def favorite_list(user_id, tables=None, fields=None, expand=None):
+    """
+    Same as `UserRecipeFavoriteSerializer` of the user's favorites, newest first
+    (see `recipe_payloads` for the other arguments)
+    """
+    rows = list(
+        UserRecipeFavorite.objects.filter(user=user_id)
+        .order_by("-added_date", "-id")
+        .values_list("id", "recipe_id", "added_date", "user_id")
+    )
+    recipes = recipe_payloads({row[1] for row in rows}, user_id, tables, fields, expand)
+    return [
+        {
+            "id": id,
+            "recipe": recipes[recipe_id],
+            "added_date": format_datetime(added_date),
+            "user": user,
+        }
+        for id, recipe_id, added_date, user in rows
+    ]
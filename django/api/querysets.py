@@ -1,5 +1,24 @@
+from django.contrib.postgres.aggregates import ArrayAgg, StringAgg
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.search import SearchVector, TrigramWordSimilarity
 from django.db import models
-from django.db.models import Case, Count, Exists, F, OuterRef, Prefetch, Q, When
+from django.db.models import (
+    Case,
+    Count,
+    Exists,
+    F,
+    OuterRef,
+    Prefetch,
+    Q,
+    Subquery,
+    TextField,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce, Length, Upper
+
+# text search configuration of `Recipe.search_vector` and the queries against it
+TEXT_SEARCH_CONFIG = "english"
 
 
 class IngredientQuerySet(models.QuerySet):
@@ -21,19 +40,39 @@ class IngredientQuerySet(models.QuerySet):
             ),
         )
 
+    def similar(self, text):
+        """
+        ingredients with a word similar to `text` in their names (e.g. typos),
+        most similar first, using the trigram index on `UPPER(name::text)`
+        """
+        upper_name = Upper(Cast("name", TextField()))
+        return (
+            self.alias(upper_name=upper_name)
+            .filter(upper_name__trigram_word_similar=text)
+            .annotate(similarity=TrigramWordSimilarity(text, upper_name))
+            .order_by("-similarity", Length("name"), "name")
+        )
+
 
 class RecipeQuerySet(models.QuerySet):
     def annotate_all(self, user=None):
-        from .models import Ingredient  # local import to avoid circular imports
+        # local import to avoid circular imports
+        from .models import Ingredient, RecipeIngredient, Tag
 
         ret = (
-            self.select_related("nutrition")
+            self.defer("ingredient_ids", "search_vector")
+            .select_related("nutrition")
             .prefetch_related(
+                # ordered like `payloads.recipe_payloads`
+                Prefetch(
+                    "recipeingredient_set",
+                    queryset=RecipeIngredient.objects.order_by("id"),
+                ),
                 Prefetch(
                     "recipeingredient_set__ingredient",
                     queryset=Ingredient.objects.annotate_all(user),
                 ),
-                "tags",
+                Prefetch("tags", queryset=Tag.objects.order_by("id")),
             )
             .annotate_stats()
         )
@@ -41,17 +80,90 @@ class RecipeQuerySet(models.QuerySet):
             ret = ret.annotate_user(user)
         return ret
 
+    def in_order(self, ids):
+        """filter by the given ids, keeping their order"""
+        ids = list(ids)
+        return self.filter(id__in=ids).order_by(
+            Case(*[When(id=id, then=pos) for pos, id in enumerate(ids)])
+        )
+
+    def annotate_ingredient_ids(self, name="actual_ingredient_ids"):
+        """annotate sorted ids of the ingredients, aggregated from RecipeIngredient"""
+        from .models import RecipeIngredient  # local import to avoid circular imports
+
+        return self.annotate(**{name: self._ingredient_ids(RecipeIngredient)})
+
+    def update_ingredient_ids(self):
+        """recompute the denormalized `ingredient_ids` from RecipeIngredient"""
+        from .models import RecipeIngredient  # local import to avoid circular imports
+
+        return self.update(ingredient_ids=self._ingredient_ids(RecipeIngredient))
+
+    @staticmethod
+    def _ingredient_ids(model):
+        return Coalesce(
+            Subquery(
+                model.objects.filter(recipe=OuterRef("pk"))
+                .values("recipe")
+                .annotate(ids=ArrayAgg("ingredient_id", ordering="ingredient_id"))
+                .values("ids")
+            ),
+            Value([]),
+            output_field=ArrayField(models.BigIntegerField()),
+        )
+
+    def update_search_vector(self):
+        """recompute `search_vector` from the title (weight A) and tag names (B)"""
+        from .models import RecipeTag  # local import to avoid circular imports
+
+        tag_names = Subquery(
+            RecipeTag.objects.filter(recipe=OuterRef("pk"))
+            .values("recipe")
+            .annotate(names=StringAgg("tag__name", " "))
+            .values("names")
+        )
+        return self.update(
+            search_vector=SearchVector("title", weight="A", config=TEXT_SEARCH_CONFIG)
+            + SearchVector(tag_names, weight="B", config=TEXT_SEARCH_CONFIG)
+        )
+
     def annotate_stats(self):
-        """annotate statistics"""
+        """annotate statistics, read from the denormalized counters"""
         return self.annotate(
-            all_cooked=Count(
-                "userrecipehistory",
-                filter=Q(userrecipehistory__cooked=True),
-                distinct=True,
-            ),
-            all_favorite=Count("userrecipefavorite", distinct=True),
+            all_cooked=F("num_cooked"), all_favorite=F("num_favorites")
+        )
+
+    def annotate_counts(self, prefix="actual_"):
+        """annotate `num_cooked` and `num_favorites` counted from the user tables"""
+        return self.annotate(
+            **{prefix + name: count for name, count in self._counts().items()}
         )
 
+    def update_counts(self):
+        """recompute the denormalized `num_cooked` and `num_favorites`"""
+        return self.update(**self._counts())
+
+    @staticmethod
+    def _counts():
+        # local import to avoid circular imports
+        from .models import UserRecipeFavorite, UserRecipeHistory
+
+        def count(queryset):
+            return Coalesce(
+                Subquery(
+                    queryset.filter(recipe=OuterRef("pk"))
+                    .values("recipe")
+                    .annotate(count=Count("id"))
+                    .values("count")
+                ),
+                0,
+            )
+
+        return {
+            "num_cooked": count(UserRecipeHistory.objects.filter(cooked=True)),
+            "num_favorites": count(UserRecipeFavorite.objects.all()),
+        }
+
     def annotate_user(self, user):
         """annotate user-related fields"""
         return self.annotate(
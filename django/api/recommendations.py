@@ -0,0 +1,153 @@
+"""
+Item-item collaborative filtering of recipes from users' history and favorites.
+
+`build_neighbors` (run by `manage.py build_recommendations`) builds a sparse
+user x recipe matrix of interaction weights, streamed from the DB as arrays
+rather than model instances, and stores the top-N most similar recipes (cosine
+similarity of their columns) of every recipe in `RecipeNeighbors`.
+`recommend` then only merges the stored neighbours of the user's recent
+recipes.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+
+from .models import RecipeNeighbors, UserRecipeFavorite, UserRecipeHistory
+
+CHUNK_SIZE = 100000
+
+# weight of each kind of interaction of a user with a recipe, summed over
+# repeated interactions and then damped by log1p
+VIEWED_WEIGHT = 1.0
+COOKED_WEIGHT = 2.0
+FAVORITE_WEIGHT = 3.0
+
+NUM_NEIGHBORS = 20
+
+# number of the user's latest viewed/cooked and favorite recipes recommending
+RECENT_RECIPES = 50
+
+
+def _chunks(rows, width):
+    """2-d float arrays of `width` columns from an iterator of tuples"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield np.array(chunk, dtype=float).reshape(-1, width)
+            chunk = []
+    if chunk:
+        yield np.array(chunk, dtype=float).reshape(-1, width)
+
+
+def interactions():
+    """(user ids, recipe ids, weights) arrays of all interactions"""
+    parts = []
+    history = UserRecipeHistory.objects.values_list("user_id", "recipe_id", "cooked")
+    for chunk in _chunks(history.iterator(CHUNK_SIZE), 3):
+        chunk[:, 2] = np.where(chunk[:, 2] > 0, COOKED_WEIGHT, VIEWED_WEIGHT)
+        parts.append(chunk)
+    favorites = UserRecipeFavorite.objects.values_list("user_id", "recipe_id")
+    for chunk in _chunks(favorites.iterator(CHUNK_SIZE), 2):
+        parts.append(np.column_stack([chunk, np.full(len(chunk), FAVORITE_WEIGHT)]))
+    data = np.concatenate(parts) if parts else np.zeros((0, 3))
+    return data[:, 0].astype(np.int64), data[:, 1].astype(np.int64), data[:, 2]
+
+
+def neighbors(users, recipes, weights, n=NUM_NEIGHBORS, block_size=1000):
+    """
+    Yields (recipe id, neighbor ids, similarities) of the `n` recipes with the
+    most similar columns of the user x recipe matrix to each recipe.
+    """
+    if len(weights) == 0:
+        return
+    _, rows = np.unique(users, return_inverse=True)
+    recipe_ids, cols = np.unique(recipes, return_inverse=True)
+    matrix = sparse.csr_matrix((weights, (rows, cols)))  # duplicates are summed
+    matrix.data = np.log1p(matrix.data)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0)).ravel())
+    matrix = (matrix @ sparse.diags(1 / norms)).tocsc()
+    transposed = matrix.T.tocsr()
+
+    for start in range(0, len(recipe_ids), block_size):  # bounds the memory
+        end = start + block_size
+        similarities = (transposed[start:end] @ matrix).tocsr()
+        for i in range(similarities.shape[0]):
+            lo, hi = similarities.indptr[i], similarities.indptr[i + 1]
+            others = similarities.indices[lo:hi] != start + i
+            columns = similarities.indices[lo:hi][others]
+            values = similarities.data[lo:hi][others]
+            if len(values) > n:
+                top = np.argpartition(-values, n - 1)[:n]
+                columns, values = columns[top], values[top]
+            order = np.lexsort((recipe_ids[columns], -values))
+            yield (
+                recipe_ids[start + i].item(),
+                recipe_ids[columns[order]].tolist(),
+                values[order].tolist(),
+            )
+
+
+def build_neighbors(n=NUM_NEIGHBORS, batch_size=1000):
+    """recompute all `RecipeNeighbors`, returning the number of recipes"""
+    count = 0
+    with transaction.atomic():
+        RecipeNeighbors.objects.all().delete()
+        batch = []
+        for recipe_id, neighbor_ids, scores in neighbors(*interactions(), n=n):
+            if not neighbor_ids:
+                continue
+            batch.append(
+                RecipeNeighbors(
+                    recipe_id=recipe_id, neighbor_ids=neighbor_ids, scores=scores
+                )
+            )
+            if len(batch) == batch_size:
+                RecipeNeighbors.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        RecipeNeighbors.objects.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def recent_recipes(user_id):
+    """{recipe id: weight} of the user's latest interactions"""
+    recent = {}
+    history = (
+        UserRecipeHistory.objects.filter(user=user_id)
+        .order_by("-access_date")
+        .values_list("recipe_id", "cooked")[:RECENT_RECIPES]
+    )
+    for recipe_id, cooked in history:
+        weight = COOKED_WEIGHT if cooked else VIEWED_WEIGHT
+        recent[recipe_id] = max(recent.get(recipe_id, 0), weight)
+    favorites = (
+        UserRecipeFavorite.objects.filter(user=user_id)
+        .order_by("-added_date")
+        .values_list("recipe_id", flat=True)[:RECENT_RECIPES]
+    )
+    for recipe_id in favorites:
+        recent[recipe_id] = FAVORITE_WEIGHT
+    return recent
+
+
+def recommend(user_id, limit=10):
+    """
+    Returns [(recipe id, score)] of the recipes most similar to the user's
+    recent recipes (other than those), the best first.
+    """
+    recent = recent_recipes(user_id)
+    scores = {}
+    rows = RecipeNeighbors.objects.filter(recipe_id__in=recent).values_list(
+        "recipe_id", "neighbor_ids", "scores"
+    )
+    for recipe_id, neighbor_ids, similarities in rows:
+        for neighbor_id, similarity in zip(neighbor_ids, similarities):
+            if neighbor_id not in recent:
+                scores[neighbor_id] = (
+                    scores.get(neighbor_id, 0) + recent[recipe_id] * similarity
+                )
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
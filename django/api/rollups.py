@@ -0,0 +1,166 @@
+"""
+Precomputed statistics of recipes and ingredients.
+
+Aggregating every history, favorite and user-ingredient row on each request
+does not scale, so the statistics endpoints read small summaries instead:
+
+- `refresh_rankings` (run periodically by `manage.py refresh_statistics`)
+  stores the `TOP_SIZE` most cooked, liked and viewed recipes in
+  `RecipeRanking`, read back by `rankings`.
+- `IngredientUsage` holds running sums and counts per ingredient, updated by
+  `add_usage` from signals as recipe and user ingredients are saved and
+  deleted (and recomputed by `manage.py rebuild_ingredient_usage`), so that
+  `ingredient_rankings` is two index scans.
+"""
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import (
+    IngredientUsage,
+    RankingKind,
+    RecipeIngredient,
+    RecipeRanking,
+    UserIngredient,
+    UserRecipeFavorite,
+    UserRecipeHistory,
+)
+
+TOP_SIZE = 10
+
+# the expressions of the indexes of `IngredientUsage`
+USES = F("num_recipes") + F("num_user_ingredients")
+AVERAGE_HAPPINESS = F("happiness_sum") / F("happiness_count")
+
+
+def top_recipes(queryset, n=TOP_SIZE):
+    """[(recipe id, number of rows)] of the recipes with the most rows, ties by id"""
+    return list(
+        queryset.values("recipe")
+        .annotate(count=Count("id"))
+        .order_by("-count", "recipe")
+        .values_list("recipe", "count")[:n]
+    )
+
+
+def refresh_rankings(n=TOP_SIZE):
+    """recompute all `RecipeRanking`, returning the time of the computation"""
+    computed_at = timezone.now()
+    tops = {
+        RankingKind.COOKED: top_recipes(
+            UserRecipeHistory.objects.filter(cooked=True), n
+        ),
+        RankingKind.LIKED: top_recipes(UserRecipeFavorite.objects.all(), n),
+        RankingKind.VIEWED: top_recipes(UserRecipeHistory.objects.all(), n),
+    }
+    with transaction.atomic():  # readers see either the old or the new lists
+        RecipeRanking.objects.all().delete()
+        RecipeRanking.objects.bulk_create(
+            RecipeRanking(
+                kind=kind,
+                rank=rank,
+                recipe_id=recipe_id,
+                count=count,
+                computed_at=computed_at,
+            )
+            for kind, top in tops.items()
+            for rank, (recipe_id, count) in enumerate(top)
+        )
+    return computed_at
+
+
+def rankings():
+    """
+    Returns ({kind: [(recipe id, count)] best first}, time of the computation
+    or None if never computed).
+    """
+    tops = {kind: [] for kind in RankingKind.values}
+    computed_at = None
+    rows = RecipeRanking.objects.order_by("kind", "rank").values_list(
+        "kind", "recipe_id", "count", "computed_at"
+    )
+    for kind, recipe_id, count, computed_at in rows:
+        tops[kind].append((recipe_id, count))
+    return tops, computed_at
+
+
+def add_usage(ingredient_id, create=True, **deltas):
+    """
+    Atomically adds `deltas` to the `IngredientUsage` of an ingredient,
+    creating it first if missing and `create`.
+    """
+    usage = IngredientUsage.objects.filter(ingredient=ingredient_id)
+    changes = {name: F(name) + delta for name, delta in deltas.items()}
+    if not usage.update(**changes) and create:
+        IngredientUsage.objects.bulk_create(
+            [IngredientUsage(ingredient_id=ingredient_id)], ignore_conflicts=True
+        )
+        usage.update(**changes)
+
+
+def user_ingredient_usage(happiness):
+    """what a UserIngredient adds to the `IngredientUsage` of its ingredient"""
+    if happiness is None:
+        return {"num_user_ingredients": 1}
+    return {
+        "num_user_ingredients": 1,
+        "happiness_sum": float(happiness),
+        "happiness_count": 1,
+    }
+
+
+def rebuild_usage():
+    """recompute all `IngredientUsage`, returning the number of ingredients"""
+    usages = {}
+
+    def usage(ingredient_id):
+        if ingredient_id not in usages:
+            usages[ingredient_id] = IngredientUsage(ingredient_id=ingredient_id)
+        return usages[ingredient_id]
+
+    recipes = (
+        RecipeIngredient.objects.values("ingredient")
+        .annotate(count=Count("id"))
+        .order_by()
+        .values_list("ingredient", "count")
+    )
+    users = (
+        UserIngredient.objects.values("ingredient")
+        .annotate(
+            count=Count("id"),
+            happiness_sum=Sum("happiness", default=0.0),
+            happiness_count=Count("happiness"),
+        )
+        .order_by()
+        .values_list("ingredient", "count", "happiness_sum", "happiness_count")
+    )
+    with transaction.atomic():
+        IngredientUsage.objects.all().delete()
+        for ingredient_id, count in recipes:
+            usage(ingredient_id).num_recipes = count
+        for ingredient_id, count, happiness_sum, happiness_count in users:
+            u = usage(ingredient_id)
+            u.num_user_ingredients = count
+            u.happiness_sum, u.happiness_count = happiness_sum, happiness_count
+        IngredientUsage.objects.bulk_create(usages.values(), batch_size=1000)
+    return len(usages)
+
+
+def ingredient_rankings(n=TOP_SIZE):
+    """
+    Returns ([(ingredient, uses)] of the most used ingredients by recipes and
+    users, [(ingredient, average happiness, number of ratings)] of the ones
+    the users are the happiest with), best first, ties by id.
+    """
+    usages = IngredientUsage.objects.select_related("ingredient")
+    most_used = usages.annotate(uses=USES).order_by(USES.desc(), "ingredient")[:n]
+    most_happy = (
+        usages.filter(happiness_count__gt=0)
+        .annotate(happiness=AVERAGE_HAPPINESS)
+        .order_by(AVERAGE_HAPPINESS.desc(), "ingredient")[:n]
+    )
+    return (
+        [(u.ingredient, u.uses) for u in most_used],
+        [(u.ingredient, u.happiness, u.happiness_count) for u in most_happy],
+    )
@@ -0,0 +1,137 @@
+"""
+In-process LRU cache of recipe search results.
+
+Only the ranked recipe ids (and the cursor key of the page) are cached, keyed
+by the normalized search criteria; per-user fields are added when the recipes
+are hydrated. Each entry is stamped with the version of the data it was
+computed from and is ignored once the version changes, i.e. when recipes or
+their ingredients change (see `search_version`).
+"""
+
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models import F
+
+from .models import SearchVersion
+from .search_index import recipe_index
+
+
+def search_version():
+    """
+    Stamp of the searchable data. It combines the `SearchVersion` counter,
+    incremented by `bump_search_version` after every committed change made
+    through the ORM (including the scrapy pipeline) and read from the database
+    on each search so that all workers see it, with the version of the
+    in-process index that also notices rows inserted by other processes
+    (synced at most every `search_index.SYNC_SECONDS`, so that a cache hit
+    costs the one read of the counter).
+    """
+    version = SearchVersion.objects.filter(id=1).values_list("version", flat=True)
+    token = version.first() or 0
+    if settings.RECIPE_SEARCH_INDEX:
+        return token, recipe_index.ensure_fresh()
+    return token, None
+
+
+def bump_search_version():
+    if not SearchVersion.objects.filter(id=1).update(version=F("version") + 1):
+        SearchVersion.objects.get_or_create(id=1, defaults={"version": 1})
+
+
+def freeze(value):
+    """hashable form of the value, where the order of sets and dicts is ignored"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class SearchCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (version, value), oldest first
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != version:  # stale
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.RECIPE_SEARCH_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def key(search, ingredients, mode, strict, kwargs):
+        ingredients = tuple(sorted(set(ingredients)))
+        return (
+            search.__name__,
+            ingredients,
+            mode if ingredients else None,  # the mode only matters with ingredients
+            strict,
+            # unset arguments are left to their defaults
+            freeze({k: v for k, v in kwargs.items() if v is not None}),
+        )
+
+    def search(self, search, ingredients, mode, strict, version=None, **kwargs):
+        """
+        Returns `search(ingredients, mode, strict, **kwargs)` through the cache,
+        unless the results are ranked by per-user `weights`. Pass sets for
+        arguments whose order does not matter, and the `search_version()` if
+        already read for the same request.
+        """
+        if kwargs.get("weights") is not None:
+            return search(ingredients, mode, strict, **kwargs)
+
+        key = self.key(search, ingredients, mode, strict, kwargs)
+        if version is None:
+            version = search_version()
+        value = self.get(key, version)
+        if value is None:
+            value = search(list(key[1]), mode, strict, **kwargs)
+            self.set(key, version, value)
+        return value
+
+    def search_many(self, search_many, search, queries, **kwargs):
+        """
+        Returns `search(ingredients, mode, strict, **kwargs)` for each
+        (ingredients, mode, strict) of `queries` through the cache (shared
+        with `self.search`), computing the missing ones together by
+        `search_many(queries, **kwargs)`.
+        """
+        if kwargs.get("weights") is not None:
+            return search_many(queries, **kwargs)
+
+        keys = [self.key(search, *query, kwargs) for query in queries]
+        version = search_version()
+        values = [self.get(key, version) for key in keys]
+        missing = {}  # key -> query, deduplicated
+        for key, query, value in zip(keys, queries, values):
+            if value is None:
+                missing.setdefault(key, (list(key[1]), query[1], query[2]))
+        if missing:
+            found = dict(zip(missing, search_many(list(missing.values()), **kwargs)))
+            for key, value in found.items():
+                self.set(key, version, value)
+            values = [found[key] if v is None else v for key, v in zip(keys, values)]
+        return values
+
+
+search_cache = SearchCache()
@@ -0,0 +1,758 @@
+"""
+In-process inverted index of recipes by ingredient.
+
+`SearchRecipe` answers its ingredient filters ("exact", "any", "strict"), its
+attribute filters (tags, cook time, servings, nutrition), its facet counts and
+its ranking from this index, so the database only has to hydrate the final
+page of recipes.
+
+Recipes are stored as dense rows of NumPy arrays and every ingredient keeps
+the array of rows using it (i.e. the columns of a sparse recipe x ingredient
+matrix). Scoring a query is one vectorized pass over all recipes and the top-k
+is taken with `argpartition`-style selection instead of a full sort.
+
+Each worker keeps its own copy. It is built on first use (see `wsgi.py` for the
+warm-up), picks up rows inserted by other processes (e.g. the scrapy crawler)
+through a cheap incremental sync every `SYNC_SECONDS`, receives in-process
+updates and deletions through signals (see `signals.py`), and is rebuilt from
+scratch every `RECIPE_INDEX_REBUILD_SECONDS` to catch anything the above
+missed. Both read the database without holding the lock: the rebuild fills a
+new index and swaps it in, so searches keep using the current one meanwhile.
+"""
+
+import base64
+import json
+import operator
+import threading
+import time
+from functools import reduce, wraps
+
+import numpy as np
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import (
+    LanguageOption,
+    Recipe,
+    RecipeIngredient,
+    RecipeNutrition,
+    RecipeTag,
+    Tag,
+)
+
+CHUNK_SIZE = 10000
+SYNC_SECONDS = 10
+
+LANGUAGES = {code: i for i, code in enumerate(LanguageOption.values)}
+
+# bm: number of the given ingredients used by the recipe
+# coverage: bm / number of ingredients of the recipe
+# missing: number of ingredients of the recipe not given
+# expiry: sum of the weights of the given ingredients the recipe uses,
+#         e.g. how soon the user's copies expire (see `inventory.expiry_weights`)
+# relevance: full-text rank of the title and tags against the text query (only
+#            on the DB, see `SearchRecipe.search_db`)
+#
+# each ranking maps to its sort keys as (name, descending), after which
+# recipes are ordered by id
+RANKING_KEYS = {
+    "bm": [("bm", True)],
+    "coverage": [("coverage", True), ("bm", True)],
+    "missing": [("missing", False), ("bm", True)],
+    "expiry": [("expiry", True), ("bm", True)],
+    "relevance": [("relevance", True), ("bm", True)],
+}
+RANKINGS = tuple(RANKING_KEYS)
+
+MAX_LIMIT = 100
+
+# numeric attributes of recipes that can be filtered by range, by field of
+# `Recipe` (null values never match a range)
+RECIPE_RANGES = {
+    "cook_minute": "cook_minute",
+    "num_servings": "num_servings",
+}
+NUTRITION_RANGES = {
+    "calories": "calories_kcal_per_serving",
+    "fat": "fat_gram_per_serving",
+    "carbs": "carbs_gram_per_serving",
+    "protein": "protein_gram_per_serving",
+}
+RANGES = {
+    **RECIPE_RANGES,
+    **{name: f"nutrition__{field}" for name, field in NUTRITION_RANGES.items()},
+}
+
+# max number of exclusion masks kept by the index
+MAX_EXCLUSION_MASKS = 256
+
+# max number of filters whose rows are kept for `RecipeIndex.sample`
+MAX_SAMPLED_FILTERS = 64
+# rounds of random draws of `RecipeIndex.sample` before choosing among the
+# rows not excluded
+MAX_SAMPLING_ROUNDS = 4
+
+
+def sort_keys(order):
+    return RANKING_KEYS[order] + [("id", False)]
+
+
+def encode_cursor(order, key, as_of=None):
+    """
+    opaque cursor pointing right after the recipe with the given sort key, and
+    for the expiry order, the timestamp its weights were computed at
+    """
+    data = [order, *key] if as_of is None else [order, as_of, *key]
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+
+def decode_cursor(cursor, order):
+    """
+    (sort key of the recipe the cursor points after, timestamp of the weights
+    of the expiry order or None)
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("invalid cursor")
+    # the expiry weights decay with time, so later pages use those of the first
+    timed = order == "expiry"
+    if (
+        not isinstance(data, list)
+        or data[:1] != [order]
+        or len(data) != len(sort_keys(order)) + 1 + timed
+        or (timed and not isinstance(data[1], (int, float)))
+    ):
+        raise ValueError("invalid cursor")
+    if timed:
+        return data[2:], data[1]
+    return data[1:], None
+
+
+def keyset_filter(order, key):
+    """Q object selecting the recipes ordered after the given sort key"""
+    terms, equal = [], {}
+    for (name, descending), value in zip(sort_keys(order), key):
+        terms.append(Q(**equal, **{f"{name}__{'lt' if descending else 'gt'}": value}))
+        equal[name] = value
+    return reduce(operator.or_, terms)
+
+
+def after(keys, key):
+    """mask of the entries ordered after `key` lexicographically by `keys`"""
+    greater = np.zeros(len(keys[0]), dtype=bool)
+    equal = np.ones(len(keys[0]), dtype=bool)
+    for column, value in zip(keys, key):
+        greater |= equal & (column > value)
+        equal &= column == value
+    return greater
+
+
+def top_k(keys, k):
+    """
+    Returns the indices of the `k` smallest entries when ordered
+    lexicographically by `keys` (most significant first) without sorting
+    all of them.
+    """
+    primary = keys[0]
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    idx = np.arange(len(primary))
+    if len(primary) > k:
+        kth = np.partition(primary, k - 1)[k - 1]
+        idx = np.flatnonzero(primary <= kth)  # keep ties of the k-th entry
+    order = np.lexsort([key[idx] for key in reversed(keys)])
+    return idx[order[:k]]
+
+
+def merge_pending(postings, pending, key):
+    """posting of `key` with its pending rows merged into it, sorted"""
+    posting = postings.get(key, np.zeros(0, dtype=np.int32))
+    if key in pending:
+        rows = np.fromiter(pending.pop(key), dtype=np.int32)
+        posting = postings[key] = np.union1d(posting, rows)
+    return posting
+
+
+def contains(postings, pending, key, row):
+    """whether the posting of `key` has the row, without merging the pending rows"""
+    if row in pending.get(key, ()):
+        return True
+    posting = postings.get(key)
+    if posting is None:
+        return False
+    i = np.searchsorted(posting, row)
+    return i < len(posting) and posting[i] == row
+
+
+def split_postings(keys, rows):
+    """{key: sorted array of rows} from parallel lists of keys and rows"""
+    keys = np.array(keys, dtype=np.int64)
+    rows = np.array(rows, dtype=np.int32)
+    order = np.lexsort([rows, keys])
+    unique, starts = np.unique(keys[order], return_index=True)
+    return dict(zip(unique.tolist(), np.split(rows[order], starts[1:])))
+
+
+def mutation(method):
+    """
+    runs the method with the lock held, and records the call if the index is
+    being rebuilt so that it is replayed on the new one
+    """
+
+    @wraps(method)
+    def wrapper(self, *args):
+        with self._lock:
+            if self.replay is not None:
+                self.replay.append((method, args))
+            return method(self, *args)
+
+    return wrapper
+
+
+class RecipeIndex:
+    # not swapped in from the rebuilt index
+    OWN_STATE = {"_lock", "_build_lock", "replay", "syncing", "version"}
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()  # one rebuild at a time
+        self.reset()
+
+    def reset(self):
+        """drop everything; the index is rebuilt on the next access"""
+        with self._lock:
+            self.rows = {}  # recipe id -> row
+            self.n = 0  # number of rows in use
+            self.ids = np.zeros(0, dtype=np.int64)  # row -> recipe id
+            self.num_ingredients = np.zeros(0, dtype=np.int32)  # -1 if null
+            self.languages = np.zeros(0, dtype=np.int8)  # index in LANGUAGES
+            self.sizes = np.zeros(0, dtype=np.int32)  # number of ingredients
+            self.alive = np.zeros(0, dtype=bool)
+            self.attributes = {name: np.zeros(0) for name in RANGES}  # nan if null
+            self.postings = {}  # ingredient id -> sorted array of rows
+            self.pending = {}  # ingredient id -> set of rows not merged into postings
+            self.tags = {}  # tag id -> (category, name)
+            self.tag_postings = {}  # tag id -> sorted array of rows
+            self.tag_pending = {}  # tag id -> set of rows not merged into tag_postings
+            self.last_recipe_id = 0
+            self.last_recipe_ingredient_id = 0
+            self.last_nutrition_id = 0  # recipe id
+            self.last_tag_id = 0
+            self.last_recipe_tag_id = 0
+            self.built_at = None
+            self.synced_at = None
+            self.replay = None  # calls made during a rebuild, None otherwise
+            self.syncing = False
+            self.exclusion_masks = {}  # frozenset of ingredient ids -> (version, mask)
+            self.sampled_filters = {}  # (language, tags) -> (version, rows)
+            self.version = getattr(self, "version", 0) + 1  # bumped on changes
+
+    # maintenance
+
+    def build(self):
+        """
+        (re)build the whole index from the DB into a new one, without holding
+        the lock, then swap it in with the changes made meanwhile
+        """
+        with self._lock:
+            self.replay = []
+        try:
+            index = RecipeIndex()
+            index.load()
+            with self._lock:
+                for method, args in self.replay:
+                    method(index, *args)
+                for name, value in vars(index).items():
+                    if name not in self.OWN_STATE:
+                        setattr(self, name, value)
+                self.version += 1
+        finally:
+            with self._lock:
+                self.replay = None
+
+    def load(self):
+        """load everything from the DB, into an empty index"""
+        self._load_recipes(Recipe.objects.all())
+        self._load_nutrition(RecipeNutrition.objects.all())
+        self._load_tags(Tag.objects.all())
+
+        rows, ingredient_ids = [], []
+        ris = RecipeIngredient.objects.order_by("id").values_list(
+            "id", "recipe_id", "ingredient_id"
+        )
+        for ri_id, recipe_id, ingredient_id in ris.iterator(CHUNK_SIZE):
+            rows.append(self._row(recipe_id))
+            ingredient_ids.append(ingredient_id)
+            self.last_recipe_ingredient_id = ri_id
+        np.add.at(self.sizes, np.array(rows, dtype=np.int32), 1)
+        self.postings = split_postings(ingredient_ids, rows)
+
+        rows, tag_ids = [], []
+        rts = RecipeTag.objects.order_by("id").values_list("id", "recipe_id", "tag_id")
+        for rt_id, recipe_id, tag_id in rts.iterator(CHUNK_SIZE):
+            rows.append(self._row(recipe_id))
+            tag_ids.append(tag_id)
+            self.last_recipe_tag_id = rt_id
+        self.tag_postings = split_postings(tag_ids, rows)
+
+        self.built_at = self.synced_at = time.monotonic()
+
+    def sync(self):
+        """
+        load recipes and recipe-ingredients inserted since the last sync. The
+        DB is read without holding the lock, which is only taken by each change.
+        """
+        with self._lock:
+            if self.syncing:
+                return  # another thread is at it
+            self.syncing = True
+            self.synced_at = time.monotonic()
+        try:
+            self._load_recipes(Recipe.objects.filter(id__gt=self.last_recipe_id))
+            # nutrition is saved right after its recipe, so mostly in order
+            self._load_nutrition(
+                RecipeNutrition.objects.filter(recipe_id__gt=self.last_nutrition_id)
+            )
+            self._load_tags(Tag.objects.filter(id__gt=self.last_tag_id))
+
+            ris = (
+                RecipeIngredient.objects.filter(id__gt=self.last_recipe_ingredient_id)
+                .order_by("id")
+                .values_list("id", "recipe_id", "ingredient_id")
+            )
+            for ri_id, recipe_id, ingredient_id in ris.iterator(CHUNK_SIZE):
+                self.add(recipe_id, ingredient_id)
+                self.last_recipe_ingredient_id = ri_id
+
+            rts = (
+                RecipeTag.objects.filter(id__gt=self.last_recipe_tag_id)
+                .order_by("id")
+                .values_list("id", "recipe_id", "tag_id")
+            )
+            for rt_id, recipe_id, tag_id in rts.iterator(CHUNK_SIZE):
+                self.add_tag(recipe_id, tag_id)
+                self.last_recipe_tag_id = rt_id
+        finally:
+            with self._lock:
+                self.syncing = False
+
+    def _load_recipes(self, recipes):
+        recipes = recipes.order_by("id").values_list(
+            "id", "num_ingredients", "language", *RECIPE_RANGES.values()
+        )
+        for recipe_id, num_ingredients, language, *values in recipes.iterator(
+            CHUNK_SIZE
+        ):
+            self.set_recipe(recipe_id, num_ingredients, language)
+            self.set_attributes(recipe_id, dict(zip(RECIPE_RANGES, values)))
+            self.last_recipe_id = recipe_id
+
+    def _load_nutrition(self, nutrition):
+        nutrition = nutrition.order_by("recipe_id").values_list(
+            "recipe_id", *NUTRITION_RANGES.values()
+        )
+        for recipe_id, *values in nutrition.iterator(CHUNK_SIZE):
+            self.set_attributes(recipe_id, dict(zip(NUTRITION_RANGES, values)))
+            self.last_nutrition_id = max(self.last_nutrition_id, recipe_id)
+
+    def _load_tags(self, tags):
+        for tag_id, category, name in (
+            tags.order_by("id").values_list("id", "category", "name").iterator()
+        ):
+            self.set_tag(tag_id, category, name)
+            self.last_tag_id = tag_id
+
+    def ensure_fresh(self):
+        """
+        rebuild or sync the index if due, returning its version. Call without
+        the lock held: only the first build makes the other threads wait, the
+        later ones keep using the current index meanwhile.
+        """
+        with self._lock:
+            built_at, synced_at = self.built_at, self.synced_at
+        now = time.monotonic()
+        if built_at is None or now - built_at > settings.RECIPE_INDEX_REBUILD_SECONDS:
+            if self._build_lock.acquire(blocking=built_at is None):
+                try:
+                    if self.built_at == built_at:  # not rebuilt by another thread
+                        self.build()
+                finally:
+                    self._build_lock.release()
+        elif synced_at is None or now - synced_at > SYNC_SECONDS:
+            self.sync()
+        return self.version
+
+    def _row(self, recipe_id):
+        """row of the recipe, allocating a new one if necessary"""
+        row = self.rows.get(recipe_id)
+        if row is not None:
+            return row
+        row = self.n
+        if row == len(self.ids):  # grow the arrays by doubling them
+            capacity = max(2 * row, 1024)
+            self.ids = np.resize(self.ids, capacity)
+            self.num_ingredients = np.resize(self.num_ingredients, capacity)
+            self.languages = np.resize(self.languages, capacity)
+            self.sizes = np.resize(self.sizes, capacity)
+            self.alive = np.resize(self.alive, capacity)
+            for name, values in self.attributes.items():
+                self.attributes[name] = np.resize(values, capacity)
+        self.ids[row] = recipe_id
+        self.num_ingredients[row] = -1
+        self.languages[row] = -1
+        self.sizes[row] = 0
+        self.alive[row] = True
+        for values in self.attributes.values():
+            values[row] = np.nan
+        self.rows[recipe_id] = row
+        self.n += 1
+        self.version += 1
+        return row
+
+    def posting(self, ingredient_id):
+        """array of rows of the recipes using the ingredient"""
+        return merge_pending(self.postings, self.pending, ingredient_id)
+
+    def tag_posting(self, tag_id):
+        """array of rows of the recipes with the tag"""
+        return merge_pending(self.tag_postings, self.tag_pending, tag_id)
+
+    @mutation
+    def set_recipe(self, recipe_id, num_ingredients, language=None):
+        row = self._row(recipe_id)
+        self.num_ingredients[row] = -1 if num_ingredients is None else num_ingredients
+        self.languages[row] = LANGUAGES.get(language, -1)
+        self.version += 1
+
+    @mutation
+    def set_attributes(self, recipe_id, values):
+        """set the range attributes ({name: value or None}) of the recipe"""
+        row = self._row(recipe_id)
+        for name, value in values.items():
+            self.attributes[name][row] = np.nan if value is None else value
+        self.version += 1
+
+    @mutation
+    def remove_recipe(self, recipe_id):
+        row = self.rows.get(recipe_id)
+        if row is not None:
+            self.alive[row] = False  # postings are filtered by `alive`
+            self.version += 1
+
+    @mutation
+    def add(self, recipe_id, ingredient_id):
+        row = self._row(recipe_id)
+        if contains(self.postings, self.pending, ingredient_id, row):
+            return  # already indexed, e.g. by both `sync` and a signal
+        self.pending.setdefault(ingredient_id, set()).add(row)
+        self.sizes[row] += 1
+        self.version += 1
+
+    @mutation
+    def remove(self, recipe_id, ingredient_id):
+        row = self.rows.get(recipe_id)
+        posting = self.posting(ingredient_id)
+        if row is None or not np.any(posting == row):
+            return
+        self.postings[ingredient_id] = posting[posting != row]
+        self.sizes[row] -= 1
+        self.version += 1
+
+    @mutation
+    def set_tag(self, tag_id, category, name):
+        self.tags[tag_id] = (category, name)
+        self.version += 1
+
+    @mutation
+    def add_tag(self, recipe_id, tag_id):
+        row = self._row(recipe_id)
+        if contains(self.tag_postings, self.tag_pending, tag_id, row):
+            return  # already indexed
+        self.tag_pending.setdefault(tag_id, set()).add(row)
+        self.version += 1
+
+    @mutation
+    def remove_tag(self, recipe_id, tag_id):
+        row = self.rows.get(recipe_id)
+        posting = self.tag_posting(tag_id)
+        if row is None or not np.any(posting == row):
+            return
+        self.tag_postings[tag_id] = posting[posting != row]
+        self.version += 1
+
+    # query
+
+    def exclusion_mask(self, ingredients):
+        """
+        mask of the rows using none of the ingredients, kept until the index
+        changes so that users' exclusions cost one AND per search
+        """
+        key = frozenset(ingredients)
+        with self._lock:
+            entry = self.exclusion_masks.get(key)
+            if entry is not None and entry[0] == self.version:
+                return entry[1]
+            mask = np.ones(self.n, dtype=bool)
+            for ingredient_id in key:
+                mask[self.posting(ingredient_id)] = False
+            if len(self.exclusion_masks) >= MAX_EXCLUSION_MASKS:
+                self.exclusion_masks.clear()
+            self.exclusion_masks[key] = (self.version, mask)
+            return mask
+
+    def filter_mask(self, language=None, exclude=(), tags=None, ranges=None):
+        """
+        mask of the live rows passing the filters that do not depend on the
+        query ingredients. Call with the lock held, after `ensure_fresh`.
+        """
+        n = self.n
+        mask = self.alive[:n].copy()
+        if language is not None:
+            mask &= self.languages[:n] == LANGUAGES.get(language, -1)
+        if exclude:
+            mask &= self.exclusion_mask(exclude)
+        for category, names in (tags or {}).items():  # any of the names
+            tagged = np.zeros(n, dtype=bool)
+            for tag_id, label in self.tags.items():
+                if label[0] == category and label[1] in names:
+                    tagged[self.tag_posting(tag_id)] = True
+            mask &= tagged
+        for name, (low, high) in (ranges or {}).items():
+            values = self.attributes[name][:n]
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values <= high
+        return mask
+
+    def sampled_rows(self, language=None, tags=None):
+        """
+        array of the live rows passing the filters, kept until the index
+        changes. Call with the lock held, after `ensure_fresh`.
+        """
+        key = (
+            language,
+            frozenset(
+                (category, frozenset(names)) for category, names in (tags or {}).items()
+            ),
+        )
+        entry = self.sampled_filters.get(key)
+        if entry is not None and entry[0] == self.version:
+            return entry[1]
+        rows = np.flatnonzero(self.filter_mask(language, tags=tags))
+        if len(self.sampled_filters) >= MAX_SAMPLED_FILTERS:
+            self.sampled_filters.clear()
+        self.sampled_filters[key] = (self.version, rows)
+        return rows
+
+    def sample(self, k, language=None, tags=None, exclude_ids=()):
+        """
+        Returns up to `k` distinct random ids of the live recipes passing the
+        filters, other than `exclude_ids`. Rows are drawn uniformly from the
+        cached rows passing the filters, so it costs O(k) whatever the number
+        of recipes, unless most of them are excluded.
+        """
+        rng = np.random.default_rng()
+        excluded = set(exclude_ids)
+        chosen = []
+        self.ensure_fresh()
+        with self._lock:
+            rows = self.sampled_rows(language, tags)
+            for _ in range(MAX_SAMPLING_ROUNDS):
+                missing = k - len(chosen)
+                if not missing or not len(rows):
+                    break
+                draws = rows[rng.integers(len(rows), size=2 * missing)]
+                for recipe_id in self.ids[draws].tolist():
+                    if recipe_id not in excluded and len(chosen) < k:
+                        excluded.add(recipe_id)
+                        chosen.append(recipe_id)
+            if len(chosen) < k and len(rows):  # mostly excluded, choose among the rest
+                rest = self.ids[rows]
+                rest = rest[~np.isin(rest, list(excluded))]
+                missing = min(k - len(chosen), len(rest))
+                chosen += rng.choice(rest, missing, replace=False).tolist()
+        return chosen
+
+    def candidates(
+        self,
+        query,
+        mode,
+        strict,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+        filtered=None,
+    ):
+        """
+        Returns the mask of the rows matching the search criteria and the
+        number of the `query` ingredients each row uses. `filtered` is the
+        `filter_mask` of the other arguments if already computed. Call with
+        the lock held, after `ensure_fresh`.
+        """
+        n = self.n
+        if filtered is None:
+            filtered = self.filter_mask(language, exclude, tags, ranges)
+        overlap = np.zeros(n, dtype=np.int32)
+        for ingredient_id in query:
+            overlap[self.posting(ingredient_id)] += 1
+        sizes = self.sizes[:n]
+
+        mask = filtered.copy()
+        if query and mode == "exact":
+            mask &= overlap == len(query)
+            if strict:
+                mask &= sizes == len(query)
+        elif query and mode == "any":
+            mask &= overlap > 0
+            if strict:
+                mask &= sizes == overlap
+        if strict:  # sanity check that the recipe was fully scraped
+            mask &= self.num_ingredients[:n] == sizes
+        return mask, overlap
+
+    def facets(
+        self,
+        ingredients,
+        mode,
+        strict,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+    ):
+        """
+        Returns {tag category: {tag name: number of recipes}} over the
+        recipes matching the same criteria as `search`, counted in one pass
+        over the tag postings.
+        """
+        self.ensure_fresh()
+        with self._lock:
+            mask, _ = self.candidates(
+                set(ingredients), mode, strict, language, exclude, tags, ranges
+            )
+            facets = {}
+            for tag_id, (category, name) in self.tags.items():
+                count = np.count_nonzero(mask[self.tag_posting(tag_id)])
+                if count > 0:
+                    counts = facets.setdefault(category, {})
+                    counts[name] = counts.get(name, 0) + count
+        return facets
+
+    def search(
+        self,
+        ingredients,
+        mode,
+        strict,
+        limit=30,
+        order="bm",
+        weights=None,
+        after_key=None,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+    ):
+        """
+        Returns ids of the matched recipes, ordered by `order` (one of
+        `RANKINGS`, best first) and then by the number of the given
+        ingredients they use and by id, and the sort key of the last one
+        if there are more (None otherwise).
+        `weights` ({ingredient id: weight}, missing ones are 0) is used by
+        the "expiry" order.
+        `after_key` is the sort key of the last recipe of the previous page.
+        `language` restricts the recipes to the language if given.
+        `exclude` drops the recipes using any of the ingredient ids.
+        `tags` ({category: names}) keeps the recipes with any of the names
+        in every category.
+        `ranges` ({name in `RANGES`: (min or None, max or None)}) keeps the
+        recipes with the attributes in the inclusive ranges.
+        """
+        if order not in RANKINGS:
+            raise ValueError(f"unknown order: {order}")
+        query = set(ingredients)
+        self.ensure_fresh()
+        with self._lock:
+            mask, overlap = self.candidates(
+                query, mode, strict, language, exclude, tags, ranges
+            )
+            values = self._sort_values(query, mask, overlap, order, weights)
+        return self._page(values, order, limit, after_key)
+
+    def search_many(
+        self,
+        queries,
+        limit=30,
+        order="bm",
+        weights=None,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+    ):
+        """
+        Same as `search` (first pages) for each (ingredients, mode, strict)
+        of `queries`, sharing the other arguments. The index is refreshed
+        and the filters are applied once for all of them.
+        """
+        if order not in RANKINGS:
+            raise ValueError(f"unknown order: {order}")
+        self.ensure_fresh()
+        with self._lock:
+            filtered = self.filter_mask(language, exclude, tags, ranges)
+            all_values = []
+            for ingredients, mode, strict in queries:
+                query = set(ingredients)
+                mask, overlap = self.candidates(query, mode, strict, filtered=filtered)
+                all_values.append(
+                    self._sort_values(query, mask, overlap, order, weights)
+                )
+        return [self._page(values, order, limit) for values in all_values]
+
+    def _sort_values(self, query, mask, overlap, order, weights):
+        """
+        {sort key name: values} of the rows in `mask`, ranked by `order`.
+        Call with the lock held.
+        """
+        rows = np.flatnonzero(mask)
+        bm, sizes = overlap[rows], self.sizes[rows]
+        values = {"id": self.ids[rows], "bm": bm}
+        if order == "coverage":
+            values["coverage"] = np.divide(
+                bm, sizes, out=np.zeros(len(rows)), where=sizes > 0
+            )
+        elif order == "missing":
+            values["missing"] = sizes - bm
+        elif order == "expiry":
+            weighted = np.zeros(self.n)
+            for ingredient_id, weight in (weights or {}).items():
+                if ingredient_id in query:
+                    weighted[self.posting(ingredient_id)] += weight
+            values["expiry"] = weighted[rows]
+        return values
+
+    @staticmethod
+    def _page(values, order, limit, after_key=None):
+        """ids of the page after `after_key` and the sort key of its last one"""
+        # sort ascending, negating the descending keys
+        spec = sort_keys(order)
+        keys = [-values[name] if desc else values[name] for name, desc in spec]
+        if after_key is not None:
+            mask = after(
+                keys, [-v if desc else v for (_, desc), v in zip(spec, after_key)]
+            )
+            keys = [key[mask] for key in keys]
+            values = {name: value[mask] for name, value in values.items()}
+
+        page = top_k(keys, limit + 1)
+        last_key = None
+        if len(page) > limit:
+            page = page[:limit]
+            last_key = [values[name][page[-1]].item() for name, _ in spec]
+        return values["id"][page].tolist(), last_key
+
+
+recipe_index = RecipeIndex()
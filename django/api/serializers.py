@@ -10,6 +10,7 @@ from .models import (
     RecipeTag,
     Tag,
     User,
+    UserExcludedIngredient,
     UserIngredient,
     UserRecipeFavorite,
     UserRecipeHistory,
@@ -99,7 +100,14 @@ class RecipeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Recipe
-        exclude = ["users_who_viewed", "users_who_liked"]
+        exclude = [
+            "users_who_viewed",
+            "users_who_liked",
+            "ingredient_ids",
+            "search_vector",
+            "num_cooked",
+            "num_favorites",
+        ]
 
 
 class UserRecipeFavoriteSerializer(serializers.ModelSerializer):
@@ -127,3 +135,12 @@ class UserIngredientSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserIngredient
         fields = "__all__"
+
+
+class UserExcludedIngredientSerializer(serializers.ModelSerializer):
+    # override relational fields
+    ingredient = IngredientSerializer(read_only=True)
+
+    class Meta:
+        model = UserExcludedIngredient
+        fields = "__all__"
@@ -0,0 +1,272 @@
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .autocomplete import ingredient_autocomplete
+from .inventory import invalidate_inventory
+from .minhash import update_signatures
+from .models import (
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    RecipeNutrition,
+    RecipeTag,
+    Tag,
+    UserIngredient,
+    UserRecipeFavorite,
+    UserRecipeHistory,
+)
+from .payloads import invalidate_payloads, refresh_payloads
+from .rollups import add_usage, user_ingredient_usage
+from .search_cache import bump_search_version
+from .search_index import NUTRITION_RANGES, RECIPE_RANGES, recipe_index
+from .trending import recipe_trends
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, **kwargs):
+    ingredient_id, name = instance.id, instance.name
+    transaction.on_commit(lambda: ingredient_autocomplete.add(ingredient_id, name))
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    ingredient_id = instance.id
+    transaction.on_commit(lambda: ingredient_autocomplete.remove(ingredient_id))
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, created, raw, **kwargs):
+    # the other denormalized fields are not saved (see `Recipe.save`)
+    if not raw:  # fixtures are followed by `manage.py backfill_search_vector`
+        Recipe.objects.filter(id=instance.id).update_search_vector()
+    attributes = {name: getattr(instance, f) for name, f in RECIPE_RANGES.items()}
+
+    def update_index():
+        recipe_index.set_recipe(
+            instance.id, instance.num_ingredients, instance.language
+        )
+        recipe_index.set_attributes(instance.id, attributes)
+
+    transaction.on_commit(update_index)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    recipe_id = instance.id  # cleared by Model.delete() afterwards
+    transaction.on_commit(lambda: recipe_index.remove_recipe(recipe_id))
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def recipe_ingredient_saved(sender, instance, raw, **kwargs):
+    if not raw:  # fixtures are followed by `manage.py backfill_ingredient_ids`
+        recipes = Recipe.objects.filter(id=instance.recipe_id)
+        recipes.update_ingredient_ids()
+        transaction.on_commit(lambda: update_signatures(recipes))
+    transaction.on_commit(
+        lambda: recipe_index.add(instance.recipe_id, instance.ingredient_id)
+    )
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_deleted(sender, instance, **kwargs):
+    recipe_id, ingredient_id = instance.recipe_id, instance.ingredient_id
+    recipes = Recipe.objects.filter(id=recipe_id)
+    recipes.update_ingredient_ids()
+    # after commit, when a deleted recipe is gone rather than recomputed
+    transaction.on_commit(lambda: update_signatures(recipes))
+    transaction.on_commit(lambda: recipe_index.remove(recipe_id, ingredient_id))
+
+
+@receiver(post_save, sender=RecipeNutrition)
+def recipe_nutrition_saved(sender, instance, **kwargs):
+    recipe_id = instance.recipe_id
+    attributes = {name: getattr(instance, f) for name, f in NUTRITION_RANGES.items()}
+    transaction.on_commit(lambda: recipe_index.set_attributes(recipe_id, attributes))
+
+
+@receiver(post_delete, sender=RecipeNutrition)
+def recipe_nutrition_deleted(sender, instance, **kwargs):
+    recipe_id = instance.recipe_id
+    attributes = dict.fromkeys(NUTRITION_RANGES)
+    transaction.on_commit(lambda: recipe_index.set_attributes(recipe_id, attributes))
+
+
+@receiver(post_save, sender=Tag)
+def tag_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        Recipe.objects.filter(recipetag__tag=instance.id).update_search_vector()
+    tag_id, category, name = instance.id, instance.category, instance.name
+    transaction.on_commit(lambda: recipe_index.set_tag(tag_id, category, name))
+
+
+@receiver(post_save, sender=RecipeTag)
+def recipe_tag_saved(sender, instance, raw, **kwargs):
+    if not raw:
+        Recipe.objects.filter(id=instance.recipe_id).update_search_vector()
+    recipe_id, tag_id = instance.recipe_id, instance.tag_id
+    transaction.on_commit(lambda: recipe_index.add_tag(recipe_id, tag_id))
+
+
+@receiver(post_delete, sender=RecipeTag)
+def recipe_tag_deleted(sender, instance, **kwargs):
+    recipe_id, tag_id = instance.recipe_id, instance.tag_id
+    Recipe.objects.filter(id=recipe_id).update_search_vector()
+    transaction.on_commit(lambda: recipe_index.remove_tag(recipe_id, tag_id))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(post_save, sender=RecipeNutrition)
+@receiver(post_delete, sender=RecipeNutrition)
+@receiver(post_save, sender=RecipeTag)
+@receiver(post_delete, sender=RecipeTag)
+def recipe_payload_changed(sender, instance, **kwargs):
+    recipe_ids = [instance.id if sender is Recipe else instance.recipe_id]
+    invalidate_payloads(recipe_ids)
+    # rendered after commit, replacing the stale ones concurrent requests stored
+    transaction.on_commit(lambda: refresh_payloads(recipe_ids))
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Tag)
+def recipe_payload_part_changed(sender, instance, created, **kwargs):
+    if created:  # not in any recipe yet
+        return
+    if sender is Ingredient:
+        recipes = Recipe.objects.filter(recipeingredient__ingredient=instance.id)
+    else:
+        recipes = Recipe.objects.filter(recipetag__tag=instance.id)
+    invalidate_payloads(recipes)
+    transaction.on_commit(lambda: refresh_payloads(recipes))
+
+
+@receiver(post_save, sender=UserIngredient)
+@receiver(post_delete, sender=UserIngredient)
+def user_ingredient_changed(sender, instance, **kwargs):
+    user_id = instance.user_id
+    invalidate_inventory(user_id)
+    # again after commit so that concurrent requests cannot cache stale rows
+    transaction.on_commit(lambda: invalidate_inventory(user_id))
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(post_save, sender=RecipeNutrition)
+@receiver(post_delete, sender=RecipeNutrition)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=RecipeTag)
+@receiver(post_delete, sender=RecipeTag)
+def searchable_data_changed(sender, **kwargs):
+    # after commit so that concurrent searches cannot cache stale results, and
+    # without locking the counter row for the rest of the transaction
+    transaction.on_commit(bump_search_version)
+
+
+def add_count(recipe_id, field, delta):
+    """atomically add `delta` to a denormalized counter of a recipe"""
+    Recipe.objects.filter(id=recipe_id).update(**{field: F(field) + delta})
+
+
+@receiver(pre_save, sender=UserRecipeHistory)
+def user_recipe_history_saving(sender, instance, raw, **kwargs):
+    # the recipe it was counted as cooked for, to apply the difference on save
+    instance._cooked_recipe_id = None
+    if not raw and instance.pk is not None:
+        instance._cooked_recipe_id = (
+            UserRecipeHistory.objects.filter(id=instance.pk, cooked=True)
+            .values_list("recipe_id", flat=True)
+            .first()
+        )
+
+
+@receiver(post_save, sender=UserRecipeHistory)
+def user_recipe_history_saved(sender, instance, raw, **kwargs):
+    if raw:  # fixtures are followed by `manage.py reconcile_recipe_counts`
+        return
+    cooked_recipe_id = instance.recipe_id if instance.cooked else None
+    if cooked_recipe_id != instance._cooked_recipe_id:
+        if instance._cooked_recipe_id is not None:
+            add_count(instance._cooked_recipe_id, "num_cooked", -1)
+        if cooked_recipe_id is not None:
+            add_count(cooked_recipe_id, "num_cooked", 1)
+    instance._cooked_recipe_id = cooked_recipe_id
+
+
+@receiver(post_save, sender=UserRecipeHistory)
+def user_recipe_history_viewed(sender, instance, raw, **kwargs):
+    if raw:  # fixtures are followed by `manage.py rebuild_trending`
+        return
+    recipe_id, access_date = instance.recipe_id, instance.access_date
+    transaction.on_commit(lambda: recipe_trends.record(recipe_id, access_date))
+
+
+@receiver(post_delete, sender=UserRecipeHistory)
+def user_recipe_history_deleted(sender, instance, **kwargs):
+    if instance.cooked:
+        add_count(instance.recipe_id, "num_cooked", -1)
+
+
+@receiver(post_save, sender=UserRecipeFavorite)
+def user_recipe_favorite_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:
+        add_count(instance.recipe_id, "num_favorites", 1)
+
+
+@receiver(post_delete, sender=UserRecipeFavorite)
+def user_recipe_favorite_deleted(sender, instance, **kwargs):
+    add_count(instance.recipe_id, "num_favorites", -1)
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def recipe_ingredient_usage_saved(sender, instance, created, raw, **kwargs):
+    if created and not raw:  # fixtures are followed by `rebuild_ingredient_usage`
+        add_usage(instance.ingredient_id, num_recipes=1)
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_usage_deleted(sender, instance, **kwargs):
+    add_usage(instance.ingredient_id, create=False, num_recipes=-1)
+
+
+@receiver(pre_save, sender=UserIngredient)
+def user_ingredient_saving(sender, instance, raw, **kwargs):
+    # what it was counted as, to apply the difference on save
+    instance._usage = None
+    if not raw and instance.pk is not None:
+        instance._usage = (
+            UserIngredient.objects.filter(id=instance.pk)
+            .values_list("ingredient_id", "happiness")
+            .first()
+        )
+
+
+@receiver(post_save, sender=UserIngredient)
+def user_ingredient_usage_saved(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    deltas = {instance.ingredient_id: user_ingredient_usage(instance.happiness)}
+    if instance._usage is not None:
+        ingredient_id, happiness = instance._usage
+        changes = deltas.setdefault(ingredient_id, {})
+        for name, value in user_ingredient_usage(happiness).items():
+            changes[name] = changes.get(name, 0) - value
+    for ingredient_id, changes in deltas.items():
+        changes = {name: delta for name, delta in changes.items() if delta}
+        if changes:
+            add_usage(ingredient_id, **changes)
+
+
+@receiver(post_delete, sender=UserIngredient)
+def user_ingredient_usage_deleted(sender, instance, **kwargs):
+    changes = user_ingredient_usage(instance.happiness)
+    add_usage(
+        instance.ingredient_id,
+        create=False,
+        **{name: -delta for name, delta in changes.items()},
+    )
@@ -1,11 +1,37 @@
-from datetime import datetime
-
-from django.test import TestCase
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 
-from .models import (Ingredient, QuantityScaleUnit, Recipe, RecipeIngredient,
-                     RecipeNutrition, User, UserIngredient, UserRecipeFavorite,
-                     UserRecipeHistory)
+from .autocomplete import ingredient_autocomplete
+from .management.commands import benchmark_payloads
+from .models import (
+    Ingredient,
+    QuantityScaleUnit,
+    Recipe,
+    RecipeIngredient,
+    RecipeNutrition,
+    RecipePayload,
+    RecipeTag,
+    Tag,
+    User,
+    UserExcludedIngredient,
+    UserIngredient,
+    UserRecipeFavorite,
+    UserRecipeHistory,
+)
+from .payloads import favorite_list, history_list, recipe_list
+from .search_cache import bump_search_version, search_cache
+from .search_index import SYNC_SECONDS, RecipeIndex, recipe_index
+from .trending import DecayedCounts, RecipeTrendsTracker, recipe_trends
+from .views import sort_value
 
 
 class AuthTestCase(TestCase):
@@ -173,6 +199,202 @@ class SearchIngredientTestCase(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(res.json()), 2)
 
+    def test_get_with_limit(self):
+        """GET with limit should receive the shortest matches first"""
+        Ingredient.objects.create(name="carrot juice")
+        i2 = Ingredient.objects.create(name="carrot")
+
+        res = self.client.get("/api/ingredients/search?icontains=carrot&limit=1")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([i["id"] for i in res.json()], [i2.id])
+
+        for limit in ["-1", "0", "101", "x"]:
+            res = self.client.get(
+                "/api/ingredients/search", data={"icontains": "carrot", "limit": limit}
+            )
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_similar(self):
+        """GET with similar should tolerate typos"""
+        i1 = Ingredient.objects.create(name="tomato")
+        i2 = Ingredient.objects.create(name="cherry tomatoes")
+        Ingredient.objects.create(name="potato")
+
+        res = self.client.get("/api/ingredients/search?similar=tomatoe")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertCountEqual([i["id"] for i in res.json()], [i1.id, i2.id])
+
+
+class IngredientsStatisticsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def setupToken(self, username, password="testpass"):
+        _res = self.client.post(
+            "/api/token",
+            data={"username": username, "password": password},
+            format="json",
+        )
+        token = _res.json()["access"]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def statistics(self):
+        with self.assertNumQueries(2):  # anonymous, as it is the same for everyone
+            res = APIClient().get("/api/ingredients/statistics")
+        self.assertEqual(res.status_code, 200)
+        return (
+            [(i["name"], i["uses"]) for i in res.json()["most_used"]],
+            [
+                (i["name"], i["happiness"], i["num_ratings"])
+                for i in res.json()["most_happy"]
+            ],
+        )
+
+    def test_get_statistics(self):
+        """Endpoint serves the running aggregates of recipe and user ingredients"""
+        u = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="carrot")
+        i2 = Ingredient.objects.create(name="onion")
+        i3 = Ingredient.objects.create(name="garlic")
+        unit = QuantityScaleUnit.objects.create(unit="count")
+        r = Recipe.objects.create(title="recipe 1")
+        RecipeIngredient.objects.create(recipe=r, ingredient=i2)
+        ri = RecipeIngredient.objects.create(recipe=r, ingredient=i3)
+        self.assertEqual(self.statistics(), ([("onion", 1), ("garlic", 1)], []))
+
+        self.setupToken(u.username)
+        data = {
+            "ingredient_id": i1.id,
+            "quantity_value": 1.0,
+            "quantity_scale_unit_id": unit.id,
+            "storage": 0,
+            "expiration_date": "2022-11-19T08:19:31.193Z",
+            "happiness": 40.0,
+        }
+        for happiness in [40.0, 80.0]:
+            res = self.client.post(
+                "/api/user/ingredients", {**data, "happiness": happiness}, format="json"
+            )
+        self.client.post(
+            "/api/user/ingredients",
+            {**data, "ingredient_id": i2.id, "happiness": 30.0},
+            format="json",
+        )
+        self.assertEqual(
+            self.statistics(),
+            (
+                [("carrot", 2), ("onion", 2), ("garlic", 1)],
+                [("carrot", 60.0, 2), ("onion", 30.0, 1)],
+            ),
+        )
+
+        ui = res.json()["id"]
+        self.client.put(
+            "/api/user/ingredients",
+            {"user_ingredient_id": ui, "happiness": 20.0},
+            format="json",
+        )
+        self.assertEqual(
+            self.statistics()[1], [("carrot", 30.0, 2), ("onion", 30.0, 1)]
+        )
+        self.client.put(
+            "/api/user/ingredients",
+            {"user_ingredient_id": ui, "ingredient_id": i3.id, "happiness": None},
+            format="json",
+        )
+        ri.delete()
+        UserIngredient.objects.filter(ingredient=i2).delete()
+        self.assertEqual(
+            self.statistics(),
+            ([("carrot", 1), ("onion", 1), ("garlic", 1)], [("carrot", 40.0, 1)]),
+        )
+
+    def test_rebuild(self):
+        """The command should recompute the aggregates of rows bypassing signals"""
+        u = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="carrot")
+        i2 = Ingredient.objects.create(name="onion")
+        r = Recipe.objects.create(title="recipe 1")
+        RecipeIngredient.objects.bulk_create(
+            [RecipeIngredient(recipe=r, ingredient=i) for i in [i1, i2]]
+        )
+        UserIngredient.objects.bulk_create(
+            [
+                UserIngredient(user=u, ingredient=i1, happiness=50.0),
+                UserIngredient(user=u, ingredient=i1),
+            ]
+        )
+        self.assertEqual(self.statistics(), ([], []))
+
+        out = StringIO()
+        call_command("rebuild_ingredient_usage", stdout=out)
+        self.assertIn("Rebuilt usage of 2 ingredients", out.getvalue())
+        self.assertEqual(
+            self.statistics(),
+            ([("carrot", 3), ("onion", 1)], [("carrot", 50.0, 1)]),
+        )
+
+
+class IngredientsAutocompleteTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        ingredient_autocomplete.reset()
+
+    def complete(self, prefix, **data):
+        res = self.client.get(
+            "/api/ingredients/autocomplete", data={"prefix": prefix, **data}
+        )
+        self.assertEqual(res.status_code, 200)
+        return [i["name"] for i in res.json()]
+
+    def test_word_starts_by_usage(self):
+        """Names with a word starting with the prefix, the most used first"""
+        sauce = Ingredient.objects.create(name="Sauce")
+        soy_sauce = Ingredient.objects.create(name="soy sauce")
+        Ingredient.objects.create(name="sausage")
+        Ingredient.objects.create(name="chili-sauce")
+        for i in range(2):
+            r = Recipe.objects.create(title=f"recipe {i}")
+            RecipeIngredient.objects.create(recipe=r, ingredient=soy_sauce)
+        RecipeIngredient.objects.create(recipe=r, ingredient=sauce)
+
+        self.assertEqual(self.complete("sauc"), ["soy sauce", "Sauce", "chili-sauce"])
+        self.assertEqual(self.complete("SAU", limit=2), ["soy sauce", "Sauce"])
+        self.assertEqual(self.complete("soy s"), ["soy sauce"])
+        self.assertEqual(self.complete("oy"), [])
+        self.assertEqual(self.complete("s"), [])  # too short
+
+        res = self.client.get("/api/ingredients/autocomplete", data={"limit": 0})
+        self.assertEqual(res.status_code, 400)
+
+    def test_updated_incrementally(self):
+        """Saved, renamed and deleted ingredients should be reflected"""
+        i1 = Ingredient.objects.create(name="carrot")
+        self.assertEqual(self.complete("car"), ["carrot"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            i2 = Ingredient(name="cardamom")
+            i2.save_or_update_min()
+        self.assertEqual(self.complete("car"), ["carrot", "cardamom"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            i1.name = "parsnip"
+            i1.save()
+            i2.delete()
+        self.assertEqual(self.complete("car"), [])
+        self.assertEqual(self.complete("par"), ["parsnip"])
+
+        # added in bulk and merged at once on the next lookup
+        for i in range(20):
+            ingredient_autocomplete.add(1000 + i, f"pepper {19 - i}")
+        self.assertEqual(len(ingredient_autocomplete.pending), 40)
+        self.assertEqual(self.complete("pepper 1")[:2], ["pepper 1", "pepper 10"])
+        self.assertEqual(ingredient_autocomplete.pending, [])
+        keys = ingredient_autocomplete.keys
+        self.assertEqual(keys, sorted(keys))
+
 
 class UsersIngredientsTestCase(TestCase):
     def setUp(self):
@@ -445,6 +667,8 @@ class UsersIngredientsTestCase(TestCase):
 class RecipesSearchTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
 
     def setupToken(self, username, password="testpass"):
         _res = self.client.post(
@@ -487,6 +711,17 @@ class RecipesSearchTestCase(TestCase):
             res.json()[0]["ingredients"][0]["ingredient"]["in_storage"], True
         )
 
+        # consumed through another worker, whose signal does not reach this one
+        UserIngredient.objects.filter(user=u1).update(consumed=True)
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"ingredient": [i1.id, i2.id, i3.id], "mode": "exact", "strict": True},
+        )
+        self.assertEqual(
+            res.json()[0]["ingredients"][0]["ingredient"]["in_storage"], False
+        )
+        UserIngredient.objects.filter(user=u1).update(consumed=False)
+
         # r1 uses i3, an unspecified ingredient, and thus not returned (violating 'strict')
         res = self.client.get(
             "/api/recipes/search",
@@ -606,6 +841,8 @@ class RecipesSearchTestCase(TestCase):
         RecipeIngredient.objects.create(recipe=r3, ingredient=i2)
         RecipeIngredient.objects.create(recipe=r3, ingredient=i4)
 
+        recipe_index.synced_at = None  # sync right away
+
         # Both r2 and r3 does not use any ingredient other than (i1, i2, i4)
         res = self.client.get(
             "/api/recipes/search",
@@ -691,6 +928,8 @@ class RecipesSearchTestCase(TestCase):
         RecipeIngredient.objects.create(recipe=r3, ingredient=i2)
         RecipeIngredient.objects.create(recipe=r3, ingredient=i4)
 
+        recipe_index.synced_at = None  # sync right away
+
         # Both r2 and r3 does not use any ingredient other than (i1, i2, i4)
         res = self.client.get(
             "/api/recipes/search",
@@ -705,6 +944,957 @@ class RecipesSearchTestCase(TestCase):
         self.assertEqual(res.json()[0]["id"], r3.id)
         self.assertEqual(res.json()[1]["id"], r2.id)
 
+    def test_search_fridge(self):
+        """
+        Should rank recipes by how much of them the user's stored ingredients cover
+        """
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2")
+        i3 = Ingredient.objects.create(name="ingredient 3")
+        i4 = Ingredient.objects.create(name="ingredient 4")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=3)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i2)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i4)
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        r3 = Recipe.objects.create(title="recipe 3", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r3, ingredient=i3)
+        UserIngredient.objects.create(user=u1, ingredient=i1, consumed=False)
+        UserIngredient.objects.create(user=u1, ingredient=i2, consumed=False)
+        UserIngredient.objects.create(user=u1, ingredient=i3, consumed=True)
+        data = {"mode": "fridge", "strict": False}
+
+        # without authentication there is no fridge
+        res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual(res.status_code, 401)
+
+        # r2 is fully covered by (i1, i2) and r1 is covered 2/3; i3 was consumed
+        self.setupToken(u1.username)
+        res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual([r["id"] for r in res.json()], [r2.id, r1.id])
+
+        # adding i4 to the fridge makes r1 fully covered as well
+        res = self.client.post(
+            "/api/user/ingredients",
+            data={
+                "ingredient_id": i4.id,
+                "quantity_value": 1,
+                "quantity_scale_unit_id": QuantityScaleUnit.objects.create(
+                    unit="unit"
+                ).id,
+                "storage": 1,
+                "expiration_date": "2022-11-19T08:19:31.193Z",
+                "happiness": 50,
+            },
+        )
+        self.assertEqual(res.status_code, 201)
+        res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual([r["id"] for r in res.json()], [r1.id, r2.id])
+
+    def test_search_expiry(self):
+        """
+        Should rank first the recipes using up the user's soon-to-expire ingredients
+        """
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2", refrigerator_days=30)
+        i3 = Ingredient.objects.create(name="ingredient 3")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=2)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i2)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i3)
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        r3 = Recipe.objects.create(title="recipe 3", num_ingredients=2)
+        RecipeIngredient.objects.create(recipe=r3, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r3, ingredient=i2)
+        # i1 expires tomorrow, i2 in 30 days (estimated by its shelf life)
+        UserIngredient.objects.create(
+            user=u1,
+            ingredient=i1,
+            expiration_date=timezone.now() + timedelta(days=1),
+        )
+        UserIngredient.objects.create(user=u1, ingredient=i2, storage=1)
+        data = {"mode": "fridge", "strict": False, "order": "expiry"}
+
+        res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual(res.status_code, 401)
+
+        self.setupToken(u1.username)
+        res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual([r["id"] for r in res.json()], [r3.id, r2.id, r1.id])
+
+        with override_settings(RECIPE_SEARCH_INDEX=False):
+            res = self.client.get("/api/recipes/search", data=data)
+        self.assertEqual([r["id"] for r in res.json()], [r3.id, r2.id, r1.id])
+
+        # only the given ingredients count
+        res = self.client.get(
+            "/api/recipes/search",
+            data={**data, "ingredient": [i2.id], "mode": "any"},
+        )
+        self.assertEqual([r["id"] for r in res.json()], [r1.id, r3.id])
+
+        # later pages keep the weights of the first one, even days after
+        res = self.client.get("/api/recipes/search", data={**data, "limit": 1})
+        ids = [r["id"] for r in res.json()["results"]]
+        later = timezone.now() + timedelta(days=40)
+        with mock.patch("django.utils.timezone.now", return_value=later):
+            for _ in range(2):
+                cursor = res.json()["next"]
+                res = self.client.get(
+                    "/api/recipes/search", data={**data, "limit": 1, "cursor": cursor}
+                )
+                ids += [r["id"] for r in res.json()["results"]]
+        self.assertEqual(ids, [r3.id, r2.id, r1.id])
+
+
+class RecipeIndexTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+
+    def search(self, ingredients, mode="any", strict=False, order="bm"):
+        res = self.client.get(
+            "/api/recipes/search",
+            data={
+                "ingredient": ingredients,
+                "mode": mode,
+                "strict": strict,
+                "order": order,
+            },
+        )
+        self.assertEqual(res.status_code, 200)
+        return [r["id"] for r in res.json()]
+
+    def test_rows_added_after_build(self):
+        """Recipes inserted after the index is built should be searchable"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        self.assertEqual(self.search([i1.id]), [r1.id])
+
+        # e.g. inserted by the crawler running in another process
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        search_cache.clear()
+        self.assertEqual(self.search([i1.id]), [r1.id])  # until the next sync
+
+        recipe_index.synced_at -= SYNC_SECONDS + 1
+        self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+
+    def test_rows_deleted(self):
+        """Deleted recipes and recipe-ingredients should not match anymore"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=2)
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        ri = RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i2)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ri.delete()
+        self.assertEqual(self.search([i1.id]), [r2.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            r2.delete()
+        self.assertEqual(self.search([i1.id, i2.id]), [r1.id])
+
+    def test_rebuild(self):
+        """Changes made while the index is rebuilt should be kept"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=1)
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+
+        load = RecipeIndex.load
+
+        def load_and_delete(index):
+            load(index)
+            # e.g. by a signal in another thread, while the old index is in use
+            self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+            recipe_index.remove_recipe(r1.id)
+
+        with mock.patch.object(RecipeIndex, "load", load_and_delete):
+            recipe_index.build()
+        self.assertEqual(self.search([i1.id]), [r2.id])
+
+    def test_add_without_merging(self):
+        """Adding rows should keep them pending, once, until the next query"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        recipes = [Recipe.objects.create(title=f"recipe {i}") for i in range(3)]
+        RecipeIngredient.objects.create(recipe=recipes[0], ingredient=i1)
+        self.assertEqual(self.search([i1.id]), [recipes[0].id])
+
+        for r in reversed(recipes):  # as both `sync` and a signal would
+            recipe_index.add(r.id, i1.id)
+            recipe_index.add(r.id, i1.id)
+        self.assertEqual(len(recipe_index.pending[i1.id]), 2)
+        posting = recipe_index.posting(i1.id)
+        self.assertEqual(posting.tolist(), sorted(set(posting.tolist())))
+        self.assertEqual(len(posting), 3)
+
+    def test_same_as_db(self):
+        """The index should return the same ranking as the DB"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(4)]
+        for i, uses in enumerate([(0, 1, 2), (0, 1), (1, 2, 3), (3,), ()]):
+            r = Recipe.objects.create(title=f"recipe {i}", num_ingredients=len(uses))
+            for u in uses:
+                RecipeIngredient.objects.create(recipe=r, ingredient=ings[u])
+
+        for query in [[], [0], [0, 1], [1, 3], [0, 1, 2, 3]]:
+            for mode in ["any", "exact"]:
+                for strict in [True, False]:
+                    for order in ["bm", "coverage", "missing"]:
+                        ids = [ings[q].id for q in query]
+                        with override_settings(RECIPE_SEARCH_INDEX=False):
+                            expected = self.search(ids, mode, strict, order)
+                        self.assertEqual(
+                            self.search(ids, mode, strict, order), expected
+                        )
+
+    def test_order(self):
+        """Should rank by the number of matches, coverage or missing ingredients"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(5)]
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=5)
+        for i in ings:
+            RecipeIngredient.objects.create(recipe=r1, ingredient=i)
+        r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=ings[0])
+
+        query = [ings[0].id, ings[1].id]
+        self.assertEqual(self.search(query, order="bm"), [r1.id, r2.id])
+        self.assertEqual(self.search(query, order="coverage"), [r2.id, r1.id])
+        self.assertEqual(self.search(query, order="missing"), [r2.id, r1.id])
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"ingredient": query, "mode": "any", "strict": False, "order": "x"},
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_pagination(self):
+        """Pages should follow each other without gaps or duplicates"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(3)]
+        recipes = []
+        for i in range(7):
+            r = Recipe.objects.create(title=f"recipe {i}", num_ingredients=i % 3 + 1)
+            for ing in ings[: i % 3 + 1]:
+                RecipeIngredient.objects.create(recipe=r, ingredient=ing)
+            recipes.append(r)
+        query = [ing.id for ing in ings]
+
+        for order in ["bm", "coverage", "missing"]:
+            for use_index in [True, False]:
+                with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                    expected = self.search(query, order=order)
+                    data = {"ingredient": query, "mode": "any", "strict": False}
+                    data.update(order=order, limit=3)
+                    pages = []
+                    while True:
+                        res = self.client.get("/api/recipes/search", data=data)
+                        self.assertEqual(res.status_code, 200)
+                        pages.append([r["id"] for r in res.json()["results"]])
+                        if res.json()["next"] is None:
+                            break
+                        data["cursor"] = res.json()["next"]
+                self.assertEqual([len(page) for page in pages], [3, 3, 1])
+                self.assertEqual(sum(pages, []), expected)
+
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"mode": "any", "strict": False, "cursor": "invalid"},
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_hydrate_only_page(self):
+        """Statistics should be joined only for the selected page of recipes"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        for i in range(3):
+            r = Recipe.objects.create(title=f"recipe {i}", num_ingredients=1)
+            RecipeIngredient.objects.create(recipe=r, ingredient=i1)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                with CaptureQueriesContext(connection) as ctx:
+                    self.assertEqual(len(self.search([i1.id])), 3)
+            stats = [q["sql"] for q in ctx.captured_queries if "num_cooked" in q["sql"]]
+            self.assertEqual(len(stats), 1)
+            self.assertIn('"api_recipe"."id" IN (', stats[0])
+            self.assertNotIn("api_recipeingredient", stats[0])
+
+
+class RecipeSearchBatchTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+        self.ings = [
+            Ingredient.objects.create(name=f"ingredient {i}") for i in range(4)
+        ]
+        for i, uses in enumerate([(0, 1, 2), (0, 1), (1, 2, 3), (3,), ()]):
+            r = Recipe.objects.create(title=f"recipe {i}", num_ingredients=len(uses))
+            for u in uses:
+                RecipeIngredient.objects.create(recipe=r, ingredient=self.ings[u])
+
+    def test_same_as_search(self):
+        """Each query of the batch should return the same page as a search"""
+        queries = [
+            {"ingredient": [self.ings[q].id for q in query], "mode": mode}
+            for query in [[0], [0, 1], [1, 3], [0], []]
+            for mode in ["any", "exact"]
+        ]
+        for order in ["bm", "coverage", "missing"]:
+            for use_index in [True, False]:
+                with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                    expected = []
+                    for query in queries:
+                        res = self.client.get(
+                            "/api/recipes/search",
+                            data={**query, "strict": False, "order": order, "limit": 2},
+                        )
+                        expected.append(res.json())
+                    search_cache.clear()
+                    with CaptureQueriesContext(connection) as ctx:
+                        res = self.client.post(
+                            "/api/recipes/search/batch",
+                            data={"queries": queries, "order": order, "limit": 2},
+                            format="json",
+                        )
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual(res.json(), expected)
+                # one query for all the searches and one hydration of all pages
+                sqls = [q["sql"] for q in ctx.captured_queries]
+                searches = [sql for sql in sqls if "UNION ALL" in sql]
+                self.assertEqual(len(searches), 0 if use_index else 1)
+                hydrations = [sql for sql in sqls if "num_cooked" in sql]
+                self.assertEqual(len(hydrations), 1)
+
+    def test_null_sort_values(self):
+        """Pages of the UNION ALL should be sorted as PostgreSQL sorts NULLs"""
+        values = [3, None, 1]
+        self.assertEqual(
+            sorted(values, key=lambda v: sort_value(v, False)), [1, 3, None]
+        )
+        self.assertEqual(
+            sorted(values, key=lambda v: sort_value(v, True)), [None, 3, 1]
+        )
+
+    def test_invalid(self):
+        for data in [
+            {"queries": []},
+            {"queries": [{"ingredient": ["x"]}]},
+            {"queries": [{}], "order": "x"},
+            {"queries": [{}], "limit": 0},
+        ]:
+            res = self.client.post("/api/recipes/search/batch", data, format="json")
+            self.assertEqual(res.status_code, 400)
+
+
+class RecipeFacetsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+
+    def search(self, ingredients, **data):
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"ingredient": ingredients, "mode": "any", "strict": False, **data},
+        )
+        self.assertEqual(res.status_code, 200)
+        return res.json()
+
+    def test_filters_and_facets(self):
+        """Searches should be filtered by tags and ranges and count tags"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        vegan = Tag.objects.create(category="diet", name="vegan")
+        keto = Tag.objects.create(category="diet", name="keto")
+        lunch = Tag.objects.create(category="meal", name="lunch")
+        r1 = Recipe.objects.create(title="recipe 1", cook_minute=10, num_servings=2)
+        r2 = Recipe.objects.create(title="recipe 2", cook_minute=30, num_servings=4)
+        r3 = Recipe.objects.create(title="recipe 3")
+        for r in [r1, r2, r3]:
+            RecipeIngredient.objects.create(recipe=r, ingredient=i1)
+        RecipeNutrition.objects.create(recipe=r1, calories_kcal_per_serving=200)
+        RecipeNutrition.objects.create(recipe=r2, calories_kcal_per_serving=600)
+        RecipeTag.objects.create(recipe=r1, tag=vegan)
+        RecipeTag.objects.create(recipe=r1, tag=lunch)
+        RecipeTag.objects.create(recipe=r2, tag=keto)
+        RecipeTag.objects.create(recipe=r3, tag=vegan)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                res = self.search([i1.id], facets=True)
+                self.assertEqual(
+                    [r["id"] for r in res["results"]], [r1.id, r2.id, r3.id]
+                )
+                self.assertEqual(
+                    res["facets"],
+                    {"diet": {"vegan": 2, "keto": 1}, "meal": {"lunch": 1}},
+                )
+
+                res = self.search([i1.id], tag=["diet::vegan", "diet::keto"])
+                self.assertEqual([r["id"] for r in res], [r1.id, r2.id, r3.id])
+                res = self.search([i1.id], tag=["diet::vegan", "meal::lunch"])
+                self.assertEqual([r["id"] for r in res], [r1.id])
+
+                res = self.search([i1.id], max_cook_minute=20, facets=True)
+                self.assertEqual([r["id"] for r in res["results"]], [r1.id])
+                self.assertEqual(
+                    res["facets"], {"diet": {"vegan": 1}, "meal": {"lunch": 1}}
+                )
+                res = self.search([i1.id], min_num_servings=3)
+                self.assertEqual([r["id"] for r in res], [r2.id])
+                res = self.search([i1.id], min_calories=100, max_calories=500)
+                self.assertEqual([r["id"] for r in res], [r1.id])
+
+        # tagged after the index is built
+        RecipeTag.objects.create(recipe=r2, tag=lunch)
+        recipe_index.synced_at = None  # sync right away
+        res = self.search([i1.id], facets=True)
+        self.assertEqual(res["facets"]["meal"], {"lunch": 2})
+
+        res = self.client.get(
+            "/api/recipes/search", data={"mode": "any", "strict": False, "tag": "x"}
+        )
+        self.assertEqual(res.status_code, 400)
+
+
+class RecipeTextSearchTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+
+    def search(self, text, ingredients=(), **data):
+        res = self.client.get(
+            "/api/recipes/search",
+            data={
+                "q": text,
+                "ingredient": ingredients,
+                "mode": "any",
+                "strict": False,
+                **data,
+            },
+        )
+        self.assertEqual(res.status_code, 200)
+        return res.json()
+
+    def test_title_and_tags(self):
+        """Recipes should be ranked by matches in their titles, then tags"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        r1 = Recipe.objects.create(title="Tomato soup")
+        r2 = Recipe.objects.create(title="Green salad")
+        r3 = Recipe.objects.create(title="Pasta")
+        RecipeTag.objects.create(
+            recipe=r2, tag=Tag.objects.create(category="dish", name="soups")
+        )
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                self.assertEqual([r["id"] for r in self.search("soup")], [r1.id, r2.id])
+                self.assertEqual([r["id"] for r in self.search("pasta")], [r3.id])
+                # combined with the ingredients
+                self.assertEqual(
+                    [r["id"] for r in self.search("soup", [i1.id])], [r2.id]
+                )
+                res = self.search("soup", limit=1)
+                self.assertEqual([r["id"] for r in res["results"]], [r1.id])
+                res = self.search("soup", limit=1, cursor=res["next"])
+                self.assertEqual([r["id"] for r in res["results"]], [r2.id])
+                self.assertIsNone(res["next"])
+
+        # renaming the title or tags updates the vector
+        r3.title = "Pasta soup"
+        r3.save()
+        self.assertEqual(len(self.search("soup")), 3)
+
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"mode": "any", "strict": False, "order": "relevance"},
+        )
+        self.assertEqual(res.status_code, 400)
+
+    def test_backfill(self):
+        """Recipes saved without signals should be searchable once backfilled"""
+        Recipe.objects.bulk_create([Recipe(title="Tomato soup")])
+        self.assertEqual(self.search("soup"), [])
+
+        call_command("backfill_search_vector", stdout=StringIO())
+        self.assertEqual(len(self.search("soup")), 1)
+
+
+class SimilarRecipesTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def similar(self, recipe_id):
+        res = self.client.get(f"/api/recipes/{recipe_id}/similar")
+        self.assertEqual(res.status_code, 200)
+        return [(r["id"], r["similarity"]) for r in res.json()]
+
+    def test_similar(self):
+        """Recipes sharing most ingredients should be returned, most similar first"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(12)]
+        r1, r2, r3, r4 = [Recipe.objects.create(title=f"recipe {i}") for i in range(4)]
+        with self.captureOnCommitCallbacks(execute=True):
+            for r, used in [(r1, ings[:10]), (r2, ings[:10]), (r3, ings[:9])]:
+                for ing in used:
+                    RecipeIngredient.objects.create(recipe=r, ingredient=ing)
+            RecipeIngredient.objects.create(recipe=r4, ingredient=ings[11])
+
+        res = self.similar(r1.id)
+        self.assertEqual([i for i, _ in res], [r2.id, r3.id])
+        self.assertEqual(res[0][1], 1.0)
+        self.assertEqual(self.similar(r4.id), [])
+
+        res = self.client.get("/api/recipes/0/similar")
+        self.assertEqual(res.status_code, 404)
+
+    def test_most_matching_candidates(self):
+        """Candidates beyond the limit should be those sharing the fewest bands"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(10)]
+        r1, r2, r3 = [Recipe.objects.create(title=f"recipe {i}") for i in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            for r, used in [(r1, ings[:8]), (r2, ings), (r3, ings)]:
+                for ing in used:
+                    RecipeIngredient.objects.create(recipe=r, ingredient=ing)
+
+        self.assertEqual([i for i, _ in self.similar(r2.id)], [r3.id, r1.id])
+        with mock.patch("api.minhash.MAX_CANDIDATES", 1):
+            self.assertEqual(self.similar(r2.id), [(r3.id, 1.0)])
+
+    def test_build(self):
+        """Signatures of recipes saved without signals should be built offline"""
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(3)]
+        r1, r2 = [Recipe.objects.create(title=f"recipe {i}") for i in range(2)]
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=r, ingredient=ing) for r in [r1, r2] for ing in ings
+        )
+        call_command("backfill_ingredient_ids", stdout=StringIO())
+        self.assertEqual(self.similar(r1.id), [])
+
+        call_command("build_minhash", stdout=StringIO())
+        self.assertEqual(self.similar(r1.id), [(r2.id, 1.0)])
+
+
+class SearchCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+
+    def search(self, ingredients, **data):
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"ingredient": ingredients, "mode": "any", "strict": False, **data},
+        )
+        self.assertEqual(res.status_code, 200)
+        return [r["id"] for r in res.json()]
+
+    def test_hit_and_invalidation(self):
+        """Repeated searches should be cached until recipes change"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                self.assertEqual(self.search([i1.id, i2.id]), [r1.id])
+                # same ingredients in another order and duplicated, costing
+                # the version read and the hydration of the page
+                with self.assertNumQueries(3) as ctx:
+                    self.assertEqual(self.search([i2.id, i1.id, i1.id]), [r1.id])
+                self.assertFalse(
+                    any("ingredient_ids" in q["sql"] for q in ctx.captured_queries)
+                )
+                data = {"ingredient": [i1.id], "mode": "any", "strict": False}
+                data["facets"] = True
+                self.client.get("/api/recipes/search", data=data)
+                with self.assertNumQueries(3):  # the version is read once
+                    res = self.client.get("/api/recipes/search", data=data)
+                self.assertEqual(res.json()["facets"], {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+            RecipeIngredient.objects.create(recipe=r2, ingredient=i2)
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                self.assertEqual(self.search([i1.id, i2.id]), [r1.id, r2.id])
+
+    def test_invalidation_by_other_process(self):
+        """A change committed by another worker should invalidate cached pages"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        r1 = Recipe.objects.create(title="recipe 1", num_ingredients=1)
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        with override_settings(RECIPE_SEARCH_INDEX=False):
+            self.assertEqual(self.search([i1.id]), [r1.id])
+
+            # rows written by another worker, which then bumps the version
+            r2 = Recipe.objects.create(title="recipe 2", num_ingredients=1)
+            RecipeIngredient.objects.bulk_create(
+                [RecipeIngredient(recipe=r2, ingredient=i1)]
+            )
+            Recipe.objects.filter(id=r2.id).update(ingredient_ids=[i1.id])
+            self.assertEqual(self.search([i1.id]), [r1.id])
+            bump_search_version()
+            self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+
+    def test_language(self):
+        """Searches should be filtered by language if given"""
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        r1 = Recipe.objects.create(title="recipe 1", language="en")
+        r2 = Recipe.objects.create(title="recipe 2", language="de")
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+                self.assertEqual(self.search([i1.id], language="de"), [r2.id])
+                self.assertEqual(self.search([i1.id], language="ja"), [])
+
+
+class IngredientIdsTestCase(TestCase):
+    def test_kept_in_sync(self):
+        """Recipe.ingredient_ids should follow RecipeIngredient changes"""
+        r1 = Recipe.objects.create(title="recipe 1")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2")
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i2)
+        ri = RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        r1.refresh_from_db()
+        self.assertEqual(r1.ingredient_ids, [i1.id, i2.id])
+
+        ri.delete()
+        r1.refresh_from_db()
+        self.assertEqual(r1.ingredient_ids, [i2.id])
+
+        # saving a stale instance does not lose them
+        r1.ingredient_ids = []
+        r1.save()
+        r1.refresh_from_db()
+        self.assertEqual(r1.ingredient_ids, [i2.id])
+
+    def test_backfill_and_check(self):
+        """The checker should find rows bypassing signals until backfilled"""
+        r1 = Recipe.objects.create(title="recipe 1")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        RecipeIngredient.objects.bulk_create(
+            [RecipeIngredient(recipe=r1, ingredient=i1)]
+        )
+        with self.assertRaisesMessage(CommandError, "1 recipes"):
+            call_command("check_ingredient_ids", stdout=StringIO())
+
+        call_command("backfill_ingredient_ids", stdout=StringIO())
+        call_command("check_ingredient_ids", stdout=StringIO())
+        r1.refresh_from_db()
+        self.assertEqual(r1.ingredient_ids, [i1.id])
+
+
+class RecipeCountsTestCase(TestCase):
+    def counts(self, recipe):
+        recipe.refresh_from_db()
+        return recipe.num_cooked, recipe.num_favorites
+
+    def test_kept_in_sync(self):
+        """Recipe.num_cooked and num_favorites should follow the user tables"""
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        u2 = User.objects.create_user(username="user2", password="testpass")
+        r1 = Recipe.objects.create(title="recipe 1")
+        r2 = Recipe.objects.create(title="recipe 2")
+
+        h1 = UserRecipeHistory.objects.create(user=u1, recipe=r1, cooked=True)
+        h2 = UserRecipeHistory.objects.create(user=u2, recipe=r1)
+        UserRecipeFavorite.objects.create(user=u1, recipe=r1)
+        f2 = UserRecipeFavorite.objects.create(user=u2, recipe=r1)
+        self.assertEqual(self.counts(r1), (1, 2))
+
+        h2.cooked = True
+        h2.save()
+        h2.save()  # unchanged
+        self.assertEqual(self.counts(r1), (2, 2))
+        h1.recipe = r2
+        h1.save()
+        self.assertEqual(self.counts(r1), (1, 2))
+        self.assertEqual(self.counts(r2), (1, 0))
+
+        h2.delete()
+        f2.delete()
+        self.assertEqual(self.counts(r1), (0, 1))
+
+        # saving a stale instance does not lose them, nor recompute them
+        r2.num_cooked = 0
+        with CaptureQueriesContext(connection) as ctx:
+            r2.save()
+        updates = [q["sql"] for q in ctx.captured_queries if "UPDATE" in q["sql"]]
+        self.assertEqual(len(updates), 2)  # the row, then its search vector
+        self.assertNotIn("num_cooked", " ".join(updates))
+        self.assertEqual(self.counts(r2), (1, 0))
+
+        client = APIClient()
+        res = client.post(
+            "/api/token",
+            data={"username": "user2", "password": "testpass"},
+            format="json",
+        )
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {res.json()['access']}")
+        client.post("/api/user/recipes", data={"recipe_id": r2.id, "cooked": True})
+        client.post("/api/user/favorite", data={"recipe_id": r2.id})
+        self.assertEqual(self.counts(r2), (2, 1))
+        client.put("/api/user/recipes", data={"recipe_id": r2.id})
+        client.delete("/api/user/favorite", data={"recipe_id": r2.id})
+        self.assertEqual(self.counts(r2), (1, 0))
+
+        res = client.get("/api/user/recipes")
+        self.assertEqual(res.json()[0]["recipe"]["all_cooked"], 1)
+        self.assertEqual(res.json()[0]["recipe"]["all_favorite"], 0)
+
+    def test_reconcile(self):
+        """The command should fix the counters of rows bypassing signals"""
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        r1 = Recipe.objects.create(title="recipe 1")
+        r2 = Recipe.objects.create(title="recipe 2")
+        UserRecipeHistory.objects.bulk_create(
+            [UserRecipeHistory(user=u1, recipe=r1, cooked=True)]
+        )
+        UserRecipeFavorite.objects.bulk_create([UserRecipeFavorite(user=u1, recipe=r1)])
+        UserRecipeFavorite.objects.create(user=u1, recipe=r2)
+        Recipe.objects.filter(id=r2.id).update(num_cooked=5)
+
+        out = StringIO()
+        call_command("reconcile_recipe_counts", dry_run=True, stdout=out)
+        self.assertIn("2 recipes", out.getvalue())
+        self.assertEqual(self.counts(r1), (0, 0))
+
+        out = StringIO()
+        call_command("reconcile_recipe_counts", stdout=out)
+        self.assertIn("Updated 2 recipes", out.getvalue())
+        self.assertEqual(self.counts(r1), (1, 1))
+        self.assertEqual(self.counts(r2), (0, 1))
+
+        out = StringIO()
+        call_command("reconcile_recipe_counts", stdout=out)
+        self.assertIn("Updated 0 recipes", out.getvalue())
+
+
+class PayloadsTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="testpass")
+        scale = QuantityScaleUnit.objects.create(unit="cup")
+        ings = [Ingredient.objects.create(name=f"ingredient {i}") for i in range(3)]
+        tags = [Tag.objects.create(name=f"tag {i}", category="diet") for i in range(2)]
+        self.recipes = []
+        for i in range(4):
+            r = Recipe.objects.create(
+                title=f"recipe {i}", num_ingredients=i, cook_minute=i * 1.5
+            )
+            for ing in ings[:i]:
+                RecipeIngredient.objects.create(
+                    recipe=r, ingredient=ing, quantity_value="1.5", quantity_scale=scale
+                )
+            for tag in tags[: i % 3]:
+                RecipeTag.objects.create(recipe=r, tag=tag)
+            if i % 2:
+                RecipeNutrition.objects.create(recipe=r, fat_gram_per_serving=2.5)
+            self.recipes.append(r)
+        UserIngredient.objects.create(user=self.user, ingredient=ings[0])
+        for r in self.recipes[1:]:
+            UserRecipeHistory.objects.create(user=self.user, recipe=r, cooked=r.id % 2)
+        UserRecipeFavorite.objects.create(user=self.user, recipe=self.recipes[2])
+
+    def test_same_json_as_serializers(self):
+        """The fast path should render exactly the same JSON as the serializers"""
+        render = JSONRenderer().render
+        ids = [r.id for r in reversed(self.recipes)]
+        for user_id in [None, self.user.id]:
+            self.assertEqual(
+                render(recipe_list(ids, user_id)),
+                render(benchmark_payloads.drf_recipes(ids, user_id)),
+            )
+        self.assertEqual(
+            render(history_list(self.user.id)),
+            render(benchmark_payloads.drf_history(self.user.id)),
+        )
+        self.assertEqual(
+            render(favorite_list(self.user.id)),
+            render(benchmark_payloads.drf_favorites(self.user.id)),
+        )
+
+    def test_stored_and_invalidated(self):
+        """Stored payloads should be used until their recipe changes"""
+        render = JSONRenderer().render
+        ids = [r.id for r in self.recipes]
+
+        def check():
+            self.assertEqual(
+                render(recipe_list(ids, self.user.id)),
+                render(benchmark_payloads.drf_recipes(ids, self.user.id)),
+            )
+
+        check()
+        self.assertEqual(RecipePayload.objects.count(), len(ids))
+        with CaptureQueriesContext(connection) as ctx:
+            check()
+        stored = [q for q in ctx.captured_queries if "api_recipepayload" in q["sql"]]
+        self.assertEqual(len(stored), 1)
+
+        r = self.recipes[3]
+        with self.captureOnCommitCallbacks(execute=True):
+            r.title = "renamed"
+            r.save()
+        # rendered again after commit
+        self.assertIn('"renamed"', RecipePayload.objects.get(recipe=r).static)
+        check()
+
+        # a request rendered the recipe before the change and stores it after
+        stale = RecipePayload.objects.get(recipe=r)
+        with self.captureOnCommitCallbacks(execute=True):
+            nutrition = RecipeNutrition.objects.get(recipe=r)
+            nutrition.calories_kcal_per_serving = 1
+            nutrition.save()
+        RecipePayload.objects.bulk_create([stale], ignore_conflicts=True)
+        check()
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.filter(name="ingredient 0").get().save()
+            ing = Ingredient.objects.get(name="ingredient 1")
+            ing.name = "renamed"
+            ing.save()
+        check()
+        with self.captureOnCommitCallbacks(execute=True):
+            tag = Tag.objects.get(name="tag 0")
+            tag.name = "renamed"
+            tag.save()
+        check()
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.filter(recipe=r).first().delete()
+            RecipeNutrition.objects.get(recipe=r).delete()
+            RecipeTag.objects.create(recipe=r, tag=tag)
+        check()
+        with self.captureOnCommitCallbacks(execute=True):
+            UserIngredient.objects.filter(user=self.user).update(consumed=True)
+            UserIngredient.objects.filter(user=self.user).first().save()
+            UserRecipeFavorite.objects.create(user=self.user, recipe=r)
+        check()
+
+    def test_compact(self):
+        """Compact responses should expand to the full ones and be smaller"""
+
+        def expand(recipe, tables):
+            return {
+                **recipe,
+                "tags": [tables["tags"][str(i)] for i in recipe["tags"]],
+                "ingredients": [
+                    {**i, "ingredient": tables["ingredients"][str(i["ingredient"])]}
+                    for i in recipe["ingredients"]
+                ],
+            }
+
+        client = APIClient()
+        token = client.post(
+            "/api/token",
+            data={"username": "testuser", "password": "testpass"},
+            format="json",
+        ).json()["access"]
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        search = {"mode": "any", "strict": False}
+        for url, data, results in [
+            ("/api/recipes/search", search, lambda data: data),
+            ("/api/user/recipes", {}, lambda data: [h["recipe"] for h in data]),
+            ("/api/user/favorite", {}, lambda data: [f["recipe"] for f in data]),
+        ]:
+            full = client.get(url, data=data)
+            compact = client.get(url, data={**data, "compact": True})
+            self.assertEqual(compact.status_code, 200)
+            tables = compact.json()
+            self.assertEqual(
+                [expand(r, tables) for r in results(tables["results"])],
+                results(full.json()),
+            )
+            if len(results(full.json())) > 1:  # sharing ingredients
+                self.assertLess(len(compact.content), len(full.content))
+
+    def test_fieldsets(self):
+        """Only the requested fields and relations should be queried and returned"""
+        client = APIClient()
+        token = client.post(
+            "/api/token",
+            data={"username": "testuser", "password": "testpass"},
+            format="json",
+        ).json()["access"]
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        search = {"mode": "any", "strict": False}
+        full = client.get("/api/recipes/search", data=search).json()
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = client.get(
+                "/api/recipes/search", data={**search, "fields": "image_url,id,title"}
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json(),
+            [{k: r[k] for k in ["id", "title", "image_url"]} for r in full],
+        )
+        sqls = " ".join(  # but the index sync
+            q["sql"] for q in ctx.captured_queries if "_sync_" not in q["sql"]
+        )
+        for table in ["userrecipehistory", "recipepayload", "recipeingredient"]:
+            self.assertNotIn(f"api_{table}", sqls)
+
+        res = client.get(
+            "/api/recipes/search",
+            data={**search, "fields": "id,tags,ingredients,user_cooked", "expand": ""},
+        )
+        self.assertEqual(
+            res.json(),
+            [
+                {
+                    "id": r["id"],
+                    "tags": [t["id"] for t in r["tags"]],
+                    "ingredients": sorted(
+                        i["ingredient"]["id"] for i in r["ingredients"]
+                    ),
+                    "user_cooked": r["user_cooked"],
+                }
+                for r in full
+            ],
+        )
+        res = client.get(
+            "/api/recipes/search",
+            data={
+                **search,
+                "fields": "ingredients,all_cooked",
+                "expand": "ingredients",
+            },
+        )
+        self.assertEqual(
+            res.json(),
+            [{k: r[k] for k in ["ingredients", "all_cooked"]} for r in full],
+        )
+
+        res = client.get("/api/user/recipes", data={"fields": "title"})
+        self.assertEqual(
+            [h["recipe"] for h in res.json()],
+            [{"title": r.title} for r in reversed(self.recipes[1:])],
+        )
+        for data in [{"fields": "title,x"}, {"expand": "nutrition"}]:
+            res = client.get("/api/recipes/search", data={**search, **data})
+            self.assertEqual(res.status_code, 400)
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command("benchmark_payloads", user="testuser", repeat=1, stdout=out)
+        self.assertIn("4 recipes:", out.getvalue())
+        self.assertIn("history:", out.getvalue())
+
 
 class UsersRecipesHistoryTestCase(TestCase):
     def setUp(self):
@@ -794,6 +1984,125 @@ class UsersRecipesHistoryTestCase(TestCase):
         self.assertEqual(res.json()["deleted"], 1)
 
 
+class UsersExcludedIngredientsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_index.reset()
+        search_cache.clear()
+
+    def setupToken(self, username, password="testpass"):
+        _res = self.client.post(
+            "/api/token",
+            data={"username": username, "password": password},
+            format="json",
+        )
+        token = _res.json()["access"]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def search(self, ingredients, **data):
+        res = self.client.get(
+            "/api/recipes/search",
+            data={"ingredient": ingredients, "mode": "any", "strict": False, **data},
+        )
+        self.assertEqual(res.status_code, 200)
+        return [r["id"] for r in res.json()]
+
+    def test_post_get_delete(self):
+        """Endpoint adds, lists and removes excluded ingredients of a user"""
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+
+        self.setupToken(u1.username)
+        res = self.client.post("/api/user/excluded", data={"ingredient_id": i1.id})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json()["ingredient"], i1.id)
+
+        res = self.client.get("/api/user/excluded")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([e["ingredient"]["id"] for e in res.json()], [i1.id])
+
+        res = self.client.delete("/api/user/excluded", data={"ingredient_id": i1.id})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json()["deleted"], 1)
+
+    def test_search_exclude(self):
+        """Recipes using excluded ingredients should not be found"""
+        u1 = User.objects.create_user(username="user1", password="testpass")
+        i1 = Ingredient.objects.create(name="ingredient 1")
+        i2 = Ingredient.objects.create(name="ingredient 2")
+        i3 = Ingredient.objects.create(name="ingredient 3")
+        r1 = Recipe.objects.create(title="recipe 1")
+        r2 = Recipe.objects.create(title="recipe 2")
+        r3 = Recipe.objects.create(title="recipe 3")
+        RecipeIngredient.objects.create(recipe=r1, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r2, ingredient=i2)
+        RecipeIngredient.objects.create(recipe=r3, ingredient=i1)
+        RecipeIngredient.objects.create(recipe=r3, ingredient=i3)
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                self.client.credentials()
+                self.assertEqual(self.search([i1.id]), [r1.id, r2.id, r3.id])
+                self.assertEqual(self.search([i1.id], exclude=[i2.id]), [r1.id, r3.id])
+                self.assertEqual(self.search([i1.id], exclude=[i2.id, i3.id]), [r1.id])
+
+                # persisted exclusions apply to every search of the user
+                self.setupToken(u1.username)
+                self.client.post("/api/user/excluded", data={"ingredient_id": i3.id})
+                self.assertEqual(self.search([i1.id]), [r1.id, r2.id])
+                self.assertEqual(self.search([i1.id], exclude=[i2.id]), [r1.id])
+                self.client.delete("/api/user/excluded", data={"ingredient_id": i3.id})
+                self.assertEqual(self.search([i1.id]), [r1.id, r2.id, r3.id])
+
+                # also when added by another instance (no signal in this process)
+                UserExcludedIngredient.objects.bulk_create(
+                    [UserExcludedIngredient(user=u1, ingredient=i2)]
+                )
+                self.assertEqual(self.search([i1.id]), [r1.id, r3.id])
+                UserExcludedIngredient.objects.filter(user=u1).delete()
+
+
+class UsersRecommendationsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def setupToken(self, username, password="testpass"):
+        _res = self.client.post(
+            "/api/token",
+            data={"username": username, "password": password},
+            format="json",
+        )
+        token = _res.json()["access"]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+
+    def test_recommendations(self):
+        """Recipes liked by users with similar interactions should be recommended"""
+        u1, u2, u3 = [
+            User.objects.create_user(username=f"user{i}", password="testpass")
+            for i in range(3)
+        ]
+        r1, r2, r3, r4 = [Recipe.objects.create(title=f"recipe {i}") for i in range(4)]
+        for u in [u1, u2]:
+            UserRecipeHistory.objects.create(user=u, recipe=r1, cooked=True)
+            UserRecipeFavorite.objects.create(user=u, recipe=r2)
+        UserRecipeHistory.objects.create(user=u2, recipe=r3)
+        UserRecipeHistory.objects.create(user=u3, recipe=r4)
+        UserRecipeHistory.objects.create(user=u3, recipe=r1)
+
+        self.setupToken(u3.username)
+        res = self.client.get("/api/user/recommendations")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.json(), [])  # not built yet
+
+        call_command("build_recommendations", stdout=StringIO())
+        res = self.client.get("/api/user/recommendations")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r["id"] for r in res.json()], [r2.id, r3.id])
+        res = self.client.get("/api/user/recommendations", data={"limit": 1})
+        self.assertEqual([r["id"] for r in res.json()], [r2.id])
+
+
 class UsersStatisticsTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
@@ -889,6 +2198,7 @@ class UsersFavoriteRecipesTestCase(TestCase):
 class RandomRecipeTestCase(TestCase):
     def setUp(self):
         self.client = APIClient()
+        recipe_index.reset()
 
     def test_get_random_recipe(self):
         """Return a random recipe"""
@@ -899,3 +2209,247 @@ class RandomRecipeTestCase(TestCase):
         res = self.client.get("/api/recipes/random")
         self.assertEqual(res.status_code, 200)
         self.assertTrue(res.json()["id"] in [r1.id, r2.id])
+
+    def test_get_random_recipes(self):
+        """Return distinct random recipes passing the filters, unseen by the user"""
+        u = User.objects.create_user(username="user1", password="testpass")
+        t1 = Tag.objects.create(name="dinner", category="meal")
+        recipes = []
+        for i in range(6):
+            r = Recipe.objects.create(
+                title=f"recipe {i}", language="en" if i < 4 else "es"
+            )
+            if i % 2 == 0:
+                RecipeTag.objects.create(recipe=r, tag=t1)
+            recipes.append(r.id)
+        UserRecipeHistory.objects.create(user=u, recipe_id=recipes[0])
+        res = self.client.post(
+            "/api/token",
+            data={"username": "user1", "password": "testpass"},
+            format="json",
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {res.json()['access']}")
+
+        for use_index in [True, False]:
+            with override_settings(RECIPE_SEARCH_INDEX=use_index):
+                res = self.client.get("/api/recipes/random", data={"n": 10})
+                self.assertEqual(res.status_code, 200)
+                ids = [r["id"] for r in res.json()]
+                self.assertEqual(len(ids), len(set(ids)))
+                self.assertEqual(sorted(ids), recipes)
+
+                res = self.client.get(
+                    "/api/recipes/random",
+                    data={
+                        "n": 3,
+                        "language": "en",
+                        "tag": "meal::dinner",
+                        "unseen": "true",
+                    },
+                )
+                self.assertEqual(res.status_code, 200)
+                self.assertEqual([r["id"] for r in res.json()], [recipes[2]])
+
+                res = self.client.get(
+                    "/api/recipes/random", data={"language": "ja", "fields": "id"}
+                )
+                self.assertEqual(res.status_code, 404)
+
+        res = self.client.get("/api/recipes/random", data={"n": 0})
+        self.assertEqual(res.status_code, 400)
+        res = APIClient().get("/api/recipes/random", data={"unseen": "true"})
+        self.assertEqual(res.status_code, 401)
+
+    @override_settings(RECIPE_SEARCH_INDEX=False)
+    def test_get_random_recipes_rare_tag(self):
+        """The DB should find all the recipes of a tag clustered in the ids"""
+        t1 = Tag.objects.create(name="rare", category="meal")
+        recipes = Recipe.objects.bulk_create(
+            [Recipe(title=f"recipe {i}") for i in range(200)]
+        )
+        # just before a large gap, so that most draws land past them
+        rare = [r.id for r in recipes[:3]]
+        RecipeTag.objects.bulk_create([RecipeTag(recipe_id=i, tag=t1) for i in rare])
+        Recipe.objects.filter(id__in=[r.id for r in recipes[3:-1]]).delete()
+
+        for _ in range(5):
+            res = self.client.get(
+                "/api/recipes/random", data={"n": 3, "tag": "meal::rare"}
+            )
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(sorted(r["id"] for r in res.json()), rare)
+
+
+class RecipesStatisticsTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_get_statistics(self):
+        """Endpoint serves the top lists as of the last refresh"""
+        users = [
+            User.objects.create_user(username=f"user{i}", password="testpass")
+            for i in range(3)
+        ]
+        recipes = [Recipe.objects.create(title=f"recipe {i}") for i in range(3)]
+        for i, u in enumerate(users):
+            for r in recipes[: i + 1]:  # recipe 0 is viewed the most
+                UserRecipeHistory.objects.create(user=u, recipe=r, cooked=i == 2)
+            UserRecipeFavorite.objects.create(user=u, recipe=recipes[2])
+
+        res = self.client.get("/api/recipes/statistics")
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            res.json(),
+            {
+                "most_cooked": [],
+                "most_liked": [],
+                "most_viewed": [],
+                "computed_at": None,
+            },
+        )
+
+        call_command("refresh_statistics", stdout=StringIO())
+        UserRecipeFavorite.objects.all().delete()  # not seen until the next refresh
+        with self.assertNumQueries(2):  # the rankings and the recipes
+            res = self.client.get(
+                "/api/recipes/statistics", data={"fields": "id,all_cooked"}
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("public", res["Cache-Control"])
+        self.assertIn("max-age=", res["Cache-Control"])
+        ids = [r.id for r in recipes]
+        body = res.json()
+        self.assertEqual(
+            [(r["id"], r["count"]) for r in body["most_cooked"]],
+            [(ids[0], 1), (ids[1], 1), (ids[2], 1)],
+        )
+        self.assertEqual(
+            body["most_cooked"][0], {"id": ids[0], "all_cooked": 1, "count": 1}
+        )
+        self.assertEqual(
+            [(r["id"], r["count"]) for r in body["most_liked"]], [(ids[2], 3)]
+        )
+        self.assertEqual(
+            [(r["id"], r["count"]) for r in body["most_viewed"]],
+            [(ids[0], 3), (ids[1], 2), (ids[2], 1)],
+        )
+
+        res = self.client.get(
+            "/api/recipes/statistics", HTTP_IF_MODIFIED_SINCE=res["Last-Modified"]
+        )
+        self.assertEqual(res.status_code, 304)
+
+        call_command("refresh_statistics", top=1, stdout=StringIO())
+        body = self.client.get("/api/recipes/statistics").json()
+        self.assertEqual(body["most_liked"], [])
+        self.assertEqual(len(body["most_viewed"]), 1)
+
+
+class RecipesTrendingTestCase(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        recipe_trends.reset()
+
+    def test_decayed_counts(self):
+        """Counts should halve every half-life and stay within the capacity"""
+        counts = DecayedCounts(capacity=2, half_life=10)
+        counts.add(1, 0)
+        counts.add(1, 0)
+        counts.add(2, 10)
+        self.assertEqual(counts.top(2, 10), [(1, 1.0), (2, 1.0)])
+        counts.add(3, 40)  # replaces the lowest, inheriting its count
+        self.assertEqual(counts.top(2, 40), [(3, 1.125), (2, 0.125)])
+        self.assertEqual(counts.top(1, 50), [(3, 0.5625)])
+
+        other = DecayedCounts(capacity=2, half_life=10)
+        other.add(4, 50)
+        other.add(4, 50)
+        counts.merge(other)
+        self.assertEqual(counts.top(3, 50), [(4, 2.0), (3, 0.5625)])
+
+    def test_decayed_counts_eviction(self):
+        """The lowest current count should be replaced, not a former one"""
+        counts = DecayedCounts(capacity=2, half_life=1000)
+        for recipe_id in [1, 1, 1, 2, 3]:  # 3 replaces 2
+            counts.add(recipe_id, 0)
+        self.assertEqual(counts.top(2, 0), [(1, 3.0), (3, 2.0)])
+        counts.add(3, 0)
+        counts.add(3, 0)
+        counts.add(5, 0)  # replaces 1, no longer 3
+        self.assertEqual(counts.top(2, 0), [(3, 4.0), (5, 4.0)])
+
+    def test_get_trending(self):
+        """Endpoint serves the most viewed recipes lately without the history"""
+        users = [
+            User.objects.create_user(username=f"user{i}", password="testpass")
+            for i in range(3)
+        ]
+        recipes = [Recipe.objects.create(title=f"recipe {i}") for i in range(3)]
+        with self.captureOnCommitCallbacks(execute=True):
+            for i, u in enumerate(users):
+                for r in recipes[: i + 1]:  # recipe 0 is viewed the most
+                    UserRecipeHistory.objects.create(user=u, recipe=r)
+
+        with CaptureQueriesContext(connection) as ctx:
+            res = self.client.get(
+                "/api/recipes/trending", data={"fields": "id", "limit": 2}
+            )
+        self.assertEqual(res.status_code, 200)
+        ids = [r.id for r in recipes]
+        self.assertEqual([r["id"] for r in res.json()], ids[:2])
+        self.assertAlmostEqual(res.json()[0]["score"], 3.0, places=3)
+        sqls = " ".join(q["sql"] for q in ctx.captured_queries)
+        self.assertNotIn("api_userrecipehistory", sqls)
+
+        # another worker sees the views once checkpointed
+        recipe_trends.checkpoint()
+        other = RecipeTrendsTracker()
+        self.assertEqual([i for i, _ in other.top(3)], ids)
+
+        res = self.client.get("/api/recipes/trending", data={"limit": 0})
+        self.assertEqual(res.status_code, 400)
+
+    def test_checkpoint_failure(self):
+        """A failed checkpoint should be logged and keep the views for the next"""
+        u = User.objects.create_user(username="user1", password="testpass")
+        r1 = Recipe.objects.create(title="recipe 1")
+        client = APIClient()
+        res = client.post(
+            "/api/token",
+            data={"username": "user1", "password": "testpass"},
+            format="json",
+        )
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {res.json()['access']}")
+
+        failure = DatabaseError("could not obtain lock")
+        with mock.patch("api.trending.locked_checkpoint", side_effect=failure):
+            with self.assertLogs("api.trending", "ERROR"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    res = client.post("/api/user/recipes", data={"recipe_id": r1.id})
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual([i for i, _ in recipe_trends.top()], [r1.id])
+        self.assertTrue(UserRecipeHistory.objects.filter(user=u).exists())
+
+        recipe_trends.checkpoint()
+        self.assertEqual([i for i, _ in RecipeTrendsTracker().top()], [r1.id])
+
+    def test_rebuild(self):
+        """The command should recompute the trends from the history"""
+        u = User.objects.create_user(username="user1", password="testpass")
+        r1 = Recipe.objects.create(title="recipe 1")
+        r2 = Recipe.objects.create(title="recipe 2")
+        UserRecipeHistory.objects.bulk_create(
+            [
+                UserRecipeHistory(user=u, recipe=r1),
+                UserRecipeHistory(user=u, recipe=r2),
+                UserRecipeHistory(user=u, recipe=r2),
+            ]
+        )
+        self.assertEqual(self.client.get("/api/recipes/trending").json(), [])
+
+        out = StringIO()
+        call_command("rebuild_trending", stdout=out)
+        self.assertIn("Rebuilt trends of 2 recipes", out.getvalue())
+        recipe_trends.reset()
+        res = self.client.get("/api/recipes/trending", data={"fields": "id"})
+        self.assertEqual([r["id"] for r in res.json()], [r2.id, r1.id])
@@ -0,0 +1,234 @@
+"""
+Trending recipes by exponentially decayed view counts.
+
+Every history write (a view at `UserRecipeHistory.access_date`) adds 1 to the
+count of its recipe and all counts halve every `HALF_LIFE_SECONDS`, so a score
+is about the views of the last few days. Only the `CAPACITY` highest counts
+are kept (Space-Saving: a new recipe replaces the lowest one and inherits its
+count), which bounds the memory whatever the traffic and number of recipes.
+
+Like `search_index.recipe_index`, each worker keeps its own `recipe_trends`:
+the views it recorded since its last checkpoint, and the counts of all workers
+as of that checkpoint. Every `CHECKPOINT_SECONDS` (on the next view or read) it
+merges its views into the single `RecipeTrends` row under a row lock and
+reloads the result, so `recipes/trending` never reads the history table. The
+database is accessed outside of the worker's lock, and a failed checkpoint is
+logged and retried with the next one. Views not checkpointed yet when a worker
+stops are lost; `manage.py rebuild_trending` recomputes the checkpoint from the
+history (from the last access of each user to each recipe only).
+"""
+
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .models import RecipeTrends, UserRecipeHistory
+
+logger = logging.getLogger(__name__)
+
+HALF_LIFE_SECONDS = 2 * 24 * 60 * 60
+CAPACITY = 1000
+CHECKPOINT_SECONDS = 60
+
+# history older than this many half-lives is ignored by `rebuild`
+REBUILD_HALF_LIVES = 10
+
+
+class DecayedCounts:
+    """
+    At most `capacity` decayed counts, stored as of the timestamp `as_of` and
+    only decayed once per half-life, so that adding a view is O(log capacity)
+    amortized, including when it replaces the lowest count.
+    """
+
+    def __init__(self, capacity=CAPACITY, half_life=HALF_LIFE_SECONDS):
+        self.capacity = capacity
+        self.half_life = half_life
+        self.counts = {}  # recipe id -> count at `as_of`
+        self.as_of = None
+        # min-heap of (count, recipe id), where entries whose count is not the
+        # current one are stale; None until needed, or after rescaling all
+        self.heap = None
+
+    @classmethod
+    def load(cls, checkpoint):
+        counts = cls()
+        counts.counts = dict(zip(checkpoint.recipe_ids, checkpoint.scores))
+        counts.as_of = checkpoint.as_of.timestamp()
+        return counts
+
+    def save(self, checkpoint):
+        checkpoint.recipe_ids = list(self.counts)
+        checkpoint.scores = list(self.counts.values())
+        checkpoint.as_of = datetime.fromtimestamp(self.as_of, dt_timezone.utc)
+        checkpoint.save()
+
+    def copy(self):
+        copied = DecayedCounts(self.capacity, self.half_life)
+        copied.counts, copied.as_of = dict(self.counts), self.as_of
+        return copied
+
+    def factor(self, at):
+        """multiplier of the counts from `as_of` to the timestamp `at`"""
+        return 0.5 ** ((at - self.as_of) / self.half_life)
+
+    def decay_to(self, at):
+        if self.as_of is not None:
+            factor = self.factor(at)
+            self.counts = {i: count * factor for i, count in self.counts.items()}
+            self.heap = None
+        self.as_of = at
+
+    def pop_lowest(self):
+        """remove the lowest count, returning it"""
+        if self.heap is None or len(self.heap) > 2 * self.capacity:
+            self.heap = [(count, i) for i, count in self.counts.items()]
+            heapq.heapify(self.heap)
+        while True:
+            count, recipe_id = heapq.heappop(self.heap)
+            if self.counts.get(recipe_id) == count:
+                return self.counts.pop(recipe_id)
+
+    def add(self, recipe_id, at, weight=1.0):
+        """count a view of the recipe at the timestamp `at`"""
+        if self.as_of is None or at - self.as_of > self.half_life:
+            self.decay_to(at)  # keeps the relative weights of new views below 2
+        weight /= self.factor(at)
+        if recipe_id not in self.counts and len(self.counts) >= self.capacity:
+            weight += self.pop_lowest()
+        count = self.counts[recipe_id] = self.counts.get(recipe_id, 0.0) + weight
+        if self.heap is not None:
+            heapq.heappush(self.heap, (count, recipe_id))
+
+    def merge(self, other):
+        """add the counts of `other`, keeping the `capacity` highest"""
+        if other.as_of is None:
+            return
+        self.decay_to(
+            other.as_of if self.as_of is None else max(self.as_of, other.as_of)
+        )
+        factor = other.factor(self.as_of)
+        for recipe_id, count in other.counts.items():
+            self.counts[recipe_id] = self.counts.get(recipe_id, 0.0) + count * factor
+        self.heap = None
+        if len(self.counts) > self.capacity:
+            self.counts = dict(
+                heapq.nlargest(self.capacity, self.counts.items(), key=lambda c: c[1])
+            )
+
+    def top(self, n, at):
+        """[(recipe id, count at the timestamp `at`)] of the highest, ties by id"""
+        if self.as_of is None:
+            return []
+        factor = self.factor(at)
+        best = heapq.nsmallest(n, self.counts.items(), key=lambda c: (-c[1], c[0]))
+        return [(recipe_id, count * factor) for recipe_id, count in best]
+
+
+def locked_checkpoint():
+    """the single `RecipeTrends`, created empty if missing, locked until commit"""
+    checkpoint, _ = RecipeTrends.objects.select_for_update().get_or_create(
+        id=1, defaults={"recipe_ids": [], "scores": [], "as_of": timezone.now()}
+    )
+    return checkpoint
+
+
+class RecipeTrendsTracker:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """drop everything; the checkpoint is reloaded on the next access"""
+        with self._lock:
+            self.pending = DecayedCounts()  # views recorded since the checkpoint
+            self.saving = DecayedCounts()  # views being merged into it
+            self.merged = DecayedCounts()  # views of all workers until then
+            self.checkpointing = False
+            self.checkpointed_at = None
+
+    def checkpoint(self):
+        """merge the pending views into `RecipeTrends` and reload it"""
+        with self._lock:
+            if self.checkpointing:
+                return  # by another thread
+            self.checkpointing = True
+            saving = self.saving = self.pending
+            self.pending = DecayedCounts()
+            self.checkpointed_at = time.monotonic()
+        merged = None
+        try:
+            with transaction.atomic():
+                checkpoint = locked_checkpoint()
+                loaded = DecayedCounts.load(checkpoint)
+                if saving.as_of is not None:
+                    loaded.merge(saving)
+                    loaded.save(checkpoint)
+            merged = loaded
+        except DatabaseError:
+            logger.exception("Failed to checkpoint the trending recipes")
+        finally:
+            with self._lock:
+                if merged is None:  # kept for the next checkpoint
+                    self.pending.merge(saving)
+                else:
+                    self.merged = merged
+                self.saving = DecayedCounts()
+                self.checkpointing = False
+
+    def ensure_fresh(self):
+        with self._lock:
+            fresh = (
+                self.checkpointed_at is not None
+                and time.monotonic() - self.checkpointed_at <= CHECKPOINT_SECONDS
+            )
+        if not fresh:
+            self.checkpoint()
+
+    def record(self, recipe_id, at):
+        """count a view of the recipe at the datetime `at`"""
+        with self._lock:
+            self.pending.add(recipe_id, at.timestamp())
+        self.ensure_fresh()
+
+    def top(self, n=10):
+        """
+        Returns [(recipe id, score)] of the `n` recipes with the most decayed
+        views now, the highest first.
+        """
+        self.ensure_fresh()
+        with self._lock:
+            counts = self.merged.copy()
+            counts.merge(self.saving)
+            counts.merge(self.pending)
+        return counts.top(n, timezone.now().timestamp())
+
+
+def rebuild():
+    """
+    Replace `RecipeTrends` by the decayed counts of the history, returning
+    the number of recipes kept.
+    """
+    now = timezone.now()
+    since = now - timedelta(seconds=HALF_LIFE_SECONDS * REBUILD_HALF_LIVES)
+    counts = DecayedCounts()
+    history = (
+        UserRecipeHistory.objects.filter(access_date__gte=since, access_date__lte=now)
+        .order_by("access_date")
+        .values_list("recipe_id", "access_date")
+    )
+    for recipe_id, access_date in history.iterator():
+        counts.add(recipe_id, access_date.timestamp())
+    counts.decay_to(now.timestamp())
+    with transaction.atomic():
+        counts.save(locked_checkpoint())
+    return len(counts.counts)
+
+
+recipe_trends = RecipeTrendsTracker()
@@ -8,11 +8,15 @@ from . import views
 urlpatterns = [
     # recipes/
     path("recipes/search", views.SearchRecipe.as_view()),
+    path("recipes/search/batch", views.SearchRecipeBatch.as_view()),
     path("recipes/statistics", views.RecipesStatistics.as_view()),
+    path("recipes/trending", views.RecipesTrending.as_view()),
     path("recipes/random", views.RecipesRandom.as_view()),
+    path("recipes/<int:pk>/similar", views.RecipesSimilar.as_view()),
     # ingredients/
     path("ingredients", views.Ingredients.as_view()),
     path("ingredients/search", views.SearchIngredient.as_view()),
+    path("ingredients/autocomplete", views.IngredientsAutocomplete.as_view()),
     path("ingredients/statistics", views.IngredientsStatistics.as_view()),
     # units/
     path("units", views.Units.as_view({"get": "list", "post": "create"})),
@@ -21,7 +25,9 @@ urlpatterns = [
     path("user/ingredients", views.UsersIngredients.as_view()),
     path("user/recipes", views.UsersRecipesHistory.as_view()),
     path("user/favorite", views.UsersFavoriteRecipes.as_view()),
+    path("user/excluded", views.UsersExcludedIngredients.as_view()),
     path("user/stats", views.UsersStatistics.as_view()),
+    path("user/recommendations", views.UsersRecommendations.as_view()),
     # token/
     path("token", views.CustomTokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("token/refresh", TokenRefreshView.as_view(), name="token_refresh"),
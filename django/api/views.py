@@ -2,28 +2,43 @@ import random
 from datetime import datetime
 
 from rest_framework import status
-from rest_framework.exceptions import ParseError
+from rest_framework.exceptions import NotAuthenticated, ParseError
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.db.models import (
     BooleanField,
+    Case,
     Count,
     Exists,
     F,
+    FloatField,
+    Func,
+    IntegerField,
+    Max,
+    Min,
     OuterRef,
     Prefetch,
     Q,
     Value,
+    When,
 )
+from django.db.models.functions import Cast, Length
 from django.db.utils import IntegrityError
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 
+from .autocomplete import ingredient_autocomplete
+from .inventory import expiry_weights, user_exclusions, user_inventory
+from .minhash import similar_recipes
 from .models import (
     Ingredient,
     QuantityScaleUnit,
@@ -33,24 +48,50 @@ from .models import (
     RecipeTag,
     Tag,
     User,
+    UserExcludedIngredient,
     UserIngredient,
     UserRecipeFavorite,
     UserRecipeHistory,
 )
+from .payloads import (
+    EXPANDABLE,
+    RECIPE_KEYS,
+    compact_tables,
+    favorite_list,
+    history_list,
+    recipe_list,
+    recipe_payloads,
+)
+from .querysets import TEXT_SEARCH_CONFIG
+from .recommendations import recommend
+from .rollups import ingredient_rankings, rankings
+from .search_cache import search_cache, search_version
+from .search_index import (
+    MAX_LIMIT,
+    MAX_SAMPLING_ROUNDS,
+    RANGES,
+    RANKINGS,
+    decode_cursor,
+    encode_cursor,
+    keyset_filter,
+    recipe_index,
+    sort_keys,
+)
 from .serializers import (
     CustomTokenObtainPairSerializer,
     IngredientSerializer,
     QuantityScaleUnitSerializer,
     RecipeIngredientSerializer,
     RecipeNutritionSerializer,
-    RecipeSerializer,
     RecipeTagSerializer,
     TagSerializer,
+    UserExcludedIngredientSerializer,
     UserIngredientSerializer,
     UserRecipeFavoriteSerializer,
     UserRecipeHistorySerializer,
     UserSerializer,
 )
+from .trending import recipe_trends
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
@@ -132,24 +173,28 @@ class UsersIngredients(APIView):
         """
         try:
             data = request.data
-            user_ingredient = UserIngredient.objects.get(id=data["user_ingredient_id"])
-            user_ingredient.user = User.objects.get(id=request.auth["user_id"])
-            for key in ["quantity_value", "consumed", "storage", "happiness"]:
-                if key in data:
-                    setattr(user_ingredient, key, data[key])
-            if "ingredient_id" in data:
-                user_ingredient.ingredient = Ingredient.objects.get(
-                    id=data["ingredient_id"]
-                )
-            if "quantity_scale_unit_id" in data:
-                user_ingredient.quantity_scale = QuantityScaleUnit.objects.get(
-                    id=data["quantity_scale_unit_id"]
-                )
-            if "expiration_date" in data:
-                user_ingredient.expiration_date = datetime.fromisoformat(
-                    data["expiration_date"].replace("Z", "+00:00")
+            # locked so that concurrent edits update the ingredient usage once
+            with transaction.atomic():
+                user_ingredient = UserIngredient.objects.select_for_update().get(
+                    id=data["user_ingredient_id"]
                 )
-            user_ingredient.save()
+                user_ingredient.user = User.objects.get(id=request.auth["user_id"])
+                for key in ["quantity_value", "consumed", "storage", "happiness"]:
+                    if key in data:
+                        setattr(user_ingredient, key, data[key])
+                if "ingredient_id" in data:
+                    user_ingredient.ingredient = Ingredient.objects.get(
+                        id=data["ingredient_id"]
+                    )
+                if "quantity_scale_unit_id" in data:
+                    user_ingredient.quantity_scale = QuantityScaleUnit.objects.get(
+                        id=data["quantity_scale_unit_id"]
+                    )
+                if "expiration_date" in data:
+                    user_ingredient.expiration_date = datetime.fromisoformat(
+                        data["expiration_date"].replace("Z", "+00:00")
+                    )
+                user_ingredient.save()
             return Response(
                 {
                     **UserIngredientSerializer(user_ingredient).data,
@@ -175,27 +220,119 @@ class Ingredients(APIView):
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
 
 
+class IngredientsAutocomplete(APIView):
+    def get(self, request, format=None):
+        """
+        Get ingredients with a word starting with `prefix`, the most used first.
+        """
+        try:
+            limit = int(request.query_params.get("limit", 10))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            results = ingredient_autocomplete.complete(
+                request.query_params.get("prefix", ""), limit
+            )
+            return Response(
+                [
+                    {"id": ingredient_id, "name": name, "num_recipes": num_recipes}
+                    for ingredient_id, name, num_recipes in results
+                ],
+                status=status.HTTP_200_OK,
+            )
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+SIMILAR_INGREDIENTS_LIMIT = 20
+
+
 class SearchIngredient(APIView):
     def get(self, request, format=None):
         """
         Get a list of ingredients matched with the search criteria.
         """
         user_id = request.auth["user_id"] if request.auth else None
-        allowed_queries = {"icontains"}
+        allowed_queries = {"icontains", "similar", "limit"}
         if set(request.query_params).difference(allowed_queries):
             return Response(
                 [], status=status.HTTP_400_BAD_REQUEST
             )  # contains invalid queries
 
-        ings = Ingredient.objects.annotate_all(user_id).filter(
-            name__icontains=request.query_params.get("icontains", "")
-        )
+        ings = Ingredient.objects.annotate_all(user_id)
+        if "similar" in request.query_params:  # typo tolerant, most similar first
+            ings = ings.similar(request.query_params["similar"])
+            limit = request.query_params.get("limit", SIMILAR_INGREDIENTS_LIMIT)
+        else:  # both served by the trigram index on names
+            ings = ings.filter(
+                name__icontains=request.query_params.get("icontains", "")
+            ).order_by(Length("name"), "name")
+            limit = request.query_params.get("limit")
+        if limit is not None:
+            try:
+                limit = int(limit)
+                if not 0 < limit <= MAX_LIMIT:
+                    raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            except ValueError:
+                return Response([], status=status.HTTP_400_BAD_REQUEST)
+            ings = ings[:limit]
         return Response(
             IngredientSerializer(ings, many=True).data,
             status=status.HTTP_200_OK,
         )
 
 
+MAX_BATCH_QUERIES = 50
+
+
+def sort_value(value, descending):
+    """key sorting values like PostgreSQL, where NULL is greater than any value"""
+    if value is None:
+        return (not descending, 0)
+    return (descending, -value if descending else value)
+
+
+def parse_tags(values):
+    """{category: names} from "category::name" strings"""
+    tags = {}
+    for tag in values:
+        category, _, name = tag.partition("::")
+        if not category or not name:
+            raise ParseError(f"invalid tag: {tag}")
+        tags.setdefault(category, set()).add(name)
+    return tags
+
+
+def parse_fieldsets(params):
+    """
+    `fields` of recipes and relations to `expand` (comma-separated or lists),
+    None if not given
+    """
+    fieldsets = []
+    for name, known in [("fields", RECIPE_KEYS), ("expand", EXPANDABLE)]:
+        names = params.get(name)
+        if isinstance(names, str):
+            names = [n for n in names.split(",") if n]
+        unknown = set(names or ()) - set(known)
+        if unknown:
+            raise ParseError(f"unknown {name}: {', '.join(sorted(unknown))}")
+        fieldsets.append(names)
+    return fieldsets
+
+
+def parse_ranges(params):
+    """{name in RANGES: (min or None, max or None)} from min_/max_ parameters"""
+    ranges = {}
+    for name in RANGES:
+        low = params.get(f"min_{name}")
+        high = params.get(f"max_{name}")
+        if low is not None or high is not None:
+            ranges[name] = (
+                None if low is None else float(low),
+                None if high is None else float(high),
+            )
+    return ranges
+
+
 class SearchRecipe(APIView):
     def get(self, request, format=None):
         """
@@ -205,40 +342,415 @@ class SearchRecipe(APIView):
         ingredient_list = request.query_params.getlist("ingredient")
         mode_selection = request.query_params.get("mode").lower()
         strict_filter = request.query_params.get("strict").lower() == "true"
+        # keywords matched against the titles and tags of recipes
+        text = request.query_params.get("q", "").strip()
+        default_order = "relevance" if text else "bm"
+
+        if mode_selection == "fridge":  # use what the user has in storage
+            if user_id is None:
+                raise NotAuthenticated()
+            ingredient_list = [*ingredient_list, *user_inventory(user_id)]
+            mode_selection = "any"
+            default_order = "coverage"
+        order = request.query_params.get("order", default_order).lower()
+        if order == "expiry" and user_id is None:  # weighted by the user's copies
+            raise NotAuthenticated()
+
+        language = request.query_params.get("language")
+        exclude = request.query_params.getlist("exclude")
+        if user_id is not None:  # e.g. allergens
+            exclude = [*exclude, *user_exclusions(user_id)]
+        # recipes with any of the given tags ("category::name") of every category
+        tags = parse_tags(request.query_params.getlist("tag"))
+        with_facets = request.query_params.get("facets", "false").lower() == "true"
+        # recipes referencing ingredients and tags by id, listed once aside
+        compact = request.query_params.get("compact", "false").lower() == "true"
+        fields, expand = parse_fieldsets(request.query_params)
+        # paginated by `limit` and `cursor` (returned as `next`) if either is given
+        paginate = {"limit", "cursor"}.intersection(request.query_params)
 
-        res = Recipe.objects
         try:
-            res = res.annotate(c=Count("ingredients", distinct=True))
-            if strict_filter:
-                res = res.filter(num_ingredients=F("c"))
-            if len(ingredient_list) > 0:
-                if mode_selection == "exact":
-                    if strict_filter:
-                        res = res.filter(c=len(ingredient_list))
-                    for ing in ingredient_list:
-                        res = res.filter(ingredients=ing)
-                elif mode_selection == "any":
-                    res = res.filter(ingredients__in=ingredient_list)
-                    if strict_filter:
-                        exc_items = Ingredient.objects.exclude(id__in=ingredient_list)
-                        res = res.exclude(ingredients__in=exc_items)
+            ranges = parse_ranges(request.query_params)
+            limit, after_key, as_of, weights = self.parse_page(
+                request.query_params, order, text, user_id
+            )
+
+            # first select the ids of the page, then hydrate only those
+            args = [int(ing) for ing in ingredient_list], mode_selection, strict_filter
+            filters = {
+                "language": language,
+                "exclude": {int(ing) for ing in exclude},
+                "tags": tags,
+                "ranges": ranges,
+            }
+            if settings.RECIPE_SEARCH_INDEX and not text:
+                search_ids, search_facets = recipe_index.search, recipe_index.facets
+            else:  # the index has no text, the DB combines both in one query
+                search_ids, search_facets = self.search_ids_db, self.facets_db
+                filters["text"] = text
+            version = search_version()  # once for the page and its facets
+            ids, last_key = search_cache.search(
+                search_ids,
+                *args,
+                version=version,
+                limit=limit,
+                order=order,
+                weights=weights,
+                after_key=after_key,
+                **filters,
+            )
+            tables = compact_tables() if compact else None
+            data = recipe_list(ids, user_id, tables, fields, expand)
+            if paginate or with_facets or compact:
+                data = self.page(data, tables, last_key and (order, last_key, as_of))
+            if with_facets:  # counted over all the matched recipes
+                data["facets"] = search_cache.search(
+                    search_facets, *args, version=version, **filters
+                )
+            return Response(data, status=status.HTTP_200_OK)
+        except Exception as e:
+            print(e)
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    @staticmethod
+    def parse_page(params, order, text, user_id):
+        """
+        (limit, sort key the page starts after or None, timestamp of the
+        weights or None, weights of the expiry order or None) of the page
+        """
+        if order not in RANKINGS:
+            raise ValueError(f"unknown order: {order}")
+        if order == "relevance" and not text:
+            raise ValueError("order relevance requires q")
+        limit = int(params.get("limit", 30))
+        if not 0 < limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+        after_key, as_of = None, None
+        if "cursor" in params:
+            after_key, as_of = decode_cursor(params["cursor"], order)
+        weights = None
+        if order == "expiry":  # weight by how soon the user's copies expire
+            as_of = as_of or timezone.now().timestamp()
+            weights = expiry_weights(user_id, as_of)
+        return limit, after_key, as_of, weights
+
+    @staticmethod
+    def page(results, tables=None, cursor=None):
+        """
+        page of the `results`, with the side `tables` of the compact format and
+        the `next` cursor encoded from (order, last sort key, timestamp) if any
+        """
+        return {
+            "next": cursor and encode_cursor(*cursor),
+            "results": results,
+            **(tables or {}),
+        }
+
+    @classmethod
+    def search_ids_db(
+        cls,
+        ingredient_list,
+        mode_selection,
+        strict_filter,
+        limit=30,
+        order="bm",
+        weights=None,
+        after_key=None,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+        text="",
+    ):
+        """
+        Same as `recipe_index.search`, but by a lean query on the DB, which
+        can also match `text` (see `search_db`)
+        """
+        res = cls.search_db(
+            ingredient_list, mode_selection, strict_filter, order, weights, text
+        )
+        res = cls.filter_db(res, language, exclude, tags, ranges)
+        if after_key is not None:
+            res = res.filter(keyset_filter(order, after_key))
+        keys = list(
+            res.values_list(*[name for name, _ in sort_keys(order)])[: limit + 1]
+        )
+        last_key = None
+        if len(keys) > limit:
+            keys = keys[:limit]
+            last_key = list(keys[-1])
+        return [key[-1] for key in keys], last_key
+
+    @classmethod
+    def search_many_db(
+        cls,
+        queries,
+        limit=30,
+        order="bm",
+        weights=None,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+    ):
+        """
+        Same as `search_ids_db` (first pages) for each (ingredients, mode,
+        strict) of `queries`, in one UNION ALL query
+        """
+        spec = sort_keys(order)
+        pages = []
+        for i, (ingredient_list, mode_selection, strict_filter) in enumerate(queries):
+            res = cls.search_db(
+                ingredient_list, mode_selection, strict_filter, order, weights
+            )
+            res = cls.filter_db(res, language, exclude, tags, ranges)
+            res = res.annotate(query=Value(i, output_field=IntegerField()))
+            keys = res.values_list("query", *[name for name, _ in spec])
+            pages.append(keys[: limit + 1])
+        results = [[] for _ in queries]
+        for query, *key in pages[0].union(*pages[1:], all=True) if pages else []:
+            results[query].append(key)
+        for i, keys in enumerate(results):  # UNION ALL keeps no order
+            keys.sort(
+                key=lambda k: [sort_value(v, desc) for (_, desc), v in zip(spec, k)]
+            )
+            last_key = list(keys[limit - 1]) if len(keys) > limit else None
+            results[i] = [key[-1] for key in keys[:limit]], last_key
+        return results
+
+    @classmethod
+    def facets_db(
+        cls,
+        ingredient_list,
+        mode_selection,
+        strict_filter,
+        language=None,
+        exclude=(),
+        tags=None,
+        ranges=None,
+        text="",
+    ):
+        """Same as `recipe_index.facets`, but by one grouped query on the DB"""
+        res = cls.search_db(ingredient_list, mode_selection, strict_filter, text=text)
+        res = cls.filter_db(res, language, exclude, tags, ranges)
+        counts = (
+            RecipeTag.objects.filter(recipe__in=res.order_by().values("id"))
+            .values_list("tag__category", "tag__name")
+            .annotate(count=Count("id"))
+            .order_by()
+        )
+        facets = {}
+        for category, name, count in counts:
+            facets.setdefault(category, {})[name] = count
+        return facets
+
+    @staticmethod
+    def filter_db(res, language=None, exclude=(), tags=None, ranges=None):
+        """`res` restricted like by the same arguments of `recipe_index.search`"""
+        if language is not None:
+            res = res.filter(language=language)
+        if exclude:
+            res = res.exclude(ingredient_ids__overlap=list(exclude))  # NOT &&
+        for category, names in (tags or {}).items():
+            res = res.filter(
+                Exists(
+                    RecipeTag.objects.filter(
+                        recipe=OuterRef("pk"),
+                        tag__category=category,
+                        tag__name__in=names,
+                    )
+                )
+            )
+        for name, (low, high) in (ranges or {}).items():
+            if low is not None:
+                res = res.filter(**{f"{RANGES[name]}__gte": low})
+            if high is not None:
+                res = res.filter(**{f"{RANGES[name]}__lte": high})
+        return res
+
+    @staticmethod
+    def search_db(
+        ingredient_list,
+        mode_selection,
+        strict_filter,
+        order="bm",
+        weights=None,
+        text="",
+    ):
+        """
+        Same search as `recipe_index.search`, but done by the DB using the
+        GIN-indexed `Recipe.ingredient_ids` instead of joining ingredients.
+        If given, `text` (web search syntax) must match the GIN-indexed
+        `Recipe.search_vector` too, and is what the "relevance" order ranks.
+        """
+        ids = sorted({int(ing) for ing in ingredient_list})
+        res = Recipe.objects.annotate(
+            c=Func(
+                "ingredient_ids", function="cardinality", output_field=IntegerField()
+            ),
+            bm=sum(
+                (
+                    Case(When(ingredient_ids__contains=[ing], then=1), default=0)
+                    for ing in ids
+                ),
+                Value(0),
+            ),
+        )
+        if text:
+            res = SearchRecipe.match_text(res, text)
+        if strict_filter:
+            res = res.filter(num_ingredients=F("c"))
+        if len(ids) > 0:
+            if mode_selection == "exact":
+                res = res.filter(ingredient_ids__contains=ids)  # @>
+                if strict_filter:
+                    res = res.filter(c=len(ids))
+            elif mode_selection == "any":
+                res = res.filter(ingredient_ids__overlap=ids)  # &&
+                if strict_filter:
+                    res = res.filter(ingredient_ids__contained_by=ids)  # <@
+        return SearchRecipe.order_db(res, ids, order, weights)
+
+    @staticmethod
+    def match_text(res, text):
+        """
+        recipes of `res` matching `text` (web search syntax), annotated with
+        their "relevance"
+        """
+        query = SearchQuery(text, config=TEXT_SEARCH_CONFIG, search_type="websearch")
+        return res.filter(search_vector=query).annotate(
+            # double precision, so that cursors keep the exact value
+            relevance=Cast(SearchRank(F("search_vector"), query), FloatField())
+        )
+
+    @staticmethod
+    def order_db(res, ids, order, weights=None):
+        """
+        recipes of `search_db` ordered by `order`, given the sorted ids of the
+        searched ingredients
+        """
+        if order == "coverage":
+            res = res.annotate(
+                coverage=Case(
+                    When(c=0, then=Value(0.0)),
+                    default=Cast("bm", FloatField()) / F("c"),
+                )
+            ).order_by("-coverage", "-bm", "id")
+        elif order == "missing":
+            res = res.annotate(missing=F("c") - F("bm")).order_by(
+                "missing", "-bm", "id"
+            )
+        elif order == "expiry":
+            weights = {k: w for k, w in (weights or {}).items() if k in ids}
             res = res.annotate(
-                bm=Count(
-                    "ingredients",
-                    filter=Q(ingredients__id__in=ingredient_list),
-                    distinct=True,
+                expiry=sum(
+                    (
+                        Case(
+                            When(ingredient_ids__contains=[ing], then=Value(w)),
+                            default=Value(0.0),
+                        )
+                        for ing, w in weights.items()
+                    ),
+                    Value(0.0),
                 )
-            ).order_by("-bm")
-            res = res.annotate_all(user_id).distinct()[:30]
+            ).order_by("-expiry", "-bm", "id")
+        elif order == "relevance":
+            res = res.order_by("-relevance", "-bm", "id")
+        else:
+            res = res.order_by("-bm", "id")
+        return res
+
+
+class SearchRecipeBatch(APIView):
+    def post(self, request, format=None):
+        """
+        Get the first page of recipes search results of several searches
+        (e.g. the slots of a meal plan) sharing the other criterias.
+        """
+        user_id = request.auth["user_id"] if request.auth else None
+        data = request.data
+        try:
+            queries = self.parse_queries(data["queries"], user_id)
+            order = str(data.get("order", "bm")).lower()
+            if order not in RANKINGS or order == "relevance":
+                raise ValueError(f"unknown order: {order}")
+            weights, as_of = None, None
+            if order == "expiry":
+                if user_id is None:
+                    raise NotAuthenticated()
+                as_of = timezone.now().timestamp()
+                weights = expiry_weights(user_id, as_of)
+            limit = int(data.get("limit", 30))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            filters = self.parse_filters(data, user_id)
 
+            if settings.RECIPE_SEARCH_INDEX:
+                search_many, search = recipe_index.search_many, recipe_index.search
+            else:
+                search_many = SearchRecipe.search_many_db
+                search = SearchRecipe.search_ids_db
+            pages = search_cache.search_many(
+                search_many,
+                search,
+                queries,
+                limit=limit,
+                order=order,
+                weights=weights,
+                **filters,
+            )
+            # hydrate the recipes of all the pages at once
+            ids = {id for page_ids, _ in pages for id in page_ids}
+            recipes = recipe_payloads(ids, user_id, None, *parse_fieldsets(data))
             return Response(
-                RecipeSerializer(res, many=True).data,
+                [
+                    SearchRecipe.page(
+                        [recipes[id] for id in page_ids if id in recipes],
+                        cursor=last_key and (order, last_key, as_of),
+                    )
+                    for page_ids, last_key in pages
+                ],
                 status=status.HTTP_200_OK,
             )
+        except (NotAuthenticated, ParseError):
+            raise
         except Exception as e:
-            print(e)
             return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+    @staticmethod
+    def parse_queries(specs, user_id):
+        """(ingredient ids, mode, strict) of each query of the batch"""
+        queries = []
+        for spec in specs:
+            ingredient_list = [int(ing) for ing in spec.get("ingredient", [])]
+            mode_selection = str(spec.get("mode", "any")).lower()
+            if mode_selection == "fridge":  # use what the user has in storage
+                if user_id is None:
+                    raise NotAuthenticated()
+                ingredient_list += user_inventory(user_id)
+                mode_selection = "any"
+            queries.append(
+                (ingredient_list, mode_selection, bool(spec.get("strict", False)))
+            )
+        if not 0 < len(queries) <= MAX_BATCH_QUERIES:
+            raise ValueError(
+                f"number of queries must be between 1 and {MAX_BATCH_QUERIES}"
+            )
+        return queries
+
+    @staticmethod
+    def parse_filters(data, user_id):
+        """filters shared by all the queries of the batch"""
+        exclude = data.get("exclude", [])
+        if user_id is not None:  # e.g. allergens
+            exclude = [*exclude, *user_exclusions(user_id)]
+        return {
+            "language": data.get("language"),
+            "exclude": {int(ing) for ing in exclude},
+            "tags": parse_tags(data.get("tag", [])),
+            "ranges": parse_ranges(data),
+        }
+
 
 class UsersRecipesHistory(APIView):
     permission_classes = [IsAuthenticated]
@@ -248,24 +760,13 @@ class UsersRecipesHistory(APIView):
         Get recipe history information of user.
         """
         user_id = request.auth["user_id"] if request.auth else None
-        urhs = (
-            UserRecipeHistory.objects.filter(user=user_id)
-            .prefetch_related(
-                Prefetch("recipe", queryset=Recipe.objects.annotate_all(user_id))
-            )
-            .order_by("-access_date")
-            .annotate(
-                favorite=Exists(
-                    UserRecipeFavorite.objects.filter(
-                        user=OuterRef("user"), recipe=OuterRef("recipe")
-                    )
-                )
-            )
-        )
-
+        fields, expand = parse_fieldsets(request.query_params)
+        if request.query_params.get("compact", "false").lower() == "true":
+            tables = compact_tables()
+            data = {"results": history_list(user_id, tables, fields, expand), **tables}
+            return Response(data, status=status.HTTP_200_OK)
         return Response(
-            UserRecipeHistorySerializer(urhs, many=True, read_only=True).data,
-            status=status.HTTP_200_OK,
+            history_list(user_id, None, fields, expand), status=status.HTTP_200_OK
         )
 
     def post(self, request, format=None):
@@ -304,10 +805,14 @@ class UsersRecipesHistory(APIView):
         try:
             user_id = request.auth["user_id"]
             data = request.data
-            res = UserRecipeHistory.objects.get(user=user_id, recipe=data["recipe_id"])
-            res.cooked = data["cooked"] if "cooked" in data else False
-            res.access_date = timezone.now()
-            res.save()
+            # locked so that concurrent updates count `cooked` changes once
+            with transaction.atomic():
+                res = UserRecipeHistory.objects.select_for_update().get(
+                    user=user_id, recipe=data["recipe_id"]
+                )
+                res.cooked = data["cooked"] if "cooked" in data else False
+                res.access_date = timezone.now()
+                res.save()
             return Response(
                 {
                     **UserRecipeHistorySerializer(res).data,
@@ -347,17 +852,16 @@ class UsersFavoriteRecipes(APIView):
         Get favorite recipe information of user.
         """
         user_id = request.auth["user_id"] if request.auth else None
-        urfs = (
-            UserRecipeFavorite.objects.filter(user=user_id)
-            .prefetch_related(
-                Prefetch("recipe", queryset=Recipe.objects.annotate_all(user_id))
-            )
-            .order_by("-added_date")
-        )
-
+        fields, expand = parse_fieldsets(request.query_params)
+        if request.query_params.get("compact", "false").lower() == "true":
+            tables = compact_tables()
+            data = {
+                "results": favorite_list(user_id, tables, fields, expand),
+                **tables,
+            }
+            return Response(data, status=status.HTTP_200_OK)
         return Response(
-            UserRecipeFavoriteSerializer(urfs, many=True, read_only=True).data,
-            status=status.HTTP_200_OK,
+            favorite_list(user_id, None, fields, expand), status=status.HTTP_200_OK
         )
 
     def post(self, request, format=None):
@@ -402,6 +906,90 @@ class UsersFavoriteRecipes(APIView):
             return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
 
 
+class UsersExcludedIngredients(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        """
+        Get ingredients the user excluded from recipe search, e.g. allergens.
+        """
+        user_id = request.auth["user_id"] if request.auth else None
+        ueis = (
+            UserExcludedIngredient.objects.filter(user=user_id)
+            .prefetch_related(
+                Prefetch(
+                    "ingredient", queryset=Ingredient.objects.annotate_all(user_id)
+                )
+            )
+            .order_by("-added_date")
+        )
+
+        return Response(
+            UserExcludedIngredientSerializer(ueis, many=True).data,
+            status=status.HTTP_200_OK,
+        )
+
+    def post(self, request, format=None):
+        """
+        Exclude an ingredient from recipe search of the user.
+        """
+        try:
+            res = UserExcludedIngredient.objects.create(
+                user=User.objects.get(id=request.auth["user_id"]),
+                ingredient=Ingredient.objects.get(id=request.data["ingredient_id"]),
+            )
+            return Response(
+                {
+                    **UserExcludedIngredientSerializer(res).data,
+                    "ingredient": res.ingredient.id,  # overwrite
+                },
+                status=status.HTTP_201_CREATED,
+            )
+        except Exception as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+    def delete(self, request, format=None):
+        """
+        Stop excluding an ingredient from recipe search of the user.
+        """
+        try:
+            res = UserExcludedIngredient.objects.get(
+                user=request.auth["user_id"], ingredient=request.data["ingredient_id"]
+            )
+            n, _ = res.delete()
+            return Response(
+                {
+                    "message": "Delete successful.",
+                    "deleted": n,
+                },
+                status=status.HTTP_200_OK,
+            )
+        except Exception as e:
+            return Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+
+class UsersRecommendations(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        """
+        Get recipes recommended by what similar users viewed, cooked and liked.
+        """
+        user_id = request.auth["user_id"] if request.auth else None
+        try:
+            limit = int(request.query_params.get("limit", 10))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            fields, expand = parse_fieldsets(request.query_params)
+            recommended = recommend(user_id, limit)
+            return Response(
+                recipe_list([i for i, _ in recommended], user_id, None, fields, expand),
+                status=status.HTTP_200_OK,
+            )
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
 class UsersStatistics(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -485,20 +1073,188 @@ class RecipesStatistics(APIView):
         """
         Returns statistics about recipes (10 most cooked, 10 most liked, 10 most viewed).
         """
-        pass
+        try:
+            fields, expand = parse_fieldsets(request.query_params)
+            # the same for every user, so that it can be cached by anyone
+            tops, computed_at = rankings()
+            last_modified = computed_at and int(computed_at.timestamp())
+            response = get_conditional_response(request, last_modified=last_modified)
+            if response is None:
+                recipes = recipe_payloads(
+                    {i for top in tops.values() for i, _ in top},
+                    None,
+                    None,
+                    fields,
+                    expand,
+                )
+                response = Response(
+                    {
+                        **{
+                            f"most_{kind}": [
+                                {**recipes[i], "count": count}
+                                for i, count in top
+                                if i in recipes
+                            ]
+                            for kind, top in tops.items()
+                        },
+                        "computed_at": computed_at,
+                    },
+                    status=status.HTTP_200_OK,
+                )
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified)
+            patch_cache_control(
+                response, public=True, max_age=settings.RECIPE_STATISTICS_MAX_AGE
+            )
+            return response
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+class RecipesTrending(APIView):
+    def get(self, request, format=None):
+        """
+        Returns the recipes viewed the most recently (decayed view counts).
+        """
+        try:
+            limit = int(request.query_params.get("limit", 10))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            fields, expand = parse_fieldsets(request.query_params)
+            trending = recipe_trends.top(limit)
+            # the same for every user, like the statistics
+            recipes = recipe_payloads(
+                [i for i, _ in trending], None, None, fields, expand
+            )
+            return Response(
+                [
+                    {**recipes[i], "score": score}
+                    for i, score in trending
+                    if i in recipes
+                ],
+                status=status.HTTP_200_OK,
+            )
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
 class RecipesRandom(APIView):
     def get(self, request, format=None):
         """
-        Returns a random recipe from the database.
+        Returns a random recipe from the database, or `n` distinct ones.
+        """
+        user_id = request.auth["user_id"] if request.auth else None
+        language = request.query_params.get("language")
+        # recipes with any of the given tags ("category::name") of every category
+        tags = parse_tags(request.query_params.getlist("tag"))
+        fields, expand = parse_fieldsets(request.query_params)
+        # only recipes not in the user's history
+        unseen = request.query_params.get("unseen", "false").lower() == "true"
+        if unseen and user_id is None:
+            raise NotAuthenticated()
+        try:
+            n = int(request.query_params.get("n", 1))
+            if not 0 < n <= MAX_LIMIT:
+                raise ValueError(f"n must be between 1 and {MAX_LIMIT}")
+            seen = ()
+            if unseen:
+                seen = UserRecipeHistory.objects.filter(user=user_id).values_list(
+                    "recipe_id", flat=True
+                )
+            sample = (
+                recipe_index.sample if settings.RECIPE_SEARCH_INDEX else self.sample_db
+            )
+            ids = sample(n, language, tags, set(seen))
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        recipes = recipe_list(ids, user_id, None, fields, expand)
+        if "n" in request.query_params:
+            return Response(recipes, status=status.HTTP_200_OK)
+        if not recipes:
+            return Response(
+                {"message": "no recipe found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        return Response(recipes[0], status=status.HTTP_200_OK)
+
+    @staticmethod
+    def sample_db(k, language=None, tags=None, exclude_ids=()):
+        """
+        Returns up to `k` distinct random recipe ids like `recipe_index.sample`,
+        each the first recipe passing the filters at or after a random point of
+        the id range (wrapping around to the first one): one index seek each,
+        all in one query, so recipes after gaps in the ids are picked more
+        often. Falls back to shuffling the remaining recipes when the draws
+        keep landing on the same few, e.g. for rare tags.
+        """
+        bounds = Recipe.objects.aggregate(low=Min("id"), high=Max("id"))
+        if bounds["low"] is None:
+            return []
+        recipes = SearchRecipe.filter_db(Recipe.objects.all(), language, tags=tags)
+        excluded = set(exclude_ids)
+        chosen = []
+        for _ in range(MAX_SAMPLING_ROUNDS):
+            missing = k - len(chosen)
+            if not missing:
+                return chosen
+            draws = RecipesRandom.draw_db(
+                recipes.exclude(id__in=excluded), 2 * missing, **bounds
+            )
+            if not draws:  # nothing left
+                return chosen
+            for recipe_id in draws:
+                if recipe_id not in excluded and len(chosen) < k:
+                    excluded.add(recipe_id)
+                    chosen.append(recipe_id)
+        shuffled = recipes.exclude(id__in=excluded).order_by("?")
+        return chosen + list(shuffled.values_list("id", flat=True)[: k - len(chosen)])
+
+    @staticmethod
+    def draw_db(recipes, n, low, high):
+        """ids of the recipes at `n` random points of the id range, with repeats"""
+        firsts = [
+            recipes.filter(id__gte=random.randint(low, high))
+            .order_by("id")
+            .annotate(draw=Value(i))
+            .values_list("draw", "id")[:1]
+            for i in range(n)
+        ]
+        # where the draws past the last recipe wrap around to
+        first = recipes.order_by("id").annotate(draw=Value(-1))
+        found = dict(first.values_list("draw", "id")[:1].union(*firsts, all=True))
+        if -1 not in found:
+            return []
+        return [found.get(i, found[-1]) for i in range(n)]
+
+
+class RecipesSimilar(APIView):
+    def get(self, request, pk, format=None):
+        """
+        Returns the recipes with the most similar sets of ingredients to the recipe.
         """
         user_id = request.auth["user_id"] if request.auth else None
-        rec = Recipe.objects.annotate_all(user_id).all()
-        count = Recipe.objects.count()
-        random_number = random.randint(0, count - 1)
+        fields, expand = parse_fieldsets(request.query_params)
+        try:
+            limit = int(request.query_params.get("limit", 10))
+            if not 0 < limit <= MAX_LIMIT:
+                raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+            similar = similar_recipes(pk, limit)
+        except ObjectDoesNotExist:
+            return Response(
+                {"message": "recipe not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        recipes = recipe_payloads(
+            [i for i, _ in similar], user_id, None, fields, expand
+        )
         return Response(
-            RecipeSerializer(rec[random_number]).data,
+            [
+                {**recipes[i], "similarity": similarity}
+                for i, similarity in similar
+                if i in recipes
+            ],
             status=status.HTTP_200_OK,
         )
 
@@ -508,4 +1264,24 @@ class IngredientsStatistics(APIView):
         """
         Returns statistics about ingredients (10 most used, 10 most happy).
         """
-        pass
+        try:
+            most_used, most_happy = ingredient_rankings()
+            return Response(
+                {
+                    "most_used": [
+                        {**IngredientSerializer(ingredient).data, "uses": uses}
+                        for ingredient, uses in most_used
+                    ],
+                    "most_happy": [
+                        {
+                            **IngredientSerializer(ingredient).data,
+                            "happiness": happiness,
+                            "num_ratings": count,
+                        }
+                        for ingredient, happiness, count in most_happy
+                    ],
+                },
+                status=status.HTTP_200_OK,
+            )
+        except Exception as e:
+            return Response({"message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "corsheaders",
     "rest_framework",
     "rest_framework_simplejwt",
@@ -161,6 +162,24 @@ SIMPLE_JWT = {
     "ISSUER": "Refrigerator Catalogue",
 }
 
+# Recipe search
+# answer ingredient-based searches from the in-process index (see api/search_index.py)
+RECIPE_SEARCH_INDEX = os.environ.get("DJANGO_RECIPE_SEARCH_INDEX", "True") == "True"
+RECIPE_INDEX_REBUILD_SECONDS = int(
+    os.environ.get("DJANGO_RECIPE_INDEX_REBUILD_SECONDS", 60 * 60)
+)
+# max number of cached search results per worker (see api/search_cache.py)
+RECIPE_SEARCH_CACHE_SIZE = int(os.environ.get("DJANGO_RECIPE_SEARCH_CACHE_SIZE", 1024))
+# max-age of the recipe statistics, at most the period of
+# `manage.py refresh_statistics` (see api/rollups.py)
+RECIPE_STATISTICS_MAX_AGE = int(
+    os.environ.get("DJANGO_RECIPE_STATISTICS_MAX_AGE", 60 * 60)
+)
+
+# max age of a cached user inventory, as changes made through another worker do
+# not invalidate the local cache (see api/inventory.py)
+INVENTORY_CACHE_SECONDS = int(os.environ.get("DJANGO_INVENTORY_CACHE_SECONDS", 60))
+
 if DEBUG:
     import logging
 
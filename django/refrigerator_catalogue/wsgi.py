@@ -14,3 +14,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "refrigerator_catalogue.settings")
 
 application = get_wsgi_application()
+
+# build the in-process indexes before serving any request
+from api.autocomplete import ingredient_autocomplete  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+ingredient_autocomplete.build()
+
+if settings.RECIPE_SEARCH_INDEX:
+    from api.search_index import recipe_index
+
+    recipe_index.build()